@@ -1,131 +1,767 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
-import base64
-import io
-from PIL import Image
 import numpy as np
-import cv2
-from clothing_detector import ClothingDetector
+from detector_config import detector_from_env, result_cache_from_env
+from pipeline import NO_CLOTHING_ERROR
+from serving import InferenceGate, MemoryBudget, PayloadTooLarge, ServerBusy, inference_limits
+from inference_scheduler import QUEUE_WAIT_BUCKETS_MS, MicroBatchScheduler
+from metrics import StageMetrics, StageTimer
+from streaming import (
+    NDJSON_MIMETYPES, decode_base64_image, iter_base64_images, iter_multipart_images, iter_ndjson_images,
+    ndjson_line, sse_event
+)
+from wire_format import MSGPACK_MIMETYPE, is_raw_image, msgpack_available, negotiated_response, pack, prefers_msgpack
+from jobs import JobStore
+from closet_store import ClosetStore, fingerprint
+from wardrobe_index import QUERY_MODES, WardrobeIndex, colored_detections
+from sequence_analysis import SequenceAnalyzer, iter_video_frames
+import itertools
 import os
+from contextlib import ExitStack, contextmanager
 from dotenv import load_dotenv
+from werkzeug.exceptions import RequestEntityTooLarge
 
 load_dotenv()
 
 app = Flask(__name__)
 CORS(app)
+# Larger request bodies are refused with 413 (MAX_REQUEST_MB=0 disables the limit)
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_REQUEST_MB', 100)) * 2 ** 20 or None
 
-# Initialize the clothing detector
-detector = ClothingDetector()
+# Result cache for repeated uploads (RESULT_CACHE_SIZE=0 disables it)
+result_cache = result_cache_from_env()
+
+# Initialize the clothing detector. Models load in the background (in parallel)
+# so the process can answer /health and /ready while they warm up. Under gunicorn
+# with preload_app they load synchronously before fork and warm up in each worker.
+preforked = os.environ.get('DRESSAPP_PRELOADED') == '1'
+# Requests analyzed at once split the worker's cores for crop work; a micro-batch
+# analyzes its images one after another, so it keeps the whole share
+max_concurrent_inference, max_queued_inference = inference_limits()
+microbatch_window_ms = float(os.environ.get('MICROBATCH_WINDOW_MS', 0))
+detector = detector_from_env(
+    result_cache=result_cache,
+    crop_shares=1 if microbatch_window_ms > 0 else max_concurrent_inference
+)
+detector.load_models(
+    background=os.environ.get('MODEL_BACKGROUND_LOAD', '1') == '1' and not preforked,
+    warmup=os.environ.get('MODEL_WARMUP', '1') == '1' and not preforked
+)
+
+# Micro-batch concurrent /detect-clothing requests (MICROBATCH_WINDOW_MS=0 disables it)
+microbatch_max_size = int(os.environ.get('MICROBATCH_MAX_SIZE', 8))
+batch_scheduler = MicroBatchScheduler(
+    detector,
+    window_ms=microbatch_window_ms,
+    max_batch_size=microbatch_max_size
+) if microbatch_window_ms > 0 else None
+
+# Bound in-flight inference per worker; excess requests get HTTP 503.
+# Sized together with the gunicorn threads, see inference_limits().
+inference_gate = InferenceGate(
+    max_concurrent=max_concurrent_inference,
+    max_queued=max_queued_inference,
+    timeout=float(os.environ.get('INFERENCE_QUEUE_TIMEOUT', 30))
+)
+
+@app.errorhandler(ServerBusy)
+def handle_server_busy(error):
+    """Reject with 503 + Retry-After when the inference queue is saturated"""
+    response = negotiated_response({
+        'success': False,
+        'error': str(error)
+    }, 503)
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+# Decoded images held by in-flight requests of this worker (DECODE_MEMORY_MB=0 disables the budget)
+memory_budget = MemoryBudget(
+    max_bytes=int(os.environ.get('DECODE_MEMORY_MB', 512)) * 2 ** 20,
+    timeout=float(os.environ.get('DECODE_MEMORY_TIMEOUT', 5))
+)
+
+@app.errorhandler(PayloadTooLarge)
+@app.errorhandler(RequestEntityTooLarge)
+def handle_payload_too_large(error):
+    """Reject uploads over the request size, pixel or memory limits with 413"""
+    message = str(error) if isinstance(error, PayloadTooLarge) else (
+        f"Request body is over the {app.config['MAX_CONTENT_LENGTH'] // 2 ** 20} MB limit"
+    )
+    return negotiated_response({
+        'success': False,
+        'error': message
+    }, 413)
+
+# Bulk analysis jobs; `python jobs.py` runs the workers that drain this queue
+job_store = JobStore(os.environ.get('JOB_DB_PATH', 'jobs.db'))
+
+# Last results of closet items for incremental /analyze-closet requests
+closet_store = ClosetStore(os.environ.get('CLOSET_DB_PATH', 'closets.db'))
+
+# Per-user color index of closet items for /wardrobe queries
+wardrobe_index = WardrobeIndex(os.environ.get('WARDROBE_DIR', 'wardrobe'))
+
+# Upper bound on frames analyzed per /analyze-sequence request
+sequence_max_frames = int(os.environ.get('SEQUENCE_MAX_FRAMES', 300))
+
+# Rolling per-stage latency summaries for /metrics
+stage_metrics = StageMetrics()
+
+def timed_response(payload, timer: StageTimer):
+    """Serialize a result, optionally attach stage timings (?debug=1), and record them"""
+    if request.args.get('debug', '0').lower() in ('1', 'true', 'yes'):
+        payload['timings_ms'] = timer.as_ms()
+    with timer.stage('serialization'):
+        response = negotiated_response(payload)
+    stage_metrics.observe(timer)
+    return response
+
+def uploaded_image():
+    """Image bytes of a single-image upload, or None.
+    
+    Takes a raw body (application/octet-stream or image/*), an 'image' file
+    part, or JSON {"image_base64": ...}. Raw bodies are read once without
+    caching and decoded in place, skipping the base64 round trip.
+    """
+    if is_raw_image(request.mimetype):
+        return request.get_data(cache=False) or None
+    if 'image' in request.files:
+        return request.files['image'].read()
+    body = request.get_json(silent=True)
+    if isinstance(body, dict) and 'image_base64' in body:
+        return decode_base64_image(body['image_base64'])
+    return None
+
+@contextmanager
+def decoded_upload(image_bytes: bytes, timer: StageTimer):
+    """Decode one upload while holding its share of the memory budget; yields (image_array, original_size).
+    
+    The header is probed first, so an image over the pixel or memory limits
+    raises PayloadTooLarge before any pixels are decoded.
+    """
+    info = detector.probe_image(image_bytes)
+    with memory_budget.reserve(detector.decoded_bytes(info, len(image_bytes))):
+        with timer.stage('decode'):
+            decoded = detector.decode_for_analysis(image_bytes, info)
+        yield decoded
+
+def uploaded_images():
+    """Iterate (image_bytes, error) over a multipart, NDJSON or JSON {"images": [...]} upload.
+    
+    Multipart and NDJSON bodies are read incrementally. Returns None for
+    unsupported uploads.
+    """
+    if request.mimetype == 'multipart/form-data':
+        boundary = request.mimetype_params.get('boundary')
+        return iter_multipart_images(request.stream, boundary.encode('latin-1')) if boundary else None
+    if request.mimetype in NDJSON_MIMETYPES:
+        return iter_ndjson_images(request.stream)
+    if request.is_json:
+        body = request.get_json(silent=True)
+        if isinstance(body, dict) and isinstance(body.get('images'), list):
+            return iter_base64_images(body['images'])
+    return None
+
+def use_result_cache() -> bool:
+    """Per-request cache bypass via ?cache=0 or a Cache-Control: no-cache header"""
+    if request.args.get('cache', '1').lower() in ('0', 'false', 'no'):
+        return False
+    return 'no-cache' not in request.headers.get('Cache-Control', '').lower()
 
 @app.route('/health', methods=['GET'])
 def health_check():
-    """Health check endpoint"""
+    """Health check endpoint (liveness; see /ready for model readiness)"""
     return jsonify({
         'status': 'healthy', 
         'message': 'AI Clothing Detection API is running',
         'models_loaded': {
-            'yolo': True,
-            'sam': detector.sam_predictor is not None
-        }
+            'yolo': detector.model_state['yolo'] == 'ready',
+            'sam': detector.model_state['sam'] == 'ready'
+        },
+        'model_state': detector.model_state,
+        'model_backends': detector.model_backends,
+        'detection': detector.detection_mode,
+        'response_formats': ['application/json'] + ([MSGPACK_MIMETYPE] if msgpack_available() else []),
+        'segmentation': detector.segmentation_method,
+        'result_cache': result_cache.stats() if result_cache is not None else None,
+        'inference_queue': inference_gate.stats(),
+        'decode_memory': memory_budget.stats(),
+        'micro_batching': batch_scheduler.stats() if batch_scheduler is not None else None,
+        'jobs': job_store.stats(),
+        'closets': closet_store.stats(),
+        'wardrobe': wardrobe_index.stats()
     })
 
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    """Readiness probe: 200 once the models are loaded and warmed up, 503 before"""
+    ready = detector.is_ready()
+    return jsonify({
+        'ready': ready,
+        'models': detector.model_state,
+        'errors': detector.model_errors
+    }), 200 if ready else 503
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics: per-stage latency quantiles plus cache/queue counters, gauges and histograms"""
+    gauges = [
+        ('dressapp_inference_active', 'Requests currently running inference', inference_gate.active),
+        ('dressapp_inference_waiting', 'Requests waiting for an inference slot', inference_gate.waiting)
+    ]
+    counters = [
+        ('dressapp_inference_rejected_total', 'Requests rejected with 503', inference_gate.rejected)
+    ]
+    histograms = []
+    if result_cache is not None:
+        cache_stats = result_cache.stats()
+        counters += [
+            ('dressapp_result_cache_hits_total', 'Result cache memory hits', cache_stats['hits']),
+            ('dressapp_result_cache_disk_hits_total', 'Result cache disk hits', cache_stats['disk_hits']),
+            ('dressapp_result_cache_misses_total', 'Result cache misses', cache_stats['misses'])
+        ]
+    if batch_scheduler is not None:
+        batch_stats = batch_scheduler.stats()
+        counters.append(('dressapp_microbatch_batches_total', 'Micro-batches run', batch_stats['batches']))
+        sizes = batch_stats['batch_size_histogram']
+        histograms += [
+            ('dressapp_microbatch_batch_size', 'Requests per micro-batch',
+             [(size, sizes.get(size, 0)) for size in range(1, batch_stats['max_batch_size'] + 1)]
+             + [(float('inf'), 0)], batch_stats['requests']),
+            ('dressapp_microbatch_queue_wait_seconds', 'Time requests wait for their micro-batch',
+             list(zip([bound / 1000.0 for bound in QUEUE_WAIT_BUCKETS_MS] + [float('inf')],
+                      batch_stats['queue_wait_ms_histogram'].values())),
+             batch_stats['queue_wait_ms_sum'] / 1000.0)
+        ]
+    
+    return Response(stage_metrics.prometheus_text(gauges, counters, histograms), mimetype='text/plain; version=0.0.4')
+
 @app.route('/detect-clothing', methods=['POST'])
+@inference_gate.limit
 def detect_clothing():
     """Detect clothing types and colors from uploaded image"""
+    timer = StageTimer()
     try:
         # Get image data from request
-        if 'image' not in request.files and 'image_base64' not in request.json:
-            return jsonify({'error': 'No image provided'}), 400
+        try:
+            image_bytes = uploaded_image()
+        except ValueError as e:
+            return negotiated_response({'success': False, 'error': str(e)}, 400)
+        if image_bytes is None:
+            return negotiated_response({'error': 'No image provided'}, 400)
         
-        # Handle base64 encoded image
-        if 'image_base64' in request.json:
-            image_data = request.json['image_base64']
-            # Remove data URL prefix if present
-            if image_data.startswith('data:image'):
-                image_data = image_data.split(',')[1]
-            
-            image_bytes = base64.b64decode(image_data)
-            image = Image.open(io.BytesIO(image_bytes))
-        
-        # Handle file upload
-        elif 'image' in request.files:
-            file = request.files['image']
-            image = Image.open(file.stream)
-        
-        # Convert to RGB if necessary
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        # Convert PIL image to numpy array
-        image_array = np.array(image)
-        
-        # Detect clothing
-        results = detector.detect_clothing_from_array(image_array)
+        # Decode in memory within the memory budget and detect clothing
+        try:
+            with decoded_upload(image_bytes, timer) as (image_array, original_size):
+                if batch_scheduler is not None:
+                    results = batch_scheduler.detect(image_array, use_cache=use_result_cache(), timer=timer,
+                                                     original_size=original_size)
+                else:
+                    results = detector.detect_clothing_from_array(image_array, use_cache=use_result_cache(),
+                                                                  timer=timer, original_size=original_size)
+        except PayloadTooLarge:
+            raise
+        except ValueError as e:
+            results = {
+                'success': False,
+                'error': str(e),
+                'detections': []
+            }
         
-        return jsonify(results)
+        return timed_response(results, timer)
         
+    except (PayloadTooLarge, RequestEntityTooLarge, ServerBusy):
+        raise
     except Exception as e:
-        return jsonify({
+        return negotiated_response({
             'success': False,
             'error': str(e)
-        }), 500
+        }, 500)
 
-@app.route('/analyze-closet', methods=['POST'])
-def analyze_closet():
-    """Analyze multiple clothing items from closet"""
+def analyze_uploads(images, timer: StageTimer):
+    """Results of (image_bytes, error) pairs in upload order.
+    
+    Valid images are decoded into the memory budget and analyzed together;
+    when the next image doesn't fit, the ones decoded so far are analyzed
+    and released first, so a large upload is processed in batches that fit.
+    """
+    results = []
+    batch = []
+    reservations = ExitStack()
+    
+    def analyze_batch():
+        detections = detector.detect_batch([image_array for _, image_array, _ in batch], use_cache=use_result_cache(),
+                                           timer=timer, original_sizes=[size for _, _, size in batch])
+        for (i, _, _), detection in zip(batch, detections):
+            results[i] = {
+                'index': i,
+                'success': True,
+                'detection': detection
+            }
+        batch.clear()
+        reservations.close()
+    
     try:
-        if 'images' not in request.json:
-            return jsonify({'error': 'No images provided'}), 400
-        
-        images_data = request.json['images']
-        results = []
-        
-        for i, image_data in enumerate(images_data):
+        for i, (image_bytes, error) in enumerate(images):
+            results.append(None)
             try:
-                # Remove data URL prefix if present
-                if image_data.startswith('data:image'):
-                    image_data = image_data.split(',')[1]
-                
-                image_bytes = base64.b64decode(image_data)
-                image = Image.open(io.BytesIO(image_bytes))
-                
-                if image.mode != 'RGB':
-                    image = image.convert('RGB')
+                if error is not None:
+                    raise ValueError(error)
                 
-                image_array = np.array(image)
-                detection = detector.detect_clothing_from_array(image_array)
-                
-                results.append({
-                    'index': i,
-                    'success': True,
-                    'detection': detection
-                })
+                info = detector.probe_image(image_bytes)
+                cost = detector.decoded_bytes(info, len(image_bytes))
+                reservation = memory_budget.try_reserve(cost)
+                if reservation is None:
+                    # Analyze and release what this request holds before waiting for others
+                    if batch:
+                        analyze_batch()
+                    reservation = memory_budget.reserve(cost)
+                reservations.enter_context(reservation)
+                with timer.stage('decode'):
+                    image_array, original_size = detector.decode_for_analysis(image_bytes, info)
+                batch.append((i, image_array, original_size))
                 
+            except ServerBusy:
+                raise
             except Exception as e:
-                results.append({
+                results[i] = {
                     'index': i,
                     'success': False,
                     'error': str(e)
-                })
+                }
         
-        return jsonify({
+        if batch:
+            analyze_batch()
+    finally:
+        reservations.close()
+    return results
+
+def is_settled(detection) -> bool:
+    """Whether a detection result describes the image rather than a failure to analyze it"""
+    return detection['success'] or detection.get('error') == NO_CLOTHING_ERROR
+
+def analyze_closet_items(body, timer: StageTimer):
+    """Incremental closet analysis: only new and changed items are analyzed.
+    
+    Body: {"closet_id": ..., "items": [{"id": ..., "fingerprint": ..., "image_base64": ...}, ...]}.
+    An item whose fingerprint (hex SHA-256 of the image bytes) matches the
+    stored one gets its stored result and may omit the image; an image that
+    is sent is fingerprinted here.
+    """
+    closet_id = body.get('closet_id')
+    items = body.get('items')
+    if not isinstance(closet_id, str) or not closet_id or not isinstance(items, list):
+        return negotiated_response({'error': 'Send {"closet_id": ..., "items": [{"id": ..., ...}]}'}, 400)
+    item_ids = [item.get('id') if isinstance(item, dict) else None for item in items]
+    if not all(isinstance(item_id, str) and item_id for item_id in item_ids):
+        return negotiated_response({'error': 'Every item needs a string "id"'}, 400)
+    if len(set(item_ids)) != len(item_ids):
+        return negotiated_response({'error': 'Item ids must be unique'}, 400)
+    
+    config = detector.cache_config()
+    stored = closet_store.lookup(closet_id, item_ids, config)
+    results = [None] * len(items)
+    changed = []
+    for i, (item_id, item) in enumerate(zip(item_ids, items)):
+        result = {'index': i, 'id': item_id, 'recomputed': False}
+        image_bytes = None
+        encoded = item.get('image_base64', item.get('image'))
+        if encoded is not None:
+            try:
+                image_bytes = decode_base64_image(encoded)
+            except ValueError as e:
+                results[i] = {**result, 'success': False, 'error': str(e)}
+                continue
+        
+        item_fingerprint = fingerprint(image_bytes) if image_bytes is not None else item.get('fingerprint')
+        previous = stored.get(item_id)
+        if previous is not None and previous['fingerprint'] == item_fingerprint:
+            results[i] = {**result, 'fingerprint': item_fingerprint, 'success': True, 'detection': previous['result']}
+        elif image_bytes is None:
+            results[i] = {
+                **result,
+                'success': False,
+                'error': 'Item is new or changed; send its image',
+                'image_required': True
+            }
+        else:
+            changed.append((i, item_id, item_fingerprint, image_bytes))
+    
+    if changed:
+        # Only inference waits for (or is refused) a slot; fully unchanged closets never do
+        inference_gate.acquire()
+        try:
+            analyzed = analyze_uploads(((image_bytes, None) for *_, image_bytes in changed), timer)
+        finally:
+            inference_gate.release()
+        for (i, item_id, item_fingerprint, _), result in zip(changed, analyzed):
+            if result['success'] and is_settled(result['detection']):
+                closet_store.save(closet_id, item_id, item_fingerprint, config, result['detection'])
+            results[i] = {**result, 'index': i, 'id': item_id, 'fingerprint': item_fingerprint, 'recomputed': True}
+    
+    return timed_response({
+        'success': True,
+        'closet_id': closet_id,
+        'results': results,
+        'recomputed': [item_id for _, item_id, _, _ in changed],
+        'reused': sum(1 for result in results if result['success'] and not result['recomputed'])
+    }, timer)
+
+@app.route('/analyze-closet', methods=['POST'])
+def analyze_closet():
+    """Analyze multiple clothing items from closet.
+    
+    JSON with "closet_id" and "items" is analyzed incrementally (see
+    analyze_closet_items); other uploads analyze every image.
+    """
+    timer = StageTimer()
+    try:
+        body = request.get_json(silent=True) if request.is_json else None
+        if isinstance(body, dict) and 'items' in body:
+            return analyze_closet_items(body, timer)
+        
+        images = uploaded_images()
+        if images is None:
+            return negotiated_response({'error': 'No images provided'}, 400)
+        
+        inference_gate.acquire()
+        try:
+            results = analyze_uploads(images, timer)
+        finally:
+            inference_gate.release()
+        
+        return timed_response({
             'success': True,
             'results': results
-        })
+        }, timer)
+    
+    except (RequestEntityTooLarge, ServerBusy):
+        raise
+    except Exception as e:
+        return negotiated_response({
+            'success': False,
+            'error': str(e)
+        }, 500)
+
+@app.route('/closets/<closet_id>', methods=['DELETE'])
+def forget_closet(closet_id):
+    """Drop the stored results of a closet (the next request analyzes every item)"""
+    return jsonify({'success': True, 'removed': closet_store.remove(closet_id)})
+
+@app.route('/analyze-closet/stream', methods=['POST'])
+def analyze_closet_stream():
+    """Analyze closet images as they are uploaded, streaming one result per image.
+    
+    Accepts multipart/form-data (one image per part) or NDJSON (one base64
+    image per line) and answers with NDJSON lines, Server-Sent Events when
+    the client sends Accept: text/event-stream, or concatenated MessagePack
+    objects when it prefers application/msgpack. Only the image being
+    processed is held in memory.
+    """
+    images = uploaded_images()
+    if images is None:
+        return jsonify({'error': 'Send multipart/form-data or application/x-ndjson'}), 415
+    
+    use_sse = 'text/event-stream' in request.headers.get('Accept', '') or request.args.get('format') == 'sse'
+    use_msgpack = not use_sse and prefers_msgpack(request.accept_mimetypes)
+    
+    def frame(payload, event='result'):
+        if use_sse:
+            return sse_event(payload, event=event)
+        return pack(payload) if use_msgpack else ndjson_line(payload)
+    debug = request.args.get('debug', '0').lower() in ('1', 'true', 'yes')
+    use_cache = use_result_cache()
+    
+    # Hold one inference slot for the whole stream; a full queue still gets a plain 503
+    inference_gate.acquire()
+    
+    def generate():
+        processed = 0
+        failed = 0
+        try:
+            for index, (image_bytes, error) in enumerate(images):
+                timer = StageTimer()
+                if error is None:
+                    try:
+                        with decoded_upload(image_bytes, timer) as (image_array, original_size):
+                            detection = detector.detect_clothing_from_array(
+                                image_array, use_cache=use_cache, timer=timer, original_size=original_size
+                            )
+                    except (ValueError, ServerBusy) as e:
+                        # Bad, oversized or (for now) unaffordable image: report it and keep going
+                        error = str(e)
+                if error is None:
+                    result = {
+                        'index': index,
+                        'success': True,
+                        'detection': detection
+                    }
+                    if debug:
+                        result['timings_ms'] = timer.as_ms()
+                    stage_metrics.observe(timer)
+                    processed += 1
+                else:
+                    result = {
+                        'index': index,
+                        'success': False,
+                        'error': error
+                    }
+                    failed += 1
+                yield frame(result)
+            
+            summary = {'done': True, 'processed': processed, 'failed': failed}
+        except Exception as e:
+            summary = {'done': True, 'processed': processed, 'failed': failed, 'error': str(e)}
+        yield frame(summary, event='done')
+    
+    response = Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream' if use_sse else MSGPACK_MIMETYPE if use_msgpack else 'application/x-ndjson'
+    )
+    response.vary.add('Accept')
+    # Ask proxies (e.g. nginx) to pass each result through immediately
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    # The server closes the response even if the client disconnects mid-stream
+    response.call_on_close(inference_gate.release)
+    return response
+
+def sequence_frames(max_frames: int, frame_step: int, timer: StageTimer):
+    """Iterate (frame, original_size) of the uploaded clip or burst, each held in the memory budget.
+    
+    Takes a raw video/* body or JSON {"video_base64": ...} (decoded frame by
+    frame), or burst photos as a multipart, NDJSON or JSON {"images": [...]}
+    upload. Returns None for unsupported uploads.
+    """
+    video_bytes = None
+    if request.mimetype.startswith('video/'):
+        video_bytes = request.get_data(cache=False)
+    elif request.is_json:
+        body = request.get_json(silent=True)
+        if isinstance(body, dict) and 'video_base64' in body:
+            video_bytes = decode_base64_image(body['video_base64'])
+    
+    if video_bytes is not None:
+        def video_frames():
+            for frame in iter_video_frames(video_bytes, frame_step=frame_step, max_frames=max_frames):
+                with memory_budget.reserve(frame.nbytes):
+                    yield frame, None
+        return video_frames()
+    
+    images = uploaded_images()
+    if images is None:
+        return None
+    
+    def photo_frames():
+        for image_bytes, error in itertools.islice(images, 0, max_frames * frame_step, frame_step):
+            if error is not None:
+                raise ValueError(error)
+            with decoded_upload(image_bytes, timer) as decoded:
+                yield decoded
+    return photo_frames()
+
+@app.route('/analyze-sequence', methods=['POST'])
+@inference_gate.limit
+def analyze_sequence():
+    """Analyze a video clip or photo burst as one sequence of frames.
+    
+    Detections are linked into tracks across frames, and a track that barely
+    changed reuses its previous mask or colors instead of recomputing them.
+    Query parameters: frame_step (analyze every n-th frame) and max_frames.
+    """
+    timer = StageTimer()
+    try:
+        try:
+            frame_step = max(1, int(request.args.get('frame_step', 1)))
+            max_frames = max(1, min(int(request.args.get('max_frames', sequence_max_frames)), sequence_max_frames))
+            frames = sequence_frames(max_frames, frame_step, timer)
+        except ValueError as e:
+            return negotiated_response({'success': False, 'error': str(e)}, 400)
+        if frames is None:
+            return negotiated_response({'error': 'No video or frames provided'}, 400)
+        
+        try:
+            results = SequenceAnalyzer(detector).analyze(frames, timer)
+        except PayloadTooLarge:
+            raise
+        except ValueError as e:
+            results = {
+                'success': False,
+                'error': str(e),
+                'tracks': [],
+                'frames': []
+            }
         
+        return timed_response(results, timer)
+        
+    except (PayloadTooLarge, RequestEntityTooLarge, ServerBusy):
+        raise
     except Exception as e:
-        return jsonify({
+        return negotiated_response({
             'success': False,
             'error': str(e)
-        }), 500
+        }, 500)
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    """Queue a bulk analysis job and return its id immediately.
+    
+    Takes the same uploads as /analyze-closet/stream (or /analyze-closet's
+    JSON body); images are written to the job queue as they arrive.
+    """
+    images = uploaded_images()
+    if images is None:
+        return jsonify({'error': 'Send multipart/form-data, application/x-ndjson or {"images": [...]}'}), 415
+    
+    try:
+        job = job_store.create_job(images, use_cache=use_result_cache())
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    job['status_url'] = f"/jobs/{job['job_id']}"
+    response = jsonify(job)
+    response.status_code = 202
+    response.headers['Location'] = job['status_url']
+    return response
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Job progress plus the results finished so far (?results=0 omits them, ?offset=&limit= pages them)"""
+    try:
+        offset = int(request.args.get('offset', 0))
+        limit = int(request.args['limit']) if 'limit' in request.args else None
+    except ValueError:
+        return jsonify({'error': 'offset and limit must be integers'}), 400
+    
+    job = job_store.get_job(
+        job_id,
+        include_results=request.args.get('results', '1').lower() not in ('0', 'false', 'no'),
+        offset=offset,
+        limit=limit
+    )
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return negotiated_response(job)
+
+def analyzed_detections():
+    """Detections sent as JSON {"detections": [...]}, else analyzed from the uploaded image.
+    
+    Returns (detections, error_response).
+    """
+    body = request.get_json(silent=True)
+    if isinstance(body, dict) and isinstance(body.get('detections'), list):
+        return body['detections'], None
+    if isinstance(body, dict) and isinstance(body.get('colors'), list):
+        return [{'colors': body['colors'], 'clothing_type': body.get('clothing_type')}], None
+    
+    try:
+        image_bytes = uploaded_image()
+    except ValueError as e:
+        return None, negotiated_response({'success': False, 'error': str(e)}, 400)
+    if image_bytes is None:
+        return None, negotiated_response({'error': 'No image, colors or detections provided'}, 400)
+    
+    inference_gate.acquire()
+    try:
+        with decoded_upload(image_bytes, StageTimer()) as (image_array, original_size):
+            results = detector.detect_clothing_from_array(image_array, use_cache=use_result_cache(),
+                                                          original_size=original_size)
+    except PayloadTooLarge:
+        raise
+    except ValueError as e:
+        results = {'success': False, 'error': str(e), 'detections': []}
+    finally:
+        inference_gate.release()
+    if not results['success']:
+        return None, negotiated_response(results, 422)
+    return results['detections'], None
+
+@app.route('/wardrobe/<user_id>/items/<item_id>', methods=['PUT', 'POST'])
+def index_wardrobe_item(user_id, item_id):
+    """Add or replace a closet item in the wardrobe index.
+    
+    Takes an image upload (analyzed here), a /detect-clothing result's
+    {"detections": [...]}, or a single palette {"colors": [...]}.
+    """
+    detections, error = analyzed_detections()
+    if error is not None:
+        return error
+    try:
+        indexed = wardrobe_index.add_detections(user_id, item_id, detections)
+    except (KeyError, TypeError, ValueError) as e:
+        return negotiated_response({'success': False, 'error': f'Invalid detections: {e}'}, 400)
+    return negotiated_response({
+        'success': True,
+        'item_id': item_id,
+        'indexed': indexed,
+        'items': wardrobe_index.get(user_id, item_id)
+    })
+
+@app.route('/wardrobe/<user_id>/items/<item_id>', methods=['DELETE'])
+def remove_wardrobe_item(user_id, item_id):
+    if not wardrobe_index.remove(user_id, item_id):
+        return jsonify({'error': 'Item not found'}), 404
+    return jsonify({'success': True, 'item_id': item_id})
+
+def match_options():
+    """(k, mode, clothing_type) from the query string"""
+    k = int(request.args.get('k', 5))
+    mode = request.args.get('mode', 'similar')
+    if mode not in QUERY_MODES:
+        raise ValueError(f"mode must be one of {', '.join(QUERY_MODES)}")
+    return max(0, min(k, 100)), mode, request.args.get('clothing_type') or None
+
+@app.route('/wardrobe/<user_id>/items/<item_id>/matches', methods=['GET'])
+def match_wardrobe_item(user_id, item_id):
+    """Items of the same closet that match an indexed item (?k=5&mode=similar|complementary&clothing_type=)"""
+    try:
+        k, mode, clothing_type = match_options()
+        detection = int(request.args.get('detection', 0))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    items = [item for item in wardrobe_index.get(user_id, item_id) if item['detection'] == detection]
+    if not items:
+        return jsonify({'error': 'Item not found'}), 404
+    matches = wardrobe_index.query(user_id, items[0]['colors'], k=k, mode=mode,
+                                   clothing_type=clothing_type, exclude_item=item_id)
+    return negotiated_response({'success': True, 'item_id': item_id, 'mode': mode, 'matches': matches})
+
+@app.route('/wardrobe/<user_id>/matches', methods=['POST'])
+def match_wardrobe(user_id):
+    """Closet items matching a new photo or palette, without indexing it"""
+    try:
+        k, mode, clothing_type = match_options()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    detections, error = analyzed_detections()
+    if error is not None:
+        return error
+    
+    try:
+        entries = colored_detections(detections)
+    except (KeyError, TypeError, ValueError) as e:
+        return negotiated_response({'success': False, 'error': f'Invalid detections: {e}'}, 400)
+    
+    results = [
+        {
+            'detection': number,
+            'clothing_type': detection.get('clothing_type'),
+            'matches': wardrobe_index.query(user_id, detection['colors'], k=k, mode=mode,
+                                            clothing_type=clothing_type)
+        }
+        for number, detection, _ in entries
+    ]
+    return negotiated_response({'success': True, 'mode': mode, 'results': results})
 
 @app.route('/test', methods=['GET'])
+@inference_gate.limit
 def test_detection():
     """Test endpoint to verify the detector is working"""
     try:
         # Create a simple test image (red rectangle)
         test_image = np.zeros((300, 300, 3), dtype=np.uint8)
-        test_image[:, :, 0] = 255  # Red channel
+        test_image[:, :, 2] = 255  # Red channel (arrays are BGR)
         
         results = detector.detect_clothing_from_array(test_image)
         
@@ -142,5 +778,7 @@ def test_detection():
         }), 500
 
 if __name__ == '__main__':
+    # Development server only; production runs gunicorn -c gunicorn.conf.py app:app
     port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port, debug=True) 
\ No newline at end of file
+    debug = os.environ.get('FLASK_DEBUG', '0') == '1'
+    app.run(host='0.0.0.0', port=port, debug=debug, use_reloader=False) 
\ No newline at end of file
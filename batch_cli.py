@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+"""
+Offline batch analysis of image directories and manifests
+
+Walks a directory (or reads a manifest of paths) and analyzes every image
+without the web app. The models are loaded once and worker processes are
+forked afterwards, sharing them copy-on-write. Each worker reads and
+decodes the next batches on a small thread pool while the current batch
+runs through detect_batch. Results are written in chunks of JSONL (or
+Parquet, with pyarrow installed), and a checkpoint file records every
+finished chunk, so an interrupted run picks up where it stopped.
+
+Examples:
+    python batch_cli.py catalog/ --output results/ --processes 4
+    python batch_cli.py --manifest images.txt --output results/ --format parquet
+    python batch_cli.py catalog/ --output results/          # resumes from results/checkpoint.jsonl
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, FrozenSet, Iterator, List, Set, Tuple
+
+from clothing_detector import ClothingDetector
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.tif', '.tiff', '.gif')
+OUTPUT_FORMATS = ('jsonl', 'parquet')
+
+
+def iter_directory(root: str) -> Iterator[Tuple[str, str]]:
+    """(item id, path) of every image under ``root`` in a stable order; the id is the relative path"""
+    for directory, subdirectories, files in os.walk(root):
+        subdirectories.sort()
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                path = os.path.join(directory, name)
+                yield os.path.relpath(path, root), path
+
+
+def iter_manifest(manifest: str) -> Iterator[Tuple[str, str]]:
+    """(item id, path) of every line of a manifest.
+
+    A line is either a path or a JSON object {"path": ..., "id": ...} (the
+    id defaults to the path). Relative paths are relative to the manifest.
+    """
+    base = os.path.dirname(os.path.abspath(manifest))
+    with open(manifest) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('{'):
+                entry = json.loads(line)
+                path, item_id = entry['path'], str(entry.get('id', entry['path']))
+            else:
+                path = item_id = line
+            yield item_id, os.path.join(base, path)
+
+
+class Checkpoint:
+    """Append-only record of written chunks: one JSON line {"chunk": file, "ids": [...]} per chunk.
+
+    A chunk counts as done only once its line is here, so chunk files left
+    behind by a crash before their line was written are removed on resume
+    and their images analyzed again.
+    """
+
+    def __init__(self, output_dir: str, path: str = None):
+        self.output_dir = output_dir
+        self.path = path or os.path.join(output_dir, 'checkpoint.jsonl')
+        self.done: Set[str] = set()
+        self.chunks: List[str] = []
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Torn last line of an interrupted append
+                        continue
+                    self.chunks.append(entry['chunk'])
+                    self.done.update(entry['ids'])
+
+    def remove_orphans(self) -> List[str]:
+        """Delete chunk files the checkpoint doesn't list"""
+        listed = set(self.chunks)
+        orphans = [name for name in os.listdir(self.output_dir)
+                   if name.startswith('part-') and name not in listed]
+        for name in orphans:
+            os.unlink(os.path.join(self.output_dir, name))
+        return orphans
+
+    def record(self, chunk: str, ids: List[str]):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps({'chunk': chunk, 'ids': ids}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.chunks.append(chunk)
+        self.done.update(ids)
+
+
+class ChunkWriter:
+    """Writes result records as numbered part files and checkpoints each one"""
+
+    def __init__(self, output_dir: str, checkpoint: Checkpoint, output_format: str = 'jsonl',
+                 chunk_size: int = 10000):
+        self.output_dir = output_dir
+        self.checkpoint = checkpoint
+        self.output_format = output_format
+        self.chunk_size = chunk_size
+        self.buffer: List[Dict[str, Any]] = []
+        self._next = len(checkpoint.chunks)
+
+    def add(self, record: Dict[str, Any]):
+        self.buffer.append(record)
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        name = f"part-{self._next:05d}.{self.output_format}"
+        path = os.path.join(self.output_dir, name)
+        # Write under a temporary name so a chunk file is always complete
+        partial = path + '.partial'
+        if self.output_format == 'parquet':
+            # Fixed columns; detections stay nested JSON
+            rows = [
+                {
+                    'id': record['id'],
+                    'path': record['path'],
+                    'success': bool(record.get('success')),
+                    'error': record.get('error'),
+                    'detections': json.dumps(record.get('detections', []))
+                }
+                for record in self.buffer
+            ]
+            pyarrow.parquet.write_table(pyarrow.Table.from_pylist(rows), partial)
+        else:
+            with open(partial, 'w') as f:
+                for record in self.buffer:
+                    f.write(json.dumps(record) + '\n')
+        os.replace(partial, path)
+        self.checkpoint.record(name, [record['id'] for record in self.buffer])
+        self._next += 1
+        self.buffer = []
+
+
+class BatchRunner:
+    """Analyze (item id, path) pairs with forked worker processes sharing one loaded detector.
+
+    Batches of ``batch_size`` paths are handed to ``processes`` workers;
+    each decodes up to ``prefetch`` batches ahead on ``readers`` threads.
+    """
+
+    def __init__(self, detector: ClothingDetector, writer: ChunkWriter, processes: int = 2, batch_size: int = 8,
+                 readers: int = 4, prefetch: int = 2, report_interval: float = 10.0):
+        self.detector = detector
+        self.writer = writer
+        self.processes = processes
+        self.batch_size = batch_size
+        self.readers = readers
+        self.prefetch = prefetch
+        self.report_interval = report_interval
+        self._context = multiprocessing.get_context('fork')
+        self._stop = threading.Event()
+
+    def run(self, items: Iterator[Tuple[str, str]], skip: Set[str]) -> Dict[str, Any]:
+        """Analyze every item not in ``skip`` until done or SIGINT/SIGTERM; returns counts and throughput"""
+        tasks = self._context.Queue(maxsize=self.processes * (self.prefetch + 1))
+        results = self._context.Queue()
+        workers = [
+            self._context.Process(target=self._work, args=(slot, tasks, results), name=f"batch-worker-{slot}",
+                                  daemon=True)
+            for slot in range(self.processes)
+        ]
+        for process in workers:
+            process.start()
+
+        # The checkpoint's set keeps growing as chunks are written; the feeder gets a frozen copy
+        self._skipped = 0
+        feeder = threading.Thread(target=self._feed, args=(items, frozenset(skip), tasks), daemon=True)
+        feeder.start()
+        signal.signal(signal.SIGTERM, lambda *_: self._stop.set())
+        signal.signal(signal.SIGINT, lambda *_: self._stop.set())
+
+        counts = {'analyzed': 0, 'failed': 0}
+        start = last_report = time.perf_counter()
+        last_count = 0
+        finished = 0
+        while finished < self.processes and not self._stop.is_set():
+            try:
+                message = results.get(timeout=1.0)
+            except queue.Empty:
+                if not any(process.is_alive() for process in workers):
+                    print("❌ All batch workers exited")
+                    break
+                continue
+
+            if message is None:
+                finished += 1
+                continue
+            for record in message:
+                counts['analyzed'] += 1
+                counts['failed'] += not record.get('success', False)
+                self.writer.add(record)
+
+            now = time.perf_counter()
+            if now - last_report >= self.report_interval:
+                recent = (counts['analyzed'] - last_count) / (now - last_report)
+                print(f"📈 {counts['analyzed']} images ({counts['failed']} failed), "
+                      f"{counts['analyzed'] / (now - start):.1f} images/s overall, {recent:.1f} images/s recent")
+                last_report, last_count = now, counts['analyzed']
+
+        if self._stop.is_set():
+            print("🛑 Interrupted, writing finished results...")
+        # Whatever was analyzed is kept: the last, partial chunk is checkpointed too
+        self.writer.flush()
+        for process in workers:
+            process.terminate()
+        for process in workers:
+            process.join(timeout=60)
+
+        elapsed = time.perf_counter() - start
+        counts['seconds'] = round(elapsed, 2)
+        counts['images_per_second'] = round(counts['analyzed'] / elapsed, 2) if elapsed > 0 else 0.0
+        counts['skipped'] = self._skipped
+        counts['complete'] = finished == self.processes
+        return counts
+
+    def _feed(self, items: Iterator[Tuple[str, str]], skip: FrozenSet[str], tasks):
+        """Queue batches of unfinished items, then one end marker per worker; counts skipped inputs"""
+        batch = []
+        for item_id, path in items:
+            if self._stop.is_set():
+                return
+            if item_id in skip:
+                self._skipped += 1
+                continue
+            batch.append((item_id, path))
+            if len(batch) >= self.batch_size:
+                tasks.put(batch)
+                batch = []
+        if batch:
+            tasks.put(batch)
+        for _ in range(self.processes):
+            tasks.put(None)
+
+    def _work(self, slot: int, tasks, results):
+        """Worker process: decode upcoming batches on reader threads while analyzing the current one"""
+        import torch
+        from serving import available_cpus
+
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        torch.set_num_threads(max(1, available_cpus() // self.processes))
+
+        reader = ThreadPoolExecutor(max_workers=self.readers, thread_name_prefix='reader')
+        pending = deque()
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) <= self.prefetch:
+                batch = tasks.get()
+                if batch is None:
+                    exhausted = True
+                    break
+                pending.append((batch, [reader.submit(self._load, path) for _, path in batch]))
+            if not pending:
+                break
+
+            batch, loads = pending.popleft()
+            results.put(self._analyze(batch, [load.result() for load in loads]))
+        results.put(None)
+
+    def _load(self, path: str):
+        """Read and decode one image: (image_array, original_size, error)"""
+        try:
+            with open(path, 'rb') as f:
+                image_bytes = f.read()
+            image_array, original_size = self.detector.decode_for_analysis(image_bytes)
+            return image_array, original_size, None
+        except Exception as e:
+            # Any unreadable or undecodable file becomes a failed record, not a dead worker
+            return None, None, str(e)
+
+    def _analyze(self, batch: List[Tuple[str, str]], loaded: List[tuple]) -> List[Dict[str, Any]]:
+        records = [{'id': item_id, 'path': path} for item_id, path in batch]
+        positions = []
+        for i, (image_array, original_size, error) in enumerate(loaded):
+            if error is not None:
+                records[i].update({'success': False, 'error': error, 'detections': []})
+            else:
+                positions.append(i)
+
+        if positions:
+            try:
+                detections = self.detector.detect_batch(
+                    [loaded[i][0] for i in positions], use_cache=False,
+                    original_sizes=[loaded[i][1] for i in positions]
+                )
+            except Exception as e:
+                detections = [{'success': False, 'error': str(e), 'detections': []}] * len(positions)
+            for i, detection in zip(positions, detections):
+                records[i].update(detection)
+        return records
+
+
+def build_detector(args) -> ClothingDetector:
+    options = {
+        'max_image_side': args.max_image_side,
+        'max_detect_side': args.max_detect_side,
+        'segmentation': args.segmentation,
+        # Processes already use every core; keep each one's crop work on its own thread
+        'crop_workers': 1
+    }
+    if args.stub_models:
+        from benchmark import StubYOLO
+        return ClothingDetector(yolo_model=StubYOLO(), yolo_weights='stub', sam_checkpoint=None, **options)
+    return ClothingDetector(garment_weights=os.environ.get('GARMENT_WEIGHTS') or None, **options)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Analyze a directory or manifest of images offline')
+    parser.add_argument('directory', nargs='?', help='Directory walked recursively for images')
+    parser.add_argument('--manifest', help='File with one image path (or {"path", "id"} JSON) per line')
+    parser.add_argument('--output', required=True, help='Directory for result chunks and the checkpoint')
+    parser.add_argument('--format', default='jsonl', choices=OUTPUT_FORMATS, help='Result chunk format')
+    parser.add_argument('--chunk-size', type=int, default=10000, help='Results per output chunk')
+    parser.add_argument('--checkpoint', help='Checkpoint file (default: OUTPUT/checkpoint.jsonl)')
+    parser.add_argument('--processes', type=int, default=2, help='Worker processes sharing the loaded models')
+    parser.add_argument('--batch-size', type=int, default=8, help='Images per detect_batch call')
+    parser.add_argument('--readers', type=int, default=4, help='Threads reading and decoding images per worker')
+    parser.add_argument('--prefetch', type=int, default=2, help='Batches each worker decodes ahead')
+    parser.add_argument('--report-interval', type=float, default=10.0, help='Seconds between progress lines')
+    parser.add_argument('--max-image-side', type=int, default=1024,
+                        help='Working resolution bound (0 = analyze at full resolution)')
+    parser.add_argument('--max-detect-side', type=int, default=640,
+                        help='YOLO input resolution bound (0 = detect at working resolution)')
+    parser.add_argument('--segmentation', default='auto', choices=ClothingDetector.SEGMENTATION_METHODS,
+                        help='How detections are masked before color extraction')
+    parser.add_argument('--stub-models', action='store_true',
+                        help='Use a stub YOLO and no SAM (no weights needed)')
+    args = parser.parse_args()
+
+    if bool(args.directory) == bool(args.manifest):
+        parser.error('give either a directory or --manifest')
+    if args.format == 'parquet' and pyarrow is None:
+        parser.error('--format parquet needs pyarrow (pip install pyarrow)')
+
+    os.makedirs(args.output, exist_ok=True)
+    checkpoint = Checkpoint(args.output, args.checkpoint)
+    orphans = checkpoint.remove_orphans()
+    if checkpoint.done:
+        print(f"♻️ Resuming: {len(checkpoint.done)} images in {len(checkpoint.chunks)} chunks already done")
+    if orphans:
+        print(f"🧹 Removed {len(orphans)} chunk files missing from the checkpoint")
+
+    items = iter_manifest(args.manifest) if args.manifest else iter_directory(args.directory)
+    # Models load here, once; forked workers share them
+    detector = build_detector(args)
+    writer = ChunkWriter(args.output, checkpoint, args.format, args.chunk_size)
+    runner = BatchRunner(detector, writer, processes=args.processes, batch_size=args.batch_size,
+                         readers=args.readers, prefetch=args.prefetch, report_interval=args.report_interval)
+
+    print(f"🚀 Analyzing with {args.processes} workers into {args.output}")
+    summary = runner.run(items, checkpoint.done)
+    print(f"{'✅' if summary['complete'] else '⏸️'} {summary['analyzed']} images "
+          f"({summary['failed']} failed, {summary['skipped']} skipped) in {summary['seconds']}s, "
+          f"{summary['images_per_second']} images/s")
+    if not summary['complete']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
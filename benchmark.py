@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+"""
+Reproducible benchmark suite for the clothing detection pipeline
+
+Generates deterministic synthetic workloads (resolution x people x colors),
+times every ClothingDetector stage and the full detect_clothing_from_array
+call with warmup + repeated iterations, and writes JSON results that can be
+compared across commits.
+
+Examples:
+    python benchmark.py --stub-models --output bench_stub.json
+    python benchmark.py --resolutions 640x480,4032x3024 --people 1,4 --iterations 20
+    python benchmark.py --compare bench_before.json bench_after.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Tuple
+
+import cv2
+import numpy as np
+
+from clothing_detector import ClothingDetector
+import segmentation
+
+
+class _StubArray(np.ndarray):
+    """NumPy array with the .cpu()/.numpy() calls the detector uses on torch tensors"""
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return np.asarray(self)
+
+
+def _stub_array(values, dtype=np.float32) -> _StubArray:
+    return np.asarray(values, dtype=dtype).view(_StubArray)
+
+
+class _StubBoxes:
+    """Minimal stand-in for ultralytics' Boxes (iterable, tensor attributes)"""
+
+    def __init__(self, xyxy: np.ndarray, cls: np.ndarray, conf: np.ndarray):
+        self.xyxy = _stub_array(xyxy.reshape(-1, 4))
+        self.cls = _stub_array(cls)
+        self.conf = _stub_array(conf)
+
+    def __len__(self):
+        return len(self.cls)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield _StubBoxes(self.xyxy[i:i + 1], self.cls[i:i + 1], self.conf[i:i + 1])
+
+
+class _StubResult:
+    def __init__(self, boxes: _StubBoxes, names: Dict[int, str]):
+        self.boxes = boxes
+        self.names = names
+
+
+class StubYOLO:
+    """Offline stand-in for YOLO that 'detects' the people drawn by make_workload.
+
+    Foreground is everything that differs clearly from the background color
+    in the image corner; each large connected region becomes a person box.
+    """
+
+    names = {0: 'person'}
+
+    def predict(self, source, **kwargs):
+        images = source if isinstance(source, list) else [source]
+        return [self._detect(image) for image in images]
+
+    def _detect(self, image: np.ndarray) -> _StubResult:
+        background = image[0, 0].astype(np.int16)
+        foreground = (np.abs(image.astype(np.int16) - background).max(axis=2) > 40).astype(np.uint8)
+        count, _, stats, _ = cv2.connectedComponentsWithStats(foreground, connectivity=8)
+
+        min_area = 0.002 * image.shape[0] * image.shape[1]
+        boxes = [
+            [x, y, x + w, y + h]
+            for x, y, w, h, area in stats[1:count]
+            if area >= min_area
+        ]
+        xyxy = np.array(boxes, dtype=np.float32).reshape(-1, 4)
+        return _StubResult(
+            _StubBoxes(xyxy, np.zeros(len(xyxy)), np.full(len(xyxy), 0.9)),
+            self.names
+        )
+
+
+def make_workload(width: int, height: int, people: int, colors: int, seed: int = 0) -> np.ndarray:
+    """Deterministic BGR image with `people` figures, each made of `colors` color bands"""
+    rng = np.random.default_rng(seed)
+    image = np.empty((height, width, 3), dtype=np.int16)
+    image[:] = (128, 128, 128)
+
+    slot_width = width // max(people, 1)
+    for person in range(people):
+        x1 = person * slot_width + slot_width // 6
+        x2 = (person + 1) * slot_width - slot_width // 6
+        y1 = height // 8
+        y2 = height - height // 16
+        bands = np.linspace(y1, y2, colors + 1).astype(int)
+        for band in range(colors):
+            # Keep colors well away from the gray background
+            color = rng.integers(0, 256, size=3)
+            while np.abs(color - 128).max() < 80:
+                color = rng.integers(0, 256, size=3)
+            image[bands[band]:bands[band + 1], x1:x2] = color
+
+    # Mild sensor noise so clustering has real work to do
+    image += rng.integers(-8, 9, size=image.shape, dtype=np.int16)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process so far"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def time_call(func: Callable[[], Any], warmup: int, iterations: int) -> Dict[str, float]:
+    """Run func warmup + iterations times and summarize the timed runs"""
+    for _ in range(warmup):
+        func()
+
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+
+    latencies_ms = np.array(latencies) * 1000.0
+    mean_ms = float(latencies_ms.mean())
+    return {
+        'iterations': iterations,
+        'mean_ms': mean_ms,
+        'p50_ms': float(np.percentile(latencies_ms, 50)),
+        'p95_ms': float(np.percentile(latencies_ms, 95)),
+        'p99_ms': float(np.percentile(latencies_ms, 99)),
+        'min_ms': float(latencies_ms.min()),
+        'max_ms': float(latencies_ms.max()),
+        'throughput_per_s': 1000.0 / mean_ms if mean_ms > 0 else float('inf')
+    }
+
+
+def benchmark_workload(detector: ClothingDetector, image_bgr: np.ndarray,
+                       warmup: int, iterations: int) -> Dict[str, Dict[str, float]]:
+    """Time each pipeline stage in isolation, then the full pipeline"""
+    ok, encoded = cv2.imencode('.jpg', image_bgr, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    if not ok:
+        raise RuntimeError('Could not encode workload image')
+    encoded = encoded.tobytes()
+
+    # Stages see the same bounded images the pipeline works on
+    image = cv2.cvtColor(detector.bound_size(image_bgr, detector.max_image_side), cv2.COLOR_BGR2RGB)
+    detect_image = detector.bound_size(image, detector.max_detect_side)
+    boxes = detector._rescale_boxes(detector.detect_clothing(detect_image), detect_image, image)
+    crops = detector.crop_regions(image, boxes)
+    masks = detector.get_box_masks(image, boxes)
+    colors = [detector.get_color_percentages(crop, mask) for crop, mask in zip(crops, masks)]
+    centers = [rgb for crop_colors in colors for rgb, _ in crop_colors]
+
+    stages = {
+        'decode': lambda: detector.decode_for_analysis(encoded),
+        'resize': lambda: detector.bound_size(
+            detector.bound_size(image_bgr, detector.max_image_side), detector.max_detect_side
+        ),
+        'yolo': lambda: detector.detect_clothing(detect_image),
+        'crop': lambda: detector.crop_regions(image, boxes),
+        'sam': lambda: detector.get_box_masks(image, boxes),
+        'color': lambda: [detector.get_color_percentages(crop, mask) for crop, mask in zip(crops, masks)],
+        'naming': lambda: detector.closest_color_names(centers),
+        'full_pipeline': lambda: detector.detect_clothing_from_array(image_bgr, use_cache=False)
+    }
+
+    results = {}
+    for name, func in stages.items():
+        results[name] = time_call(func, warmup, iterations)
+    results['detections'] = {'count': int(len(crops))}
+    return results
+
+
+def benchmark_segmentation(detector: ClothingDetector, image_bgr: np.ndarray,
+                           warmup: int, iterations: int, padding: float = 0.15) -> Dict[str, Dict[str, float]]:
+    """Time each segmentation method and score its masks.
+
+    Stub boxes fit the drawn figures exactly, so they are padded by
+    ``padding`` to leave background inside them, as real detector boxes
+    do. Masks are scored by IoU against the drawn foreground and, when SAM
+    is loaded, against SAM's masks.
+    """
+    image = cv2.cvtColor(detector.bound_size(image_bgr, detector.max_image_side), cv2.COLOR_BGR2RGB)
+    detect_image = detector.bound_size(image, detector.max_detect_side)
+    boxes = detector._rescale_boxes(detector.detect_clothing(detect_image), detect_image, image)
+    pad = np.stack([boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1]] * 2, axis=1) * padding
+    regions = detector._clip_boxes(image, boxes + pad * np.array([-1, -1, 1, 1]))
+    # The workload background is uniform gray
+    foreground = np.abs(image.astype(np.int16) - 128).max(axis=2) > 40
+    truth = [foreground[y1:y2, x1:x2] for x1, y1, x2, y2 in regions]
+
+    methods = {
+        'box': lambda: segmentation.box_masks(regions),
+        'grabcut': lambda: segmentation.grabcut_masks(image, regions)
+    }
+    if detector.sam_predictor is not None:
+        methods['sam'] = lambda: detector._sam_masks(image, regions)
+
+    sam_masks = methods['sam']() if 'sam' in methods else None
+    results = {}
+    for name, func in methods.items():
+        masks = func()
+        results[name] = time_call(func, warmup, iterations)
+        results[name]['iou_vs_truth'] = float(np.mean([
+            segmentation.mask_iou(mask, expected) for mask, expected in zip(masks, truth)
+        ])) if regions else None
+        if sam_masks is not None:
+            results[name]['iou_vs_sam'] = float(np.mean([
+                segmentation.mask_iou(mask, expected) for mask, expected in zip(masks, sam_masks)
+            ])) if regions else None
+    return results
+
+
+def parse_resolutions(value: str) -> List[Tuple[int, int]]:
+    resolutions = []
+    for item in value.split(','):
+        width, height = item.lower().split('x')
+        resolutions.append((int(width), int(height)))
+    return resolutions
+
+
+def parse_ints(value: str) -> List[int]:
+    return [int(item) for item in value.split(',')]
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def build_detector(args) -> ClothingDetector:
+    options = {
+        'color_backend': args.color_backend,
+        'max_image_side': args.max_image_side,
+        'max_detect_side': args.max_detect_side,
+        'crop_workers': args.crop_workers,
+        'segmentation': args.segmentation
+    }
+    if args.stub_models:
+        return ClothingDetector(yolo_model=StubYOLO(), yolo_weights='stub', sam_checkpoint=None, **options)
+    return ClothingDetector(**options)
+
+
+def run(args) -> Dict[str, Any]:
+    detector = build_detector(args)
+
+    results = []
+    for width, height in parse_resolutions(args.resolutions):
+        for people in parse_ints(args.people):
+            for colors in parse_ints(args.colors):
+                name = f"{width}x{height}_p{people}_c{colors}"
+                print(f"⏱️  {name}")
+                image = make_workload(width, height, people, colors, seed=args.seed)
+                stages = benchmark_workload(detector, image, args.warmup, args.iterations)
+                full = stages['full_pipeline']
+                print(f"   full pipeline p50 {full['p50_ms']:.1f} ms, "
+                      f"p95 {full['p95_ms']:.1f} ms, {full['throughput_per_s']:.2f} img/s")
+                masks = benchmark_segmentation(detector, image, args.warmup, args.iterations)
+                for method, summary in masks.items():
+                    iou = summary['iou_vs_truth']
+                    print(f"   {method:8s} masks p50 {summary['p50_ms']:.1f} ms, IoU "
+                          f"{'n/a' if iou is None else f'{iou:.3f}'}")
+                results.append({
+                    'workload': {
+                        'name': name,
+                        'width': width,
+                        'height': height,
+                        'people': people,
+                        'colors': colors,
+                        'seed': args.seed
+                    },
+                    'stages': stages,
+                    'segmentation': masks,
+                    'peak_rss_mb': peak_rss_mb()
+                })
+
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'stub_models': args.stub_models,
+            'sam_loaded': detector.sam_predictor is not None,
+            'color_backend': args.color_backend,
+            'max_image_side': args.max_image_side,
+            'max_detect_side': args.max_detect_side,
+            'crop_workers': args.crop_workers,
+            'segmentation': detector.segmentation_method,
+            'warmup': args.warmup,
+            'iterations': args.iterations
+        },
+        'results': results,
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+def compare(before_path: str, after_path: str):
+    """Print per-workload, per-stage p50 changes between two result files"""
+    with open(before_path) as f:
+        before = {r['workload']['name']: r for r in json.load(f)['results']}
+    with open(after_path) as f:
+        after = json.load(f)['results']
+
+    for result in after:
+        name = result['workload']['name']
+        if name not in before:
+            continue
+        print(f"📊 {name}")
+        for stage, summary in result['stages'].items():
+            old = before[name]['stages'].get(stage, {})
+            if 'p50_ms' not in summary or 'p50_ms' not in old:
+                continue
+            change = (summary['p50_ms'] - old['p50_ms']) / old['p50_ms'] * 100 if old['p50_ms'] else 0.0
+            print(f"   {stage:14s} {old['p50_ms']:9.2f} ms -> {summary['p50_ms']:9.2f} ms ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the clothing detection pipeline')
+    parser.add_argument('--resolutions', default='640x480,1920x1080,4032x3024',
+                        help='Comma-separated WIDTHxHEIGHT list')
+    parser.add_argument('--people', default='1,4', help='Comma-separated people counts')
+    parser.add_argument('--colors', default='3', help='Comma-separated color counts per person')
+    parser.add_argument('--warmup', type=int, default=2, help='Untimed warmup runs per stage')
+    parser.add_argument('--iterations', type=int, default=10, help='Timed runs per stage')
+    parser.add_argument('--seed', type=int, default=0, help='Workload generator seed')
+    parser.add_argument('--color-backend', default='seeded', help='ClothingDetector color backend')
+    parser.add_argument('--max-image-side', type=int, default=1024,
+                        help='Working resolution bound (0 = analyze at full resolution)')
+    parser.add_argument('--max-detect-side', type=int, default=640,
+                        help='YOLO input resolution bound (0 = detect at working resolution)')
+    parser.add_argument('--crop-workers', type=int, default=None,
+                        help='Threads coloring the detections of one image (default: CPU share)')
+    parser.add_argument('--segmentation', default='auto', choices=ClothingDetector.SEGMENTATION_METHODS,
+                        help='Segmentation used by the pipeline stages (every method is also compared separately)')
+    parser.add_argument('--stub-models', action='store_true',
+                        help='Use a stub YOLO and no SAM (no weights needed)')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON output path')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='Compare two result files instead of running')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    report = run(args)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"✅ Results written to {args.output} (peak RSS {report['peak_rss_mb']:.0f} MB)")
+
+
+if __name__ == '__main__':
+    main()
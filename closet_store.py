@@ -0,0 +1,102 @@
+"""
+Stored closet results for incremental /analyze-closet requests
+
+Each closet item is remembered by (closet_id, item_id) with the content
+fingerprint of the image it was analyzed from and the detector
+configuration that analyzed it. A request whose item still has the same
+fingerprint gets the stored result back without sending or analyzing the
+image again, so only new and changed items cost inference.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, Optional
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS closet_items (
+    closet_id TEXT NOT NULL,
+    item_id TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    config TEXT NOT NULL,
+    result TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (closet_id, item_id)
+);
+"""
+
+
+def fingerprint(image_bytes: bytes) -> str:
+    """Content fingerprint of an uploaded image: hex SHA-256 of its bytes"""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def config_digest(config: str) -> str:
+    """Short digest of ClothingDetector.cache_config(); results from another config are stale"""
+    return hashlib.blake2b(config.encode('utf-8'), digest_size=12).hexdigest()
+
+
+class ClosetStore:
+    """Last analysis of every closet item; safe to share between threads and processes"""
+
+    def __init__(self, path: str = 'closets.db'):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        if getattr(self._local, 'pid', None) != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute('PRAGMA journal_mode=WAL')
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return self._local.db
+
+    def lookup(self, closet_id: str, item_ids: Iterable[str], config: str) -> Dict[str, Dict[str, Any]]:
+        """Stored {'fingerprint', 'result'} per item id, for items analyzed with ``config``"""
+        item_ids = list(item_ids)
+        if not item_ids:
+            return {}
+        digest = config_digest(config)
+        stored = {}
+        db = self._connect()
+        # Stay well below SQLite's bound-parameter limit
+        for start in range(0, len(item_ids), 500):
+            chunk = item_ids[start:start + 500]
+            rows = db.execute(
+                f"SELECT item_id, fingerprint, result FROM closet_items "
+                f"WHERE closet_id = ? AND config = ? AND item_id IN ({', '.join('?' * len(chunk))})",
+                [closet_id, digest] + chunk
+            )
+            for row in rows:
+                stored[row['item_id']] = {'fingerprint': row['fingerprint'], 'result': json.loads(row['result'])}
+        return stored
+
+    def save(self, closet_id: str, item_id: str, item_fingerprint: str, config: str, result: Dict[str, Any]):
+        """Remember the result of an item's latest analysis"""
+        self._connect().execute(
+            'INSERT OR REPLACE INTO closet_items (closet_id, item_id, fingerprint, config, result, updated) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (closet_id, item_id, item_fingerprint, config_digest(config), json.dumps(result), time.time())
+        )
+
+    def remove(self, closet_id: str, item_id: Optional[str] = None) -> int:
+        """Forget one item, or a whole closet when ``item_id`` is None"""
+        db = self._connect()
+        if item_id is None:
+            return db.execute('DELETE FROM closet_items WHERE closet_id = ?', (closet_id,)).rowcount
+        return db.execute(
+            'DELETE FROM closet_items WHERE closet_id = ? AND item_id = ?', (closet_id, item_id)
+        ).rowcount
+
+    def stats(self) -> Dict[str, int]:
+        row = self._connect().execute('SELECT COUNT(*), COUNT(DISTINCT closet_id) FROM closet_items').fetchone()
+        return {
+            'items': row[0],
+            'closets': row[1]
+        }
@@ -1,29 +1,112 @@
 import cv2
+import io
+import json
 import numpy as np
-from sklearn.cluster import KMeans
+import threading
+import time
+import torch
 import webcolors
+from PIL import Image
 from ultralytics import YOLO
 from segment_anything import SamPredictor, sam_model_registry
 import os
-from typing import List, Tuple, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Dict, Any, Optional
+from color_extraction import ColorExtractor
+from result_cache import ResultCache
+from metrics import StageTimer, NULL_TIMER
+from pipeline import CropExecutor, DetectionPipeline, clip_boxes, describe_colors
+from serving import PayloadTooLarge
+import garments
+import segmentation
+import onnx_backend
 
 class ClothingDetector:
-    def __init__(self):
-        """Initialize the clothing detector with YOLO and SAM models"""
+    SEGMENTATION_METHODS = segmentation.SEGMENTATION_METHODS
+    
+    def __init__(self, color_backend: str = 'seeded', max_color_pixels: int = 20000,
+                 max_batch_size: int = 16, result_cache: ResultCache = None,
+                 yolo_weights: str = 'yolov8n.pt', sam_checkpoint: str = 'sam_vit_b.pth',
+                 yolo_model=None, load_models: bool = True, lazy_sam: bool = False,
+                 max_image_side: int = 1024, max_detect_side: int = 640,
+                 inference_backend: str = 'auto', onnx_threads: int = None, crop_workers: int = None, crop_shares: int = 1,
+                 garment_weights: str = None, segmentation: str = 'auto', max_decode_pixels: int = 40_000_000):
+        """Initialize the clothing detector with YOLO and SAM models
+        
+        An already constructed ``yolo_model`` may be passed in (e.g. a stub for
+        benchmarks); ``sam_checkpoint=None`` disables SAM. With
+        ``load_models=False`` nothing is loaded until load_models() is called,
+        which can run in the background; ``lazy_sam`` defers SAM to first use.
+        
+        Large inputs are analyzed on a copy bounded to ``max_image_side`` (SAM
+        works at 1024 px internally) and YOLO runs on one bounded to
+        ``max_detect_side`` (its 640 px input size); 0 disables either bound.
+        Reported boxes are mapped back to the original image coordinates.
+        Uploads are decoded within ``max_decode_pixels``: over it, JPEGs are
+        decoded at a reduced scale and other formats are refused with
+        PayloadTooLarge before any pixels are decoded (0 disables the limit).
+        
+        ``inference_backend`` is 'auto' (ONNX Runtime when export_models.py
+        artifacts exist next to the weights, else PyTorch), 'onnx' or 'torch'.
+        
+        ``garment_weights`` is an optional fashion-trained YOLO (see garments.py)
+        used instead of ``yolo_weights``: detections are then individual
+        garments with their own class and confidence rather than whole people.
+        If the file is missing, the person detector is used as before.
+        
+        ``segmentation`` picks how detections are masked: 'sam', 'grabcut'
+        (cheap CPU GrabCut seeded from each box, SAM is never loaded), 'box'
+        (no mask) or 'auto' (SAM when its checkpoint loads, else GrabCut).
+        'sam' without a checkpoint keeps whole boxes.
+        
+        Colors of the detections in one image are computed on up to
+        ``crop_workers`` threads (default: the process's CPU share divided by
+        ``crop_shares``, the number of requests analyzed at once); 1 runs
+        them one after another.
+        """
         print("🚀 Initializing Clothing Detector...")
         
-        # Initialize YOLO model for clothing detection
-        self.yolo_model = YOLO('yolov8n.pt')
-        print("✅ YOLO model loaded")
+        self.yolo_weights = yolo_weights
+        self.garment_weights = garment_weights
+        self.sam_checkpoint = sam_checkpoint
         
-        # Initialize SAM for segmentation
-        try:
-            self.sam = sam_model_registry["vit_b"](checkpoint="sam_vit_b.pth")
-            self.sam_predictor = SamPredictor(self.sam)
-            print("✅ SAM model loaded")
-        except FileNotFoundError:
-            print("⚠️ SAM model not found, using basic segmentation")
-            self.sam_predictor = None
+        # Weights the detect stage loads: the garment model when it exists
+        self.detect_weights = yolo_weights
+        if garment_weights:
+            if os.path.exists(garment_weights) or os.path.exists(onnx_backend.yolo_onnx_path(garment_weights)):
+                self.detect_weights = garment_weights
+            else:
+                print(f"⚠️ Garment weights {garment_weights} not found, detecting whole people")
+        self._classes = None
+        self.lazy_sam = lazy_sam
+        
+        if inference_backend not in ('auto', 'onnx', 'torch'):
+            raise ValueError(f"Unknown inference backend '{inference_backend}'")
+        if segmentation not in self.SEGMENTATION_METHODS:
+            raise ValueError(f"Unknown segmentation '{segmentation}', expected one of {self.SEGMENTATION_METHODS}")
+        self.segmentation = segmentation
+        self.inference_backend = inference_backend
+        self.onnx_threads = onnx_threads
+        # Runtime each model actually loaded with: torch, onnx or custom
+        self.model_backends = {}
+        
+        # Per-model load state: pending, loading, ready, unavailable, disabled or failed
+        self.model_state = {'yolo': 'pending', 'sam': 'pending', 'warmup': 'pending'}
+        self.model_errors = {}
+        self._yolo_model = None
+        self._sam_predictor = None
+        self._yolo_loaded = threading.Event()
+        self._sam_loaded = threading.Event()
+        self._ready = threading.Event()
+        self._sam_load_lock = threading.Lock()
+        
+        self._custom_yolo = yolo_model is not None
+        if yolo_model is not None:
+            self.yolo_model = yolo_model
+            self.model_backends['yolo'] = 'custom'
+        
+        # SamPredictor keeps the current image embedding as state; guard it across threads
+        self._sam_lock = threading.Lock()
         
         # Clothing categories from COCO dataset
         self.clothing_categories = [
@@ -40,8 +123,241 @@ class ClothingDetector:
             'toothbrush'
         ]
         
+        # Dominant color extraction backend (see color_extraction.py)
+        self.color_extractor = ColorExtractor(backend=color_backend, max_pixels=max_color_pixels)
+        
+        # Upper bound on images per YOLO call in detect_batch
+        self.max_batch_size = max_batch_size
+        
+        # Resolution policy: longest side of the working image and of the YOLO input
+        self.max_image_side = max_image_side
+        self.max_detect_side = max_detect_side
+        self.max_decode_pixels = max_decode_pixels
+        
+        # Precompute the named-color palette once for vectorized lookups
+        self._build_color_palette()
+        
+        # Detect -> segment -> colors -> names; stages are bound methods, so
+        # swapping a model or the color extractor carries over
+        self.pipeline = DetectionPipeline(
+            detect=self.detect_boxes,
+            segment=self.get_box_masks,
+            extract_colors=self.get_color_percentages,
+            name_colors=self.closest_color_names,
+            classify=self.classify,
+            executor=CropExecutor(crop_workers, shares=crop_shares)
+        )
+        
+        # Optional cache of full results keyed by image content + config
+        self.result_cache = result_cache
+        
+        if load_models:
+            self.load_models()
+        
         print("✅ Clothing Detector initialized successfully")
     
+    @property
+    def yolo_model(self):
+        """The YOLO model, waiting for a background load to finish if needed"""
+        self._yolo_loaded.wait()
+        if self._yolo_model is None:
+            raise RuntimeError(f"YOLO model not available: {self.model_errors.get('yolo', 'not loaded')}")
+        return self._yolo_model
+    
+    @yolo_model.setter
+    def yolo_model(self, model):
+        self._yolo_model = model
+        self.model_state['yolo'] = 'ready'
+        self._yolo_loaded.set()
+    
+    @property
+    def sam_predictor(self):
+        """The SAM predictor (or None), loading it on first use when lazy_sam is set"""
+        if self.lazy_sam and self.model_state['sam'] == 'pending':
+            self._load_sam()
+        self._sam_loaded.wait()
+        return self._sam_predictor
+    
+    @sam_predictor.setter
+    def sam_predictor(self, predictor):
+        self._sam_predictor = predictor
+        self.model_state['sam'] = 'ready' if predictor is not None else 'disabled'
+        self._sam_loaded.set()
+    
+    def load_models(self, background: bool = False, warmup: bool = False):
+        """Load YOLO and SAM in parallel, optionally followed by a warm-up pass.
+        
+        With background=True this returns immediately; poll is_ready() or
+        model_state to see progress.
+        """
+        if background:
+            threading.Thread(target=self._load_models, args=(warmup,), name='model-loader', daemon=True).start()
+        else:
+            self._load_models(warmup)
+    
+    def _load_models(self, warmup: bool):
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            jobs = [pool.submit(self._load_yolo)]
+            if not self.lazy_sam:
+                jobs.append(pool.submit(self._load_sam))
+            for job in jobs:
+                job.result()
+        print(f"✅ Models loaded in {time.time() - started:.1f}s")
+        
+        if warmup:
+            self.warm_up()
+        else:
+            self.model_state['warmup'] = 'skipped'
+        self._ready.set()
+    
+    def _load_yolo(self):
+        if self._yolo_loaded.is_set():
+            return
+        self.model_state['yolo'] = 'loading'
+        try:
+            onnx_path = self._onnx_artifact(onnx_backend.yolo_onnx_path, self.detect_weights)
+            if onnx_path is not None:
+                self.yolo_model = onnx_backend.OnnxYOLO(onnx_path, threads=self.onnx_threads)
+                self.model_backends['yolo'] = 'onnx'
+                print(f"✅ YOLO model loaded (ONNX Runtime, {os.path.basename(onnx_path)})")
+            else:
+                # Initialize YOLO model for clothing detection
+                self.yolo_model = YOLO(self.detect_weights)
+                self.model_backends['yolo'] = 'torch'
+                print(f"✅ YOLO model loaded ({self.detect_weights})")
+        except Exception as e:
+            print(f"❌ YOLO model failed to load: {e}")
+            self.model_errors['yolo'] = str(e)
+            self.model_state['yolo'] = 'failed'
+            self._yolo_loaded.set()
+    
+    def _load_sam(self):
+        with self._sam_load_lock:
+            if self._sam_loaded.is_set():
+                return
+            self.model_state['sam'] = 'loading'
+            
+            # Initialize SAM for segmentation
+            if self.segmentation in ('grabcut', 'box'):
+                print(f"✅ Using {self.segmentation} segmentation, SAM not loaded")
+                self.model_state['sam'] = 'disabled'
+            elif self.sam_checkpoint is None:
+                print(f"⚠️ SAM disabled, using {self.segmentation_method} segmentation")
+                self.model_state['sam'] = 'disabled'
+            else:
+                try:
+                    self.sam = sam_model_registry["vit_b"](checkpoint=self.sam_checkpoint)
+                    encoder_path = self._onnx_artifact(onnx_backend.sam_encoder_onnx_path, self.sam_checkpoint)
+                    if encoder_path is not None:
+                        self._sam_predictor = onnx_backend.OnnxSamPredictor(
+                            self.sam, encoder_path, threads=self.onnx_threads
+                        )
+                        self.model_backends['sam'] = 'onnx'
+                    else:
+                        self._sam_predictor = SamPredictor(self.sam)
+                        self.model_backends['sam'] = 'torch'
+                    self.model_state['sam'] = 'ready'
+                    print(f"✅ SAM model loaded ({self.model_backends['sam']})")
+                except FileNotFoundError:
+                    print(f"⚠️ SAM model not found, using {self.segmentation_method} segmentation")
+                    self.model_state['sam'] = 'unavailable'
+                except Exception as e:
+                    print(f"⚠️ SAM model failed to load, using {self.segmentation_method} segmentation: {e}")
+                    self.model_errors['sam'] = str(e)
+                    self.model_state['sam'] = 'failed'
+            self._sam_loaded.set()
+    
+    def _onnx_export(self, path_for, weights: str) -> Optional[str]:
+        """Exported ONNX model next to weights, if any (never with the torch backend)"""
+        if self.inference_backend == 'torch':
+            return None
+        return onnx_backend.find_artifact([path_for(weights, quantized=True), path_for(weights)])
+    
+    def _onnx_artifact(self, path_for, weights: str):
+        """Path of the exported ONNX model to use for weights, or None for PyTorch"""
+        path = self._onnx_export(path_for, weights)
+        if path is not None and onnx_backend.onnx_available():
+            return path
+        if self.inference_backend == 'onnx':
+            reason = 'onnxruntime is not installed' if path is not None else \
+                f"no ONNX export of {weights} (run export_models.py)"
+            raise RuntimeError(reason)
+        return None
+    
+    def warm_up(self):
+        """Run one small inference through each loaded model so the first request isn't slow"""
+        self.model_state['warmup'] = 'running'
+        started = time.time()
+        try:
+            image = np.full((320, 320, 3), 127, dtype=np.uint8)
+            self.detect_clothing(image)
+            if self.model_state['sam'] == 'ready':
+                self.get_box_masks(image, np.array([[80, 40, 240, 300]]))
+            self.model_state['warmup'] = 'done'
+            print(f"✅ Warm-up finished in {time.time() - started:.1f}s")
+        except Exception as e:
+            print(f"⚠️ Warm-up failed: {e}")
+            self.model_errors['warmup'] = str(e)
+            self.model_state['warmup'] = 'failed'
+    
+    def is_ready(self) -> bool:
+        """True once the models are loaded (and warmed up, if requested)"""
+        return self._ready.is_set() and self.model_state['yolo'] == 'ready'
+    
+    def cache_config(self) -> str:
+        """Describe everything that affects detection output, for cache keys.
+        
+        Built from the configuration and the weight files on disk, never from
+        load state, so a result computed while the models are still loading
+        gets the same key as one computed afterwards (and SAM is never
+        waited for or, with lazy_sam, loaded).
+        """
+        if self.segmentation in ('grabcut', 'box'):
+            segmentation = self.segmentation
+        elif self.sam_checkpoint is not None and os.path.exists(self.sam_checkpoint):
+            segmentation = 'sam'
+        else:
+            segmentation = 'grabcut' if self.segmentation == 'auto' else 'box'
+        return json.dumps({
+            'yolo_weights': self.yolo_weights,
+            'detect_weights': self.detect_weights,
+            'sam_checkpoint': self.sam_checkpoint if segmentation == 'sam' else None,
+            'segmentation': segmentation,
+            'color_backend': self.color_extractor.backend,
+            'max_color_pixels': self.color_extractor.max_pixels,
+            'max_image_side': self.max_image_side,
+            'max_detect_side': self.max_detect_side,
+            'backends': {
+                'yolo': 'custom' if self._custom_yolo else
+                        self._configured_runtime(onnx_backend.yolo_onnx_path, self.detect_weights),
+                'sam': self._configured_runtime(onnx_backend.sam_encoder_onnx_path, self.sam_checkpoint)
+                       if segmentation == 'sam' else None
+            },
+            'k': 3
+        }, sort_keys=True)
+    
+    def _configured_runtime(self, path_for, weights: str) -> str:
+        """Runtime a model loads with: the name of its ONNX export, or 'torch'"""
+        path = self._onnx_export(path_for, weights)
+        if path is not None and onnx_backend.onnx_available():
+            return os.path.basename(path)
+        return 'torch'
+    
+    def _build_color_palette(self):
+        """Build the CSS3 palette matrix used by closest_color_names"""
+        # Keep webcolors' dict order so ties resolve to the same name as before
+        self.color_palette_names = list(webcolors.CSS3_NAMES_TO_HEX.keys())
+        self.color_palette = np.array(
+            [webcolors.hex_to_rgb(hex_val) for hex_val in webcolors.CSS3_NAMES_TO_HEX.values()],
+            dtype=np.int32
+        )
+        # Exact matches use webcolors' canonical name for duplicated values (e.g. cyan/aqua)
+        self.exact_color_names = {
+            tuple(webcolors.hex_to_rgb(hex_val)): name
+            for hex_val, name in webcolors.CSS3_HEX_TO_NAMES.items()
+        }
+    
     def load_image(self, image_path: str) -> np.ndarray:
         """Step 1: Load and preprocess image"""
         image = cv2.imread(image_path)
@@ -49,174 +365,294 @@ class ClothingDetector:
             raise ValueError(f"Could not load image from {image_path}")
         return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
     
+    def _decode(self, image_bytes: bytes, flags: int) -> np.ndarray:
+        # np.frombuffer wraps the request buffer without copying it
+        buffer = np.frombuffer(image_bytes, dtype=np.uint8)
+        image = cv2.imdecode(buffer, flags) if buffer.size else None
+        if image is None:
+            # Formats OpenCV can't decode (e.g. GIF) go through PIL
+            try:
+                with Image.open(io.BytesIO(image_bytes)) as pil_image:
+                    image = np.array(pil_image.convert('RGB'))
+                # Swap channels in place rather than allocating another bitmap
+                image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR, dst=image)
+            except Exception:
+                raise ValueError('Invalid image data')
+        return image
+    
+    def decode_for_analysis(self, image_bytes: bytes,
+                            info: Optional[Tuple[str, Tuple[int, int]]] = None) -> Tuple[np.ndarray, Tuple[int, int]]:
+        """Decode an upload at reduced size where possible.
+        
+        Returns the BGR array, bounded to max_image_side, and the original
+        (width, height) to report boxes in. ``info`` is a probe_image() result
+        the caller already has. Raises PayloadTooLarge for images over
+        max_decode_pixels that can't be decoded at reduced scale.
+        """
+        if info is None:
+            info = self.probe_image(image_bytes)
+        factor = self.decode_factor(info)
+        image = self._decode(image_bytes, self._REDUCED_DECODE_FLAGS[factor])
+        original_size = info[1] if info is not None else (image.shape[1], image.shape[0])
+        # Only the bounded copy outlives this call (e.g. in a batch waiting for YOLO)
+        return self.bound_size(image, self.max_image_side), original_size
+    
+    _REDUCED_DECODE_FLAGS = {
+        1: cv2.IMREAD_COLOR,
+        2: cv2.IMREAD_REDUCED_COLOR_2,
+        4: cv2.IMREAD_REDUCED_COLOR_4,
+        8: cv2.IMREAD_REDUCED_COLOR_8
+    }
+    
+    def decode_factor(self, info: Optional[Tuple[str, Tuple[int, int]]]) -> int:
+        """Scale (1, 2, 4 or 8) an upload is decoded at; raises PayloadTooLarge if none fits max_decode_pixels.
+        
+        JPEGs use the largest DCT downscale that keeps the longest side >=
+        max_image_side, or a larger one when needed to fit the pixel budget.
+        """
+        if info is None:
+            return 1
+        image_format, (width, height) = info
+        factors = (1, 2, 4, 8) if image_format == 'JPEG' else (1,)
+        factor = 1
+        if self.max_image_side:
+            factor = max([f for f in factors if max(width, height) // f >= self.max_image_side], default=1)
+        for f in factors:
+            if f >= factor and (not self.max_decode_pixels or (width // f) * (height // f) <= self.max_decode_pixels):
+                return f
+        raise PayloadTooLarge(
+            f'Image is {width}x{height} ({width * height / 1e6:.0f} MP), over the '
+            f'{self.max_decode_pixels / 1e6:.0f} MP decode limit'
+        )
+    
+    def decoded_bytes(self, info: Optional[Tuple[str, Tuple[int, int]]], encoded_size: int) -> int:
+        """Estimated peak memory of decoding and analyzing one upload, for memory budgets.
+        
+        Counts the decoded bitmap, the bounded working copy and its RGB and
+        YOLO-sized copies. Raises PayloadTooLarge like decode_factor.
+        """
+        if info is None:
+            # Unknown header: OpenCV or PIL may still decode it; assume a compression ratio of 10
+            return encoded_size * 10
+        factor = self.decode_factor(info)
+        width, height = info[1][0] // factor, info[1][1] // factor
+        decoded = width * height * 3
+        bound = self.max_image_side
+        working = decoded if not bound else min(decoded, bound * bound * 3)
+        return decoded + 2 * working + encoded_size
+    
+    @staticmethod
+    def probe_image(image_bytes: bytes) -> Optional[Tuple[str, Tuple[int, int]]]:
+        """Read (format, (width, height)) from the image header without decoding pixels"""
+        try:
+            with Image.open(io.BytesIO(image_bytes)) as pil_image:
+                width, height = pil_image.size
+                # EXIF-rotated JPEGs decode transposed in OpenCV
+                if pil_image.format == 'JPEG' and pil_image.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+                    width, height = height, width
+                return pil_image.format, (width, height)
+        except Exception:
+            return None
+    
+    @staticmethod
+    def bound_size(image: np.ndarray, max_side: int) -> np.ndarray:
+        """Downscale so the longest side is at most max_side (no-op if already smaller)"""
+        height, width = image.shape[:2]
+        if not max_side or max(height, width) <= max_side:
+            return image
+        scale = max_side / max(height, width)
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        # INTER_AREA averages source pixels, so color proportions are preserved
+        return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    
     def detect_clothing(self, image: np.ndarray) -> np.ndarray:
         """Step 2: Detect clothing with YOLOv8"""
+        return self.detect_regions(image)[:, :4]
+    
+    def detect_regions(self, image: np.ndarray) -> np.ndarray:
+        """Step 2 with scores: (n, 6) rows of [x1, y1, x2, y2, confidence, class_id]"""
         results = self.yolo_model.predict(image)
-        if len(results) == 0 or len(results[0].boxes) == 0:
-            return np.array([])
-        
-        # Get bounding boxes for person class (index 0) and clothing-related items
-        clothing_boxes = []
-        for result in results:
-            boxes = result.boxes
-            if boxes is not None:
-                for box in boxes:
-                    # Filter for person and clothing-related items
-                    class_id = int(box.cls[0])
-                    if class_id == 0:  # person
-                        clothing_boxes.append(box.xyxy[0].cpu().numpy())
-        
-        return np.array(clothing_boxes)
+        return np.concatenate([self._detections(result) for result in results] or [np.zeros((0, 6), np.float32)])
+    
+    def detect_clothing_batch(self, images: List[np.ndarray]) -> List[np.ndarray]:
+        """Step 2 (batched): detect_regions for several images with one YOLO call per chunk"""
+        all_boxes = []
+        for start in range(0, len(images), self.max_batch_size):
+            # YOLO letterboxes differently sized images into a single batch tensor
+            chunk = list(images[start:start + self.max_batch_size])
+            results = self.yolo_model.predict(chunk)
+            all_boxes.extend(self._detections(result) for result in results)
+        
+        return all_boxes
+    
+    def detection_classes(self) -> Dict[int, Tuple[str, str]]:
+        """Classes the detect stage keeps: class id -> (clothing type, model label)"""
+        names = getattr(self.yolo_model, 'names', None) or {0: 'person'}
+        if self._classes is None or self._classes[0] is not names:
+            self._classes = (names, garments.detection_classes(names))
+        return self._classes[1]
+    
+    @property
+    def detection_mode(self) -> Optional[str]:
+        """'garments' or 'people' once YOLO is loaded, else None (doesn't wait for the load)"""
+        if self.model_state['yolo'] != 'ready':
+            return None
+        names = getattr(self._yolo_model, 'names', None) or {0: 'person'}
+        return 'garments' if garments.is_garment_model(names) else 'people'
+    
+    def classify(self, class_id: int) -> Tuple[str, str]:
+        """(clothing type, model label) of a detected class"""
+        return self.detection_classes().get(int(class_id), ('person', 'person'))
+    
+    def _detections(self, result) -> np.ndarray:
+        """Garment (or, for person detectors, person) rows from one YOLO result"""
+        classes = self.detection_classes()
+        rows = []
+        boxes = result.boxes
+        if boxes is not None:
+            for box in boxes:
+                class_id = int(box.cls[0])
+                if class_id in classes:
+                    rows.append([*box.xyxy[0].cpu().numpy()[:4], float(box.conf[0]), class_id])
+        
+        return np.array(rows, dtype=np.float32).reshape(-1, 6)
     
     def crop_regions(self, image: np.ndarray, boxes: np.ndarray) -> List[np.ndarray]:
         """Step 3: Crop detected clothes"""
-        crops = []
-        for box in boxes:
-            x1, y1, x2, y2 = map(int, box)
-            # Ensure coordinates are within image bounds
-            x1 = max(0, x1)
-            y1 = max(0, y1)
-            x2 = min(image.shape[1], x2)
-            y2 = min(image.shape[0], y2)
-            
-            if x2 > x1 and y2 > y1:
-                crop = image[y1:y2, x1:x2]
-                crops.append(crop)
-        
-        return crops
+        return [image[y1:y2, x1:x2] for x1, y1, x2, y2 in self._clip_boxes(image, boxes)]
+    
+    def _clip_boxes(self, image: np.ndarray, boxes: np.ndarray) -> List[Tuple[int, int, int, int]]:
+        """Clip boxes to integer image coordinates, dropping empty ones"""
+        return clip_boxes(image.shape, boxes)
+    
+    @property
+    def segmentation_method(self) -> str:
+        """Method get_box_masks uses: 'sam', 'grabcut' or 'box' (doesn't wait for SAM to load)"""
+        if self.segmentation in ('grabcut', 'box'):
+            return self.segmentation
+        if self._sam_predictor is not None:
+            return 'sam'
+        return 'grabcut' if self.segmentation == 'auto' else 'box'
     
-    def get_masks(self, crop: np.ndarray) -> np.ndarray:
-        """Step 4: Segment clothes using SAM"""
-        if self.sam_predictor is None:
-            # Fallback to basic segmentation
-            return np.ones(crop.shape[:2], dtype=np.uint8)
+    def get_box_masks(self, image: np.ndarray, boxes: np.ndarray) -> List[np.ndarray]:
+        """Step 4 (batched): Segment every detection, crop-local masks aligned with crop_regions(image, boxes).
         
-        try:
-            self.sam_predictor.set_image(crop)
-            masks, _, _ = self.sam_predictor.predict(
-                point_coords=None, 
-                point_labels=None, 
+        SAM embeds the full image once and takes all boxes as prompts in one
+        predict_torch call; GrabCut and whole-box masks are the cheap
+        alternatives (see segmentation_method).
+        """
+        regions = self._clip_boxes(image, boxes)
+        if not regions:
+            return []
+        if self.segmentation in ('auto', 'sam') and self.sam_predictor is not None:
+            try:
+                return self._sam_masks(image, regions)
+            except Exception as e:
+                print(f"⚠️ SAM segmentation failed: {e}")
+        
+        # Without SAM, 'auto' still excludes background; 'sam' keeps the old whole-box masks
+        if self.segmentation in ('auto', 'grabcut'):
+            return segmentation.grabcut_masks(image, regions)
+        # Fallback to basic segmentation
+        return segmentation.box_masks(regions)
+    
+    def _sam_masks(self, image: np.ndarray, regions: List[Tuple[int, int, int, int]]) -> List[np.ndarray]:
+        """SAM masks for clipped regions from one encoding of the image"""
+        with self._sam_lock:
+            self.sam_predictor.set_image(image)
+            box_prompts = torch.as_tensor(regions, dtype=torch.float, device=self.sam_predictor.device)
+            box_prompts = self.sam_predictor.transform.apply_boxes_torch(box_prompts, image.shape[:2])
+            masks, _, _ = self.sam_predictor.predict_torch(
+                point_coords=None,
+                point_labels=None,
+                boxes=box_prompts,
                 multimask_output=False
             )
-            return masks[0]  # binary mask
-        except Exception as e:
-            print(f"⚠️ SAM segmentation failed: {e}")
-            # Fallback to basic segmentation
-            return np.ones(crop.shape[:2], dtype=np.uint8)
+        
+        # Slice each full-frame mask down to its box before leaving torch
+        return [
+            masks[i, 0, y1:y2, x1:x2].cpu().numpy()
+            for i, (x1, y1, x2, y2) in enumerate(regions)
+        ]
     
     def get_color_percentages(self, image: np.ndarray, mask: np.ndarray = None, k: int = 3) -> List[Tuple[np.ndarray, float]]:
         """Step 5: Extract dominant colors + percentages"""
-        # Apply mask if provided
-        if mask is not None:
-            masked_image = image[mask > 0]
-            if len(masked_image) == 0:
-                return []
-            image = masked_image
-        
-        # Reshape image for clustering
-        image = image.reshape(-1, 3)
-        
-        # Run KMeans to find dominant colors
-        kmeans = KMeans(n_clusters=k, random_state=42, n_init=10)
-        kmeans.fit(image)
-        colors = kmeans.cluster_centers_.astype(int)
-        labels = kmeans.labels_
+        return self.color_extractor.extract(image, mask, k=k)
+    
+    def closest_color_names(self, rgbs) -> List[str]:
+        """Step 6: Convert a batch of RGB values to named colors in one vectorized call"""
+        rgbs = np.asarray(rgbs, dtype=np.int32).reshape(-1, 3)
+        if len(rgbs) == 0:
+            return []
         
-        # Calculate percentages
-        unique, counts = np.unique(labels, return_counts=True)
-        percentages = counts / counts.sum()
+        # Squared distance from every color to every palette entry: (n, palette)
+        diff = rgbs[:, None, :] - self.color_palette[None, :, :]
+        dists = np.einsum('npc,npc->np', diff, diff)
+        closest = np.argmin(dists, axis=1)
         
-        return list(zip(colors, percentages))
+        names = []
+        for rgb, idx, dist in zip(rgbs, closest, dists[np.arange(len(rgbs)), closest]):
+            if dist == 0:
+                names.append(self.exact_color_names.get(tuple(int(c) for c in rgb), self.color_palette_names[idx]))
+            else:
+                names.append(self.color_palette_names[idx])
+        return names
     
     def closest_color_name(self, rgb: np.ndarray) -> str:
-        """Step 6: Convert RGB to named colors"""
-        try:
-            return webcolors.rgb_to_name(tuple(rgb))
-        except ValueError:
-            # Find closest named color
-            min_dist = float('inf')
-            closest_name = None
-            for name, hex_val in webcolors.CSS3_NAMES_TO_HEX.items():
-                r_c, g_c, b_c = webcolors.hex_to_rgb(hex_val)
-                dist = sum((rgb[i] - [r_c, g_c, b_c][i]) ** 2 for i in range(3))
-                if dist < min_dist:
-                    min_dist = dist
-                    closest_name = name
-            return closest_name or 'unknown'
-    
-    def describe_outfit(self, clothing_color_data: List[Tuple[np.ndarray, float]]) -> str:
+        """Convert a single RGB value to its closest named color"""
+        names = self.closest_color_names([rgb])
+        return names[0] if names else 'unknown'
+    
+    def describe_outfit(self, clothing_color_data: List[Tuple[np.ndarray, float]],
+                        color_names: List[str] = None) -> str:
         """Step 7: Generate description using color data"""
-        if not clothing_color_data:
-            return "No clothing detected."
-        
-        description = []
-        for rgb, pct in clothing_color_data:
-            color_name = self.closest_color_name(rgb)
-            description.append(f"{int(pct*100)}% {color_name}")
-        
-        return "The clothing item contains: " + ", ".join(description) + "."
+        if color_names is None:
+            color_names = self.closest_color_names([rgb for rgb, _ in clothing_color_data])
+        return describe_colors(clothing_color_data, color_names)
     
-    def analyze_clothing(self, image_path: str) -> Dict[str, Any]:
+    def analyze_clothing(self, image_path: str, timer: StageTimer = None) -> Dict[str, Any]:
         """Step 8: End-to-End Runner"""
+        timer = timer or NULL_TIMER
         try:
             # Load image
-            image = self.load_image(image_path)
-            
-            # Detect clothing
-            boxes = self.detect_clothing(image)
-            
-            if len(boxes) == 0:
-                return {
-                    'success': False,
-                    'error': 'No clothing detected in the image',
-                    'detections': []
-                }
-            
-            # Crop regions
-            crops = self.crop_regions(image, boxes)
+            with timer.stage('decode'):
+                image = self.load_image(image_path)
+            with timer.stage('resize'):
+                working_image = self.bound_size(image, self.max_image_side)
             
-            results = []
-            for i, crop in enumerate(crops):
-                try:
-                    # Get segmentation mask
-                    mask = self.get_masks(crop)
-                    
-                    # Get color percentages
-                    colors = self.get_color_percentages(crop, mask)
-                    
-                    # Generate description
-                    description = self.describe_outfit(colors)
-                    
-                    # Format color data for response
-                    color_data = []
-                    for rgb, percentage in colors:
-                        color_name = self.closest_color_name(rgb)
-                        color_data.append({
-                            'name': color_name,
-                            'rgb': rgb.tolist(),
-                            'percentage': float(percentage * 100)
-                        })
-                    
-                    results.append({
-                        'index': i,
-                        'success': True,
-                        'description': description,
-                        'colors': color_data,
-                        'clothing_type': 'person',  # Default for now
-                        'confidence': 0.8  # Default confidence
-                    })
-                    
-                except Exception as e:
-                    results.append({
-                        'index': i,
-                        'success': False,
-                        'error': str(e)
-                    })
+            return self.pipeline.analyze(working_image, timer, (image.shape[1], image.shape[0]))
             
+        except Exception as e:
             return {
-                'success': True,
-                'detections': results
+                'success': False,
+                'error': str(e),
+                'detections': []
             }
+    
+    def detect_clothing_from_array(self, image_array: np.ndarray, use_cache: bool = True,
+                                   timer: StageTimer = None,
+                                   original_size: Tuple[int, int] = None,
+                                   max_detections: int = None) -> Dict[str, Any]:
+        """Analyze clothing from numpy array (for API use)
+        
+        ``original_size`` is the (width, height) of the source image when the
+        array was decoded at reduced size; boxes are reported in that space.
+        ``max_detections`` analyzes only the most confident detections; such
+        partial results are served from the cache but never stored in it.
+        """
+        timer = timer or NULL_TIMER
+        try:
+            cache_key, cached = self._cache_lookup(image_array, use_cache, timer, original_size)
+            if cached is not None:
+                if max_detections is not None:
+                    return {**cached, 'detections': cached['detections'][:max_detections]}
+                return cached
+            
+            image, original_size = self.prepare_image(image_array, original_size, timer)
+            result = self.pipeline.analyze(image, timer, original_size, max_detections=max_detections)
+            if cache_key is not None and max_detections is None:
+                self.result_cache.put(cache_key, result)
+            return result
             
         except Exception as e:
             return {
@@ -225,74 +661,122 @@ class ClothingDetector:
                 'detections': []
             }
     
-    def detect_clothing_from_array(self, image_array: np.ndarray) -> Dict[str, Any]:
-        """Analyze clothing from numpy array (for API use)"""
+    def prepare_image(self, image_array: np.ndarray, original_size: Tuple[int, int] = None,
+                      timer: StageTimer = NULL_TIMER) -> Tuple[np.ndarray, Tuple[int, int]]:
+        """Bounded RGB working image and the (width, height) boxes are reported in"""
+        original_size = original_size or (image_array.shape[1], image_array.shape[0])
+        with timer.stage('resize'):
+            # Shrink before color conversion so full-res pixels are read once
+            image_array = self.bound_size(image_array, self.max_image_side)
+        with timer.stage('decode'):
+            image = self._to_rgb(image_array)
+        return image, original_size
+    
+    def detect_batch(self, images: List[np.ndarray], use_cache: bool = True,
+                     timer: StageTimer = None,
+                     original_sizes: List[Tuple[int, int]] = None) -> List[Dict[str, Any]]:
+        """Analyze several numpy arrays with batched YOLO inference.
+        
+        Returns one result per input image, in order, each shaped like the
+        output of detect_clothing_from_array.
+        """
+        timer = timer or NULL_TIMER
+        results = [None] * len(images)
+        original_sizes = original_sizes or [None] * len(images)
+        
+        # Convert every uncached image first so one bad input doesn't fail the batch
+        rgb_images = []
+        detect_images = []
+        sizes = []
+        positions = []
+        cache_keys = []
+        for i, (image_array, original_size) in enumerate(zip(images, original_sizes)):
+            try:
+                cache_key, cached = self._cache_lookup(image_array, use_cache, timer, original_size)
+                if cached is not None:
+                    results[i] = cached
+                    continue
+                
+                sizes.append(original_size or (image_array.shape[1], image_array.shape[0]))
+                with timer.stage('resize'):
+                    image_array = self.bound_size(image_array, self.max_image_side)
+                with timer.stage('decode'):
+                    image = self._to_rgb(image_array)
+                with timer.stage('resize'):
+                    detect_images.append(self.bound_size(image, self.max_detect_side))
+                rgb_images.append(image)
+                positions.append(i)
+                cache_keys.append(cache_key)
+            except Exception as e:
+                results[i] = {
+                    'success': False,
+                    'error': str(e),
+                    'detections': []
+                }
+        
+        if not rgb_images:
+            return results
+        
         try:
-            # Convert BGR to RGB if needed
-            if len(image_array.shape) == 3 and image_array.shape[2] == 3:
-                image = cv2.cvtColor(image_array, cv2.COLOR_BGR2RGB)
-            else:
-                image = image_array
-            
-            # Detect clothing
-            boxes = self.detect_clothing(image)
-            
-            if len(boxes) == 0:
-                return {
+            with timer.stage('yolo'):
+                batch_boxes = self.detect_clothing_batch(detect_images)
+        except Exception as e:
+            batch_boxes = None
+            for i in positions:
+                results[i] = {
                     'success': False,
-                    'error': 'No clothing detected in the image',
+                    'error': str(e),
                     'detections': []
                 }
-            
-            # Crop regions
-            crops = self.crop_regions(image, boxes)
-            
-            results = []
-            for i, crop in enumerate(crops):
+        
+        if batch_boxes is not None:
+            for i, cache_key, image, detect_image, size, boxes in zip(
+                    positions, cache_keys, rgb_images, detect_images, sizes, batch_boxes):
                 try:
-                    # Get segmentation mask
-                    mask = self.get_masks(crop)
-                    
-                    # Get color percentages
-                    colors = self.get_color_percentages(crop, mask)
-                    
-                    # Generate description
-                    description = self.describe_outfit(colors)
-                    
-                    # Format color data for response
-                    color_data = []
-                    for rgb, percentage in colors:
-                        color_name = self.closest_color_name(rgb)
-                        color_data.append({
-                            'name': color_name,
-                            'rgb': rgb.tolist(),
-                            'percentage': float(percentage * 100)
-                        })
-                    
-                    results.append({
-                        'index': i,
-                        'success': True,
-                        'description': description,
-                        'colors': color_data,
-                        'clothing_type': 'person',  # Default for now
-                        'confidence': 0.8  # Default confidence
-                    })
-                    
+                    boxes = self._rescale_boxes(boxes, detect_image, image)
+                    results[i] = self.pipeline.analyze(image, timer, size, boxes=boxes)
+                    if cache_key is not None:
+                        self.result_cache.put(cache_key, results[i])
                 except Exception as e:
-                    results.append({
-                        'index': i,
+                    results[i] = {
                         'success': False,
-                        'error': str(e)
-                    })
-            
-            return {
-                'success': True,
-                'detections': results
-            }
-            
-        except Exception as e:
-            return {
-                'success': False,
-                'error': str(e),
-                'detections': []
-            } 
\ No newline at end of file
+                        'error': str(e),
+                        'detections': []
+                    }
+        
+        return results
+    
+    def _cache_lookup(self, image_array: np.ndarray, use_cache: bool, timer: StageTimer,
+                      original_size: Tuple[int, int] = None):
+        """Return (cache_key, cached_result); the key is None when caching is off"""
+        if not use_cache or self.result_cache is None:
+            return None, None
+        
+        with timer.stage('cache_lookup'):
+            # Reported boxes depend on the original size of a reduced decode
+            config = self.cache_config()
+            if original_size is not None:
+                config += json.dumps(list(original_size))
+            cache_key = ResultCache.make_key(image_array, config)
+            return cache_key, self.result_cache.get(cache_key)
+    
+    def _to_rgb(self, image_array: np.ndarray) -> np.ndarray:
+        """Convert BGR to RGB if needed"""
+        if len(image_array.shape) == 3 and image_array.shape[2] == 3:
+            return cv2.cvtColor(image_array, cv2.COLOR_BGR2RGB)
+        return image_array
+    
+    def detect_boxes(self, image: np.ndarray) -> np.ndarray:
+        """Detect stage: YOLO on a copy bounded to max_detect_side, rows in image coordinates"""
+        detect_image = self.bound_size(image, self.max_detect_side)
+        return self._rescale_boxes(self.detect_regions(detect_image), detect_image, image)
+    
+    def _rescale_boxes(self, boxes: np.ndarray, source: np.ndarray, target: np.ndarray) -> np.ndarray:
+        """Map xyxy boxes (extra columns such as scores untouched) from source to target image coordinates"""
+        if len(boxes) == 0 or source.shape[:2] == target.shape[:2]:
+            return boxes
+        scale_x = target.shape[1] / source.shape[1]
+        scale_y = target.shape[0] / source.shape[0]
+        boxes = np.array(boxes, dtype=np.float32)
+        boxes[:, :4] *= np.array([scale_x, scale_y, scale_x, scale_y], dtype=np.float32)
+        return boxes
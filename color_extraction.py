@@ -0,0 +1,184 @@
+"""
+Dominant color extraction backends for the clothing detector
+"""
+
+import numpy as np
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from typing import List, Tuple, Optional
+
+
+class ColorExtractor:
+    """Extract dominant colors + percentages from (masked) pixels.
+
+    Backends:
+      - 'kmeans':     sklearn KMeans with n_init=10 (the original behaviour)
+      - 'seeded':     a single KMeans run warm-started from a coarse color histogram
+      - 'minibatch':  MiniBatchKMeans warm-started from the same histogram seeds
+      - 'median_cut': variance-driven median cut, no iterative clustering at all
+
+    Every backend first subsamples the pixels to at most ``max_pixels``
+    (``None`` keeps every pixel) and returns ``[(rgb, percentage), ...]``
+    sorted by percentage, largest first.
+    """
+
+    BACKENDS = ('kmeans', 'seeded', 'minibatch', 'median_cut')
+
+    def __init__(self, backend: str = 'seeded', max_pixels: Optional[int] = 20000,
+                 histogram_bins: int = 8, random_state: int = 42):
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unknown color backend '{backend}', expected one of {self.BACKENDS}")
+        self.backend = backend
+        self.max_pixels = max_pixels
+        self.histogram_bins = histogram_bins
+        self.random_state = random_state
+
+    def sample_pixels(self, image: np.ndarray, mask: np.ndarray = None) -> np.ndarray:
+        """Return an (n, 3) pixel array of at most max_pixels masked pixels"""
+        height, width = image.shape[:2]
+        if mask is not None and not mask.all():
+            candidates = np.flatnonzero(mask)
+        else:
+            candidates = None
+
+        total = height * width if candidates is None else len(candidates)
+        if self.max_pixels is not None and total > self.max_pixels:
+            rng = np.random.default_rng(self.random_state)
+            keep = np.sort(rng.choice(total, self.max_pixels, replace=False))
+            candidates = keep if candidates is None else candidates[keep]
+        elif candidates is None:
+            return image.reshape(-1, 3)
+
+        # Gather only the selected pixels instead of copying the whole (masked) crop
+        rows, cols = np.unravel_index(candidates, (height, width))
+        return image[rows, cols].reshape(-1, 3)
+
+    def histogram_seeds(self, pixels: np.ndarray, k: int) -> np.ndarray:
+        """Seed centers from the k most populated cells of a coarse color histogram"""
+        bins = self.histogram_bins
+        quantized = (pixels.astype(np.int64) * bins) >> 8
+        cells = (quantized[:, 0] * bins + quantized[:, 1]) * bins + quantized[:, 2]
+
+        counts = np.bincount(cells, minlength=bins ** 3)
+        sums = np.stack([
+            np.bincount(cells, weights=pixels[:, c], minlength=bins ** 3) for c in range(3)
+        ], axis=1)
+
+        populated = np.flatnonzero(counts)
+        top = populated[np.argsort(counts[populated], kind='stable')[::-1][:k]]
+        seeds = sums[top] / counts[top, None]
+
+        # Too few populated cells: add the pixels farthest from the current seeds
+        pixels_f = pixels.astype(np.float64)
+        dists = np.full(len(pixels_f), np.inf)
+        for seed in seeds:
+            dists = np.minimum(dists, ((pixels_f - seed) ** 2).sum(axis=1))
+        while len(seeds) < k:
+            farthest = int(np.argmax(dists))
+            if dists[farthest] == 0:
+                break
+            seeds = np.vstack([seeds, pixels_f[farthest]])
+            dists = np.minimum(dists, ((pixels_f - pixels_f[farthest]) ** 2).sum(axis=1))
+
+        return seeds
+
+    def extract(self, image: np.ndarray, mask: np.ndarray = None, k: int = 3,
+                init: np.ndarray = None) -> List[Tuple[np.ndarray, float]]:
+        """Extract up to k dominant colors.
+
+        ``init`` optionally supplies starting centers (e.g. from a previous
+        frame) for the clustering backends instead of the histogram seeds.
+        """
+        pixels = self.sample_pixels(image, mask)
+        if len(pixels) == 0:
+            return []
+
+        if self.backend == 'median_cut':
+            return self._median_cut(pixels, k)
+        return self._cluster(pixels, k, init)
+
+    def _cluster(self, pixels: np.ndarray, k: int, init: np.ndarray = None) -> List[Tuple[np.ndarray, float]]:
+        """Run KMeans / MiniBatchKMeans on the sampled pixels"""
+        pixels = pixels.astype(np.float64)
+
+        if init is not None:
+            seeds = np.asarray(init, dtype=np.float64).reshape(-1, 3)
+        elif self.backend in ('seeded', 'minibatch'):
+            seeds = self.histogram_seeds(pixels, k)
+        else:
+            seeds = None
+
+        # Never ask for more clusters than there are distinct seeds / pixels
+        if seeds is not None:
+            n_clusters = len(seeds)
+        else:
+            n_clusters = min(k, len(np.unique(pixels, axis=0)))
+        if n_clusters == 0:
+            return []
+
+        if self.backend == 'kmeans' and init is None:
+            model = KMeans(n_clusters=n_clusters, random_state=self.random_state, n_init=10)
+        elif self.backend == 'minibatch':
+            model = MiniBatchKMeans(
+                n_clusters=n_clusters,
+                init=seeds,
+                n_init=1,
+                batch_size=min(len(pixels), 1024),
+                max_no_improvement=3,
+                random_state=self.random_state
+            )
+        else:
+            model = KMeans(n_clusters=n_clusters, init=seeds, n_init=1, random_state=self.random_state)
+        model.fit(pixels)
+
+        counts = np.bincount(model.labels_, minlength=n_clusters)
+        return self._to_color_data(model.cluster_centers_, counts)
+
+    def _median_cut(self, pixels: np.ndarray, k: int) -> List[Tuple[np.ndarray, float]]:
+        """Split the highest-error color box until there are k boxes"""
+        boxes = [pixels]
+        errors = [self._box_error(pixels)]
+        while len(boxes) < k:
+            widest = int(np.argmax(errors))
+            if errors[widest] == 0:
+                break
+
+            box = boxes.pop(widest)
+            errors.pop(widest)
+            channel = int(np.argmax(box.var(axis=0)))
+            left = box[:, channel] <= self._split_threshold(box[:, channel])
+            for part in (box[left], box[~left]):
+                boxes.append(part)
+                errors.append(self._box_error(part))
+
+        centers = np.array([box.mean(axis=0) for box in boxes])
+        counts = np.array([len(box) for box in boxes])
+        return self._to_color_data(centers, counts)
+
+    @staticmethod
+    def _box_error(box: np.ndarray) -> float:
+        """Total squared distance of a box's pixels to its mean"""
+        if len(box) < 2:
+            return 0.0
+        return float(box.var(axis=0).sum() * len(box))
+
+    @staticmethod
+    def _split_threshold(values: np.ndarray) -> int:
+        """Otsu threshold on one 8-bit channel (maximizes between-class variance)"""
+        hist = np.bincount(values.astype(np.int64), minlength=256).astype(np.float64)
+        total = hist.sum()
+        weight = np.cumsum(hist)
+        moment = np.cumsum(hist * np.arange(len(hist)))
+        valid = (weight > 0) & (weight < total)
+        between = np.zeros_like(hist)
+        between[valid] = (moment[-1] * weight[valid] - moment[valid] * total) ** 2 / (weight[valid] * (total - weight[valid]))
+        return int(np.argmax(between))
+
+    @staticmethod
+    def _to_color_data(centers: np.ndarray, counts: np.ndarray) -> List[Tuple[np.ndarray, float]]:
+        """Pair centers with their pixel share, dropping empty clusters"""
+        keep = counts > 0
+        centers, counts = centers[keep], counts[keep]
+        percentages = counts / counts.sum()
+        order = np.argsort(percentages, kind='stable')[::-1]
+        colors = centers.astype(int)
+        return [(colors[i], float(percentages[i])) for i in order]
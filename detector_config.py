@@ -0,0 +1,50 @@
+"""
+Detector and result cache configured from the environment
+
+The web app (app.py) and the job workers (jobs.py) both build their
+ClothingDetector here, so they analyze with the same models, resolution
+bounds and segmentation without the workers importing the Flask app.
+"""
+
+import os
+from typing import Optional
+
+from clothing_detector import ClothingDetector
+from result_cache import ResultCache
+
+
+def result_cache_from_env() -> Optional[ResultCache]:
+    """Result cache for repeated uploads (RESULT_CACHE_SIZE=0 disables it)"""
+    cache_size = int(os.environ.get('RESULT_CACHE_SIZE', 256))
+    if cache_size <= 0:
+        return None
+    return ResultCache(
+        max_entries=cache_size,
+        disk_dir=os.environ.get('RESULT_CACHE_DIR') or None,
+        disk_max_bytes=int(os.environ.get('RESULT_CACHE_DISK_MB', 1024)) * 2 ** 20,
+        disk_max_entries=int(os.environ.get('RESULT_CACHE_DISK_ENTRIES', 100_000))
+    )
+
+
+def detector_from_env(**options) -> ClothingDetector:
+    """ClothingDetector configured by the environment; models are not loaded yet.
+
+    ``options`` are passed to ClothingDetector on top of the environment
+    settings (e.g. the result cache or crop_shares).
+    """
+    # Large uploads are analyzed at bounded resolution (0 disables a bound)
+    config = {
+        'max_color_pixels': int(os.environ.get('COLOR_MAX_PIXELS', 20000)),
+        'max_image_side': int(os.environ.get('MAX_IMAGE_SIDE', 1024)),
+        'max_detect_side': int(os.environ.get('MAX_DETECT_SIDE', 640)),
+        'inference_backend': os.environ.get('INFERENCE_BACKEND', 'auto'),
+        'onnx_threads': int(os.environ.get('ONNX_NUM_THREADS', 0)) or None,
+        'crop_workers': int(os.environ.get('CROP_WORKERS', 0)) or None,
+        'garment_weights': os.environ.get('GARMENT_WEIGHTS') or None,
+        'segmentation': os.environ.get('SEGMENTATION', 'auto'),
+        'max_decode_pixels': int(os.environ.get('MAX_DECODE_PIXELS', 40_000_000)),
+        'lazy_sam': os.environ.get('SAM_LAZY', '0') == '1',
+        'load_models': False
+    }
+    config.update(options)
+    return ClothingDetector(**config)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+One-time export of the detection models to ONNX for the ONNX Runtime backend
+
+Writes the artifacts next to the PyTorch weights, where ClothingDetector
+looks for them (see onnx_backend.py):
+
+    yolov8n.pt      -> yolov8n.onnx
+    sam_vit_b.pth   -> sam_vit_b_encoder.onnx (+ sam_vit_b_encoder.int8.onnx)
+
+Only SAM's image encoder is exported; the prompt encoder and mask decoder
+are cheap and keep running in PyTorch. --quantize applies to the encoder
+only: dynamic quantization turns YOLO's convolutions into ConvInteger,
+which ONNX Runtime runs several times slower than the float model on CPU.
+
+Examples:
+    python export_models.py
+    python export_models.py --quantize
+    python export_models.py --skip-sam
+"""
+
+import argparse
+import os
+import shutil
+
+import torch
+from segment_anything import sam_model_registry
+from ultralytics import YOLO
+
+from onnx_backend import sam_encoder_onnx_path, yolo_onnx_path
+
+
+def export_yolo(weights: str, imgsz: int, opset: int) -> str:
+    """Export YOLO with a dynamic batch axis at a fixed square input size"""
+    print(f"📦 Exporting {weights} to ONNX...")
+    exported = YOLO(weights).export(format='onnx', imgsz=imgsz, dynamic=True, simplify=False, opset=opset)
+    path = yolo_onnx_path(weights)
+    if os.path.abspath(exported) != os.path.abspath(path):
+        shutil.move(exported, path)
+    print(f"✅ YOLO exported to {path}")
+    return path
+
+
+def export_sam_encoder(checkpoint: str, model_type: str, opset: int) -> str:
+    """Export SAM's ViT image encoder (1x3x1024x1024 preprocessed image -> embeddings)"""
+    print(f"📦 Exporting the SAM encoder from {checkpoint} to ONNX...")
+    sam = sam_model_registry[model_type](checkpoint=checkpoint).eval()
+    encoder = sam.image_encoder
+    dummy = torch.randn(1, 3, encoder.img_size, encoder.img_size)
+
+    path = sam_encoder_onnx_path(checkpoint)
+    with torch.no_grad():
+        torch.onnx.export(
+            encoder,
+            dummy,
+            path,
+            input_names=['image'],
+            output_names=['embeddings'],
+            opset_version=opset,
+            do_constant_folding=True
+        )
+    print(f"✅ SAM encoder exported to {path}")
+    return path
+
+
+def quantize(path: str, quantized_path: str):
+    """Dynamic INT8 quantization of the model weights"""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    print(f"🗜️  Quantizing {path} to INT8...")
+    quantize_dynamic(path, quantized_path, weight_type=QuantType.QInt8)
+    size_mb = os.path.getsize(quantized_path) / (1024 * 1024)
+    print(f"✅ Quantized model written to {quantized_path} ({size_mb:.0f} MB)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export YOLO and the SAM encoder to ONNX')
+    parser.add_argument('--yolo-weights', default='yolov8n.pt', help='YOLO weights to export')
+    parser.add_argument('--sam-checkpoint', default='sam_vit_b.pth', help='SAM checkpoint to export')
+    parser.add_argument('--sam-model-type', default='vit_b', help='SAM registry model type')
+    parser.add_argument('--imgsz', type=int, default=640, help='YOLO input size')
+    parser.add_argument('--opset', type=int, default=17, help='ONNX opset version')
+    parser.add_argument('--quantize', action='store_true',
+                        help='Also write a dynamically INT8-quantized SAM encoder')
+    parser.add_argument('--skip-yolo', action='store_true', help='Do not export YOLO')
+    parser.add_argument('--skip-sam', action='store_true', help='Do not export the SAM encoder')
+    args = parser.parse_args()
+
+    if not args.skip_yolo:
+        export_yolo(args.yolo_weights, args.imgsz, args.opset)
+
+    if not args.skip_sam:
+        if os.path.exists(args.sam_checkpoint):
+            path = export_sam_encoder(args.sam_checkpoint, args.sam_model_type, args.opset)
+            if args.quantize:
+                quantize(path, sam_encoder_onnx_path(args.sam_checkpoint, quantized=True))
+        else:
+            print(f"⚠️ SAM checkpoint {args.sam_checkpoint} not found, skipping the encoder")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Garment categories for fashion-trained detection models
+
+Maps the class names of common fashion datasets (DeepFashion2, ModaNet,
+Fashionpedia-style labels) onto a small set of clothing types. A model
+with none of these classes (e.g. COCO yolov8n) is used as a person
+detector instead, with whole-person crops as before.
+"""
+
+from typing import Dict, Tuple
+
+# Normalized class name -> clothing type
+GARMENT_CATEGORIES = {
+    'top': (
+        'top', 'shirt', 't_shirt', 'tshirt', 'blouse', 'sweater', 'hoodie', 'sweatshirt', 'tank_top',
+        'vest', 'sling', 'short_sleeved_shirt', 'long_sleeved_shirt', 'short_sleeve_top', 'long_sleeve_top'
+    ),
+    'outerwear': (
+        'outer', 'outerwear', 'jacket', 'coat', 'cardigan', 'blazer',
+        'short_sleeved_outwear', 'long_sleeved_outwear', 'short_sleeve_outwear', 'long_sleeve_outwear'
+    ),
+    'bottom': ('bottom', 'pants', 'trousers', 'jeans', 'shorts', 'skirt', 'skirts', 'leggings'),
+    'dress': (
+        'dress', 'jumpsuit', 'short_sleeved_dress', 'long_sleeved_dress', 'vest_dress', 'sling_dress',
+        'short_sleeve_dress', 'long_sleeve_dress'
+    ),
+    'shoes': ('shoes', 'shoe', 'footwear', 'boots', 'sneakers', 'sandals', 'heels'),
+    'accessory': ('bag', 'belt', 'headwear', 'hat', 'scarf', 'scarf_tie', 'tie', 'sunglasses', 'glasses'),
+}
+
+# Accessories alone don't make a garment model (COCO has 'tie' and 'handbag')
+_GARMENT_TYPES = ('top', 'outerwear', 'bottom', 'dress', 'shoes')
+
+_CATEGORY_BY_NAME = {name: category for category, names in GARMENT_CATEGORIES.items() for name in names}
+
+
+def normalize_class_name(name: str) -> str:
+    """'Long sleeve top' / 'long-sleeve_top' -> 'long_sleeve_top'"""
+    return '_'.join(str(name).lower().replace('-', ' ').replace('/', ' ').split())
+
+
+def garment_category(name: str) -> str:
+    """Clothing type of a model class name, or None for non-garment classes"""
+    return _CATEGORY_BY_NAME.get(normalize_class_name(name))
+
+
+def detection_classes(names: Dict[int, str]) -> Dict[int, Tuple[str, str]]:
+    """Classes to keep from a detector: class id -> (clothing type, model label).
+
+    Garment models keep every garment and accessory class; other models
+    keep 'person' (class 0 when the model has no such name).
+    """
+    if isinstance(names, (list, tuple)):
+        names = dict(enumerate(names))
+    garments = {
+        class_id: (garment_category(label), label)
+        for class_id, label in names.items()
+        if garment_category(label) is not None
+    }
+    if any(category in _GARMENT_TYPES for category, _ in garments.values()):
+        return garments
+
+    people = {
+        class_id: ('person', label)
+        for class_id, label in names.items()
+        if normalize_class_name(label) == 'person'
+    }
+    return people or {0: ('person', 'person')}
+
+
+def is_garment_model(names: Dict[int, str]) -> bool:
+    """Whether a model with these class names detects garments rather than whole people"""
+    return any(category != 'person' for category, _ in detection_classes(names).values())
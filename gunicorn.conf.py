@@ -0,0 +1,50 @@
+"""
+Gunicorn configuration for the AI Clothing Detection API
+
+Models are loaded once in the master (preload_app) and shared with the
+workers copy-on-write after fork. Every setting can be overridden from the
+environment, e.g. WEB_CONCURRENCY=2 GUNICORN_THREADS=4.
+"""
+
+import os
+from serving import available_cpus, inference_limits
+
+cpus = available_cpus()
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+# CPU inference: a few processes, each using several cores through torch
+workers = int(os.environ.get('WEB_CONCURRENCY', max(1, min(4, cpus // 2))))
+worker_class = 'gthread'
+# One thread per inference slot and queue place, plus one that answers 503s and
+# health checks; app.py sizes the queue from GUNICORN_THREADS when it is set
+max_concurrent, max_queued = inference_limits()
+threads = int(os.environ.get('GUNICORN_THREADS', max_concurrent + max_queued + 1))
+
+# Model inference on large images can take a while on small containers
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+graceful_timeout = 30
+keepalive = 5
+
+# Load YOLO/SAM before forking so workers share the weights. The models then
+# load synchronously in the master and warm up in each worker after fork,
+# so no inference thread pools exist before forking.
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+if preload_app:
+    os.environ['DRESSAPP_PRELOADED'] = '1'
+
+accesslog = '-'
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    """Split the available cores between workers, then warm up the preloaded models"""
+    import torch
+
+    torch_threads = int(os.environ.get('TORCH_NUM_THREADS', max(1, cpus // workers)))
+    torch.set_num_threads(torch_threads)
+    server.log.info(f"Worker {worker.pid} using {torch_threads} torch threads")
+
+    if preload_app and os.environ.get('MODEL_WARMUP', '1') == '1':
+        from app import detector
+        detector.warm_up()
@@ -0,0 +1,140 @@
+"""
+Dynamic micro-batching of concurrent single-image detection requests
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, Tuple
+
+import numpy as np
+
+from metrics import StageTimer
+
+
+# Upper bounds (ms) of the queue-wait histogram buckets; the last bucket is open-ended
+QUEUE_WAIT_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 250, 500, 1000)
+
+
+class MicroBatchScheduler:
+    """Collect requests arriving within a short window and run them as one batch.
+
+    The first request to arrive opens a window of ``window_ms``; everything
+    submitted before it closes (up to ``max_batch_size`` images) goes
+    through a single ``ClothingDetector.detect_batch`` call. Each caller
+    blocks only on its own Future, so latency is bounded by the window plus
+    the batch's inference time.
+    """
+
+    def __init__(self, detector, window_ms: float = 15, max_batch_size: int = 8):
+        self.detector = detector
+        self.window = window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.batches = 0
+        self.requests = 0
+        self.batch_sizes = {}
+        self.queue_wait_ms = [0] * (len(QUEUE_WAIT_BUCKETS_MS) + 1)
+        self.queue_wait_ms_sum = 0.0
+
+    def submit(self, image_array: np.ndarray, use_cache: bool = True, timer: StageTimer = None,
+               original_size: Tuple[int, int] = None) -> Future:
+        """Queue one image; the Future resolves to a detect_clothing_from_array-style dict.
+
+        If a timer is given it receives the request's queue wait plus the
+        stage timings of the batch it ran in.
+        """
+        self._ensure_started()
+        future = Future()
+        self._queue.put((image_array, use_cache, timer, future, time.monotonic(), original_size))
+        return future
+
+    def detect(self, image_array: np.ndarray, use_cache: bool = True, timer: StageTimer = None,
+               timeout: float = None, original_size: Tuple[int, int] = None) -> Dict[str, Any]:
+        """Blocking convenience wrapper around submit"""
+        return self.submit(image_array, use_cache, timer, original_size).result(timeout=timeout)
+
+    def _ensure_started(self):
+        # Started lazily so the thread lives in the process that serves requests (after fork)
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='micro-batch-scheduler', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self._process(batch)
+
+    def _process(self, batch):
+        started = time.monotonic()
+        waits = [started - enqueued for _, _, _, _, enqueued, _ in batch]
+        self._record(len(batch), waits)
+
+        # detect_batch takes one cache flag, so run bypassing requests separately
+        for use_cache in (True, False):
+            selected = [i for i, item in enumerate(batch) if item[1] == use_cache]
+            if not selected:
+                continue
+            group = [batch[i] for i in selected]
+            group_waits = [waits[i] for i in selected]
+            batch_timer = StageTimer()
+            try:
+                results = self.detector.detect_batch(
+                    [image for image, _, _, _, _, _ in group], use_cache=use_cache, timer=batch_timer,
+                    original_sizes=[original_size for _, _, _, _, _, original_size in group]
+                )
+                for (_, _, timer, future, _, _), wait, result in zip(group, group_waits, results):
+                    if timer is not None:
+                        timer.add('queue_wait', wait)
+                        timer.merge(batch_timer)
+                    future.set_result(result)
+            except Exception as e:
+                for _, _, _, future, _, _ in group:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _record(self, batch_size: int, waits):
+        with self._stats_lock:
+            self.batches += 1
+            self.requests += batch_size
+            self.batch_sizes[batch_size] = self.batch_sizes.get(batch_size, 0) + 1
+            for wait in waits:
+                wait_ms = wait * 1000.0
+                self.queue_wait_ms_sum += wait_ms
+                bucket = next(
+                    (i for i, bound in enumerate(QUEUE_WAIT_BUCKETS_MS) if wait_ms <= bound),
+                    len(QUEUE_WAIT_BUCKETS_MS)
+                )
+                self.queue_wait_ms[bucket] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Batch-size and queue-wait histograms"""
+        with self._stats_lock:
+            labels = [f"le_{bound}" for bound in QUEUE_WAIT_BUCKETS_MS] + ['le_inf']
+            return {
+                'window_ms': self.window * 1000.0,
+                'max_batch_size': self.max_batch_size,
+                'batches': self.batches,
+                'requests': self.requests,
+                'queued': self._queue.qsize(),
+                'mean_batch_size': self.requests / self.batches if self.batches else 0.0,
+                'batch_size_histogram': dict(sorted(self.batch_sizes.items())),
+                'queue_wait_ms_histogram': dict(zip(labels, self.queue_wait_ms)),
+                'queue_wait_ms_sum': self.queue_wait_ms_sum,
+                'mean_queue_wait_ms': self.queue_wait_ms_sum / self.requests if self.requests else 0.0
+            }
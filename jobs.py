@@ -0,0 +1,455 @@
+#!/usr/bin/env python3
+"""
+Asynchronous bulk analysis jobs backed by a local SQLite queue
+
+The web app only records uploads (POST /jobs) and reads progress
+(GET /jobs/<id>). A separate worker process loads the models once and
+forks a pool of workers that share them copy-on-write and drain the
+queue:
+
+    python jobs.py --processes 2
+
+Jobs live in the SQLite file (JOB_DB_PATH, default jobs.db), so queued
+and partially finished jobs survive restarts of both processes.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    total INTEGER NOT NULL DEFAULT 0,
+    completed INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    use_cache INTEGER NOT NULL DEFAULT 1,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS items (
+    job_id TEXT NOT NULL REFERENCES jobs(id) ON DELETE CASCADE,
+    idx INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    image BLOB,
+    error TEXT,
+    result TEXT,
+    worker TEXT,
+    claimed REAL,
+    PRIMARY KEY (job_id, idx)
+);
+CREATE INDEX IF NOT EXISTS items_queue ON items (status, job_id, idx);
+"""
+
+
+class JobStore:
+    """Persistent job queue; safe to share between threads and processes.
+
+    Connections are opened per thread and reopened after fork, since
+    SQLite connections must not cross either boundary.
+    """
+
+    def __init__(self, path: str = 'jobs.db'):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        if getattr(self._local, 'pid', None) != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA foreign_keys=ON')
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return self._local.db
+
+    def create_job(self, images: Iterable[Tuple[Optional[bytes], Optional[str]]],
+                   use_cache: bool = True, group_size: int = 8) -> Dict[str, Any]:
+        """Store an upload as a new job; images are (image_bytes, error) pairs.
+
+        Items are written as they come from the iterable, so a streamed
+        upload is never held in memory as a whole. Invalid items are stored
+        as failed so indices match the upload order.
+
+        The write lock is only taken for short transactions of up to
+        ``group_size`` items, never while waiting on the client, so workers
+        and other uploads keep going. The job stays 'uploading' (and is not
+        claimed) until the last item is stored.
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        db = self._connect()
+        db.execute(
+            'INSERT INTO jobs (id, status, use_cache, created, updated) VALUES (?, ?, ?, ?, ?)',
+            (job_id, 'uploading', int(use_cache), now, now)
+        )
+
+        total = 0
+        failed = 0
+        group = []
+        try:
+            for index, (image_bytes, error) in enumerate(images):
+                group.append((index, image_bytes, error))
+                failed += error is not None
+                total += 1
+                if len(group) >= group_size:
+                    self._insert_items(db, job_id, group)
+                    group = []
+            self._insert_items(db, job_id, group)
+        except BaseException:
+            # Drop the partial upload (its items go with it)
+            db.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+            raise
+
+        status = 'done' if failed == total else 'queued'
+        db.execute(
+            'UPDATE jobs SET total = ?, failed = ?, status = ?, updated = ? WHERE id = ?',
+            (total, failed, status, time.time(), job_id)
+        )
+        return self.get_job(job_id, include_results=False)
+
+    @staticmethod
+    def _insert_items(db: sqlite3.Connection, job_id: str, group: List[tuple]):
+        """Write (index, image_bytes, error) items of an uploading job in one short transaction"""
+        if not group:
+            return
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            for index, image_bytes, error in group:
+                if error is None:
+                    db.execute(
+                        'INSERT INTO items (job_id, idx, status, image) VALUES (?, ?, ?, ?)',
+                        (job_id, index, 'queued', sqlite3.Binary(image_bytes))
+                    )
+                else:
+                    db.execute(
+                        'INSERT INTO items (job_id, idx, status, error) VALUES (?, ?, ?, ?)',
+                        (job_id, index, 'failed', error)
+                    )
+            # Keeps a live upload from looking abandoned to purge()
+            db.execute('UPDATE jobs SET updated = ? WHERE id = ?', (time.time(), job_id))
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+    def claim_items(self, worker: str, limit: int = 1) -> List[Dict[str, Any]]:
+        """Atomically take up to ``limit`` queued items, oldest job first"""
+        db = self._connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            rows = db.execute(
+                'SELECT items.job_id, items.idx, items.image, jobs.use_cache FROM items '
+                'JOIN jobs ON jobs.id = items.job_id '
+                "WHERE items.status = 'queued' AND jobs.status != 'uploading' "
+                'ORDER BY jobs.created, items.idx LIMIT ?',
+                (limit,)
+            ).fetchall()
+            now = time.time()
+            for row in rows:
+                db.execute(
+                    "UPDATE items SET status = 'running', worker = ?, claimed = ? WHERE job_id = ? AND idx = ?",
+                    (worker, now, row['job_id'], row['idx'])
+                )
+                db.execute(
+                    "UPDATE jobs SET status = 'running', updated = ? WHERE id = ? AND status = 'queued'",
+                    (now, row['job_id'])
+                )
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+        return [
+            {'job_id': row['job_id'], 'index': row['idx'], 'image': bytes(row['image']),
+             'use_cache': bool(row['use_cache'])}
+            for row in rows
+        ]
+
+    def complete_item(self, job_id: str, index: int, result: Dict[str, Any]):
+        """Store an item's detection result, drop its image and update the job's progress"""
+        db = self._connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            changed = db.execute(
+                "UPDATE items SET status = 'done', result = ?, image = NULL "
+                "WHERE job_id = ? AND idx = ? AND status = 'running'",
+                (json.dumps(result), job_id, index)
+            ).rowcount
+            # A requeued item finished by two workers only counts once
+            if changed:
+                db.execute(
+                    'UPDATE jobs SET completed = completed + 1, updated = ?, '
+                    "status = CASE WHEN completed + failed + 1 >= total THEN 'done' ELSE status END "
+                    'WHERE id = ?',
+                    (time.time(), job_id)
+                )
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+    def fail_item(self, job_id: str, index: int, error: str):
+        """Mark a running item failed with ``error``, drop its image and update the job's progress"""
+        db = self._connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            changed = db.execute(
+                "UPDATE items SET status = 'failed', error = ?, image = NULL "
+                "WHERE job_id = ? AND idx = ? AND status = 'running'",
+                (error, job_id, index)
+            ).rowcount
+            if changed:
+                db.execute(
+                    'UPDATE jobs SET failed = failed + 1, updated = ?, '
+                    "status = CASE WHEN completed + failed + 1 >= total THEN 'done' ELSE status END "
+                    'WHERE id = ?',
+                    (time.time(), job_id)
+                )
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+    def requeue(self, worker: str = None, older_than: float = None) -> int:
+        """Return running items to the queue: all of them, one worker's, or stale ones"""
+        query = "UPDATE items SET status = 'queued', worker = NULL, claimed = NULL WHERE status = 'running'"
+        params = []
+        if worker is not None:
+            query += ' AND worker = ?'
+            params.append(worker)
+        if older_than is not None:
+            query += ' AND claimed < ?'
+            params.append(time.time() - older_than)
+        return self._connect().execute(query, params).rowcount
+
+    def purge(self, older_than: float) -> int:
+        """Delete finished jobs, and uploads abandoned by a crash, not updated for ``older_than`` seconds"""
+        return self._connect().execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'uploading') AND updated < ?",
+            (time.time() - older_than,)
+        ).rowcount
+
+    def get_job(self, job_id: str, include_results: bool = True,
+                offset: int = 0, limit: int = None) -> Optional[Dict[str, Any]]:
+        """Progress plus the results finished so far (ordered by index), or None"""
+        db = self._connect()
+        # One read transaction so progress and results come from the same snapshot
+        db.execute('BEGIN')
+        try:
+            return self._read_job(db, job_id, include_results, offset, limit)
+        finally:
+            db.execute('COMMIT')
+
+    def _read_job(self, db: sqlite3.Connection, job_id: str, include_results: bool,
+                  offset: int, limit: Optional[int]) -> Optional[Dict[str, Any]]:
+        job = db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if job is None:
+            return None
+
+        finished = job['completed'] + job['failed']
+        payload = {
+            'job_id': job['id'],
+            'status': job['status'],
+            'total': job['total'],
+            'completed': job['completed'],
+            'failed': job['failed'],
+            'progress': finished / job['total'] if job['total'] else float(job['status'] == 'done'),
+            'created': job['created'],
+            'updated': job['updated']
+        }
+
+        if include_results:
+            rows = db.execute(
+                "SELECT idx, status, error, result FROM items WHERE job_id = ? AND status IN ('done', 'failed') "
+                'AND idx >= ? ORDER BY idx LIMIT ?',
+                (job_id, offset, -1 if limit is None else limit)
+            ).fetchall()
+            payload['results'] = [
+                {'index': row['idx'], 'success': True, 'detection': json.loads(row['result'])}
+                if row['result'] is not None else
+                {'index': row['idx'], 'success': False, 'error': row['error']}
+                for row in rows
+            ]
+        return payload
+
+    def stats(self) -> Dict[str, int]:
+        rows = self._connect().execute('SELECT status, COUNT(*) AS n FROM items GROUP BY status').fetchall()
+        return {row['status']: row['n'] for row in rows}
+
+
+class JobWorkerPool:
+    """Pre-forked worker processes draining a JobStore with one shared detector.
+
+    The detector's models are loaded once in the parent; workers are forked
+    afterwards and share the weights copy-on-write. The parent restarts
+    workers that die, returns their claimed items to the queue, and
+    requeues items claimed longer than ``stale_after`` seconds.
+    """
+
+    def __init__(self, store: JobStore, detector, processes: int = 2, batch_size: int = 4,
+                 poll_interval: float = 1.0, stale_after: float = 600, retention: float = 7 * 24 * 3600):
+        self.store = store
+        self.detector = detector
+        self.processes = processes
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.retention = retention
+        self.workers = {}
+        self._supervisor = f"{os.uname().nodename}:{os.getpid()}"
+        self._stop = threading.Event()
+        self._context = multiprocessing.get_context('fork')
+
+    def run(self):
+        """Supervise the workers until SIGTERM/SIGINT"""
+        signal.signal(signal.SIGTERM, lambda *_: self._stop.set())
+        signal.signal(signal.SIGINT, lambda *_: self._stop.set())
+
+        # Anything still marked running was interrupted by the last shutdown
+        requeued = self.store.requeue()
+        if requeued:
+            print(f"♻️ Requeued {requeued} interrupted items")
+
+        for slot in range(self.processes):
+            self._spawn(slot)
+
+        while not self._stop.wait(self.poll_interval * 5):
+            for slot, process in list(self.workers.items()):
+                if not process.is_alive():
+                    requeued = self.store.requeue(worker=self._worker_name(slot))
+                    print(f"⚠️ Job worker {slot} exited ({process.exitcode}), requeued {requeued} items")
+                    self._spawn(slot)
+            self.store.requeue(older_than=self.stale_after)
+            self.store.purge(self.retention)
+
+        print("🛑 Stopping job workers...")
+        for process in self.workers.values():
+            process.terminate()
+        for process in self.workers.values():
+            process.join(timeout=60)
+
+    def _worker_name(self, slot: int) -> str:
+        return f"{self._supervisor}:{slot}"
+
+    def _spawn(self, slot: int):
+        process = self._context.Process(target=self._work, args=(slot,), name=f"job-worker-{slot}", daemon=True)
+        process.start()
+        self.workers[slot] = process
+
+    def _work(self, slot: int):
+        """Worker process: claim a few items, run them as one batch, store the results"""
+        import torch
+        from serving import available_cpus
+
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: stop.set())
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        torch.set_num_threads(max(1, available_cpus() // self.processes))
+        worker = self._worker_name(slot)
+
+        while not stop.is_set():
+            try:
+                items = self.store.claim_items(worker, limit=self.batch_size)
+            except sqlite3.OperationalError as e:
+                print(f"⚠️ Job worker {slot} could not claim items: {e}")
+                stop.wait(self.poll_interval)
+                continue
+            if not items:
+                stop.wait(self.poll_interval)
+                continue
+
+            try:
+                results = self._analyze(items)
+            except Exception:
+                # Analyze one at a time so a single bad item can't fail its whole batch
+                results = [self._analyze_alone(item) for item in items]
+            for item, result in zip(items, results):
+                self._finish(item, result)
+
+    def _analyze_alone(self, item: Dict[str, Any]) -> Any:
+        """Result of one item, or the exception its analysis raised"""
+        try:
+            return self._analyze([item])[0]
+        except Exception as e:
+            return e
+
+    def _finish(self, item: Dict[str, Any], result: Any):
+        """Store an item's result, or mark it failed; never raises, so the worker keeps looping"""
+        try:
+            if isinstance(result, Exception):
+                self.store.fail_item(item['job_id'], item['index'], f"Analysis failed: {result}")
+            else:
+                self.store.complete_item(item['job_id'], item['index'], result)
+        except Exception as e:
+            print(f"⚠️ Could not store item {item['index']} of job {item['job_id']}: {e}")
+            try:
+                self.store.fail_item(item['job_id'], item['index'], f"Could not store result: {e}")
+            except Exception:
+                # Still claimed; the supervisor requeues it once it goes stale
+                pass
+
+    def _analyze(self, items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        results = [None] * len(items)
+        arrays = []
+        sizes = []
+        positions = []
+        for i, item in enumerate(items):
+            try:
+                image_array, original_size = self.detector.decode_for_analysis(item['image'])
+                arrays.append(image_array)
+                sizes.append(original_size)
+                positions.append(i)
+            except ValueError as e:
+                results[i] = {
+                    'success': False,
+                    'error': str(e),
+                    'detections': []
+                }
+
+        # detect_batch takes one cache flag for the whole batch
+        for use_cache in (True, False):
+            selected = [j for j, i in enumerate(positions) if items[i]['use_cache'] == use_cache]
+            if not selected:
+                continue
+            detections = self.detector.detect_batch(
+                [arrays[j] for j in selected], use_cache=use_cache,
+                original_sizes=[sizes[j] for j in selected]
+            )
+            for j, detection in zip(selected, detections):
+                results[positions[j]] = detection
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the bulk analysis job workers')
+    parser.add_argument('--db', default=os.environ.get('JOB_DB_PATH', 'jobs.db'), help='SQLite job database')
+    parser.add_argument('--processes', type=int, default=int(os.environ.get('JOB_WORKERS', 2)),
+                        help='Worker processes sharing the preloaded models')
+    parser.add_argument('--batch-size', type=int, default=int(os.environ.get('JOB_BATCH_SIZE', 4)),
+                        help='Images claimed and analyzed together per worker')
+    args = parser.parse_args()
+
+    # Same configuration as the web app; models load here so every forked worker shares them
+    from dotenv import load_dotenv
+    from detector_config import detector_from_env, result_cache_from_env
+    load_dotenv()
+    detector = detector_from_env(result_cache=result_cache_from_env())
+    detector.load_models()
+
+    print(f"🚀 Starting {args.processes} job workers on {args.db}")
+    JobWorkerPool(JobStore(args.db), detector, processes=args.processes, batch_size=args.batch_size).run()
+
+
+if __name__ == '__main__':
+    main()
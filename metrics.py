@@ -0,0 +1,132 @@
+"""
+Per-stage latency instrumentation for the detection pipeline
+"""
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Iterable, Sequence, Tuple
+
+import numpy as np
+
+
+class StageTimer:
+    """Accumulates wall-clock time per pipeline stage for one request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.timings = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def merge(self, other: 'StageTimer'):
+        """Add another timer's stages (e.g. a shared batch) to this request"""
+        for name, seconds in other.timings.items():
+            self.add(name, seconds)
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def as_ms(self) -> Dict[str, float]:
+        timings = {name: round(seconds * 1000.0, 3) for name, seconds in self.timings.items()}
+        timings['total'] = round(self.elapsed() * 1000.0, 3)
+        return timings
+
+
+class NullTimer(StageTimer):
+    """Timer that records nothing, used when the caller doesn't pass one"""
+
+    @contextmanager
+    def stage(self, name: str):
+        yield
+
+    def add(self, name: str, seconds: float):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class StageMetrics:
+    """Rolling per-stage latency summaries, exported in Prometheus text format.
+
+    Quantiles are computed over the last ``window`` observations of each
+    stage; ``_sum`` and ``_count`` cover the whole process lifetime.
+    """
+
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self, window: int = 2048, name: str = 'dressapp_stage_latency_seconds'):
+        self.window = window
+        self.name = name
+        self._samples = {}
+        self._sums = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def observe(self, timer: StageTimer):
+        """Record every stage of a finished request, plus its total time"""
+        stages = list(timer.timings.items()) + [('total', timer.elapsed())]
+        with self._lock:
+            for stage, seconds in stages:
+                if stage not in self._samples:
+                    self._samples[stage] = deque(maxlen=self.window)
+                    self._sums[stage] = 0.0
+                    self._counts[stage] = 0
+                self._samples[stage].append(seconds)
+                self._sums[stage] += seconds
+                self._counts[stage] += 1
+
+    def prometheus_text(self, gauges: Iterable[Tuple[str, str, float]] = (),
+                        counters: Iterable[Tuple[str, str, float]] = (),
+                        histograms: Iterable[Tuple[str, str, Sequence[Tuple[float, int]], float]] = ()) -> str:
+        """Render the stage summaries plus optional extra series.
+
+        ``gauges`` and ``counters`` are (name, help, value); ``histograms``
+        are (name, help, [(upper bound, count in that bucket), ...], sum)
+        with per-bucket counts, the last bound being infinity.
+        """
+        with self._lock:
+            snapshot = {stage: np.array(samples) for stage, samples in self._samples.items()}
+            sums = dict(self._sums)
+            counts = dict(self._counts)
+
+        lines = [
+            f"# HELP {self.name} Latency of each detection pipeline stage per request",
+            f"# TYPE {self.name} summary"
+        ]
+        for stage, samples in sorted(snapshot.items()):
+            for quantile, value in zip(self.QUANTILES, np.quantile(samples, self.QUANTILES)):
+                lines.append(f'{self.name}{{stage="{stage}",quantile="{quantile}"}} {value:.6f}')
+            lines.append(f'{self.name}_sum{{stage="{stage}"}} {sums[stage]:.6f}')
+            lines.append(f'{self.name}_count{{stage="{stage}"}} {counts[stage]}')
+
+        for metric_type, series in (('gauge', gauges), ('counter', counters)):
+            for name, help_text, value in series:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                lines.append(f"{name} {value}")
+
+        for name, help_text, buckets, total in histograms:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            # Prometheus buckets are cumulative
+            cumulative = 0
+            for bound, count in buckets:
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                lines.append(f'{name}_bucket{{le="{le}"}} {cumulative}')
+            lines.append(f"{name}_sum {total:.6f}")
+            lines.append(f"{name}_count {cumulative}")
+
+        return "\n".join(lines) + "\n"
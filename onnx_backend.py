@@ -0,0 +1,223 @@
+"""
+ONNX Runtime inference backend for YOLO and the SAM image encoder
+
+Artifacts are produced once by export_models.py and live next to the
+PyTorch weights: ``yolov8n.onnx`` for ``yolov8n.pt`` and
+``sam_vit_b_encoder.onnx`` for ``sam_vit_b.pth``, plus
+``sam_vit_b_encoder.int8.onnx`` when exported with --quantize.
+"""
+
+import ast
+import os
+import threading
+from typing import Dict, List, Optional
+
+import cv2
+import numpy as np
+import torch
+from segment_anything import SamPredictor
+
+from serving import default_threads
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+
+def yolo_onnx_path(weights: str, quantized: bool = False) -> str:
+    return os.path.splitext(weights)[0] + ('.int8.onnx' if quantized else '.onnx')
+
+
+def sam_encoder_onnx_path(checkpoint: str, quantized: bool = False) -> str:
+    return os.path.splitext(checkpoint)[0] + ('_encoder.int8.onnx' if quantized else '_encoder.onnx')
+
+
+def find_artifact(paths: List[str]) -> Optional[str]:
+    """First existing path, e.g. the quantized artifact before the float one"""
+    return next((path for path in paths if os.path.exists(path)), None)
+
+
+def onnx_available() -> bool:
+    return ort is not None
+
+
+class LazySession:
+    """ONNX Runtime session created on first use.
+
+    ORT thread pools don't survive fork, so sessions must not exist in the
+    gunicorn master; creating them lazily puts them in the worker that runs
+    inference. ``threads=None`` uses default_threads() at creation time.
+    ``arena=False`` returns activation memory after each run instead of
+    keeping the peak allocated (SAM's encoder peaks at several GB).
+    """
+
+    def __init__(self, path: str, threads: int = None, arena: bool = True):
+        if ort is None:
+            raise ImportError('onnxruntime is not installed')
+        self.path = path
+        self.threads = threads
+        self.arena = arena
+        self._session = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    options = ort.SessionOptions()
+                    options.intra_op_num_threads = self.threads or default_threads()
+                    options.inter_op_num_threads = 1
+                    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+                    options.enable_cpu_mem_arena = self.arena
+                    options.enable_mem_pattern = self.arena
+                    self._session = ort.InferenceSession(
+                        self.path, sess_options=options, providers=['CPUExecutionProvider']
+                    )
+        return self._session
+
+    def run(self, inputs: np.ndarray) -> np.ndarray:
+        session = self.session
+        return session.run(None, {session.get_inputs()[0].name: inputs})[0]
+
+
+class OnnxBoxes:
+    """Detections of one image, shaped like ultralytics' Boxes (iterable, tensor attributes)"""
+
+    def __init__(self, xyxy: torch.Tensor, cls: torch.Tensor, conf: torch.Tensor):
+        self.xyxy = xyxy
+        self.cls = cls
+        self.conf = conf
+
+    def __len__(self):
+        return len(self.cls)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield OnnxBoxes(self.xyxy[i:i + 1], self.cls[i:i + 1], self.conf[i:i + 1])
+
+
+class OnnxResult:
+    def __init__(self, boxes: OnnxBoxes, names: Dict[int, str]):
+        self.boxes = boxes
+        self.names = names
+
+
+class OnnxYOLO:
+    """YOLOv8 detector running an exported ONNX graph with ultralytics-compatible results.
+
+    Pre- and post-processing follow ultralytics' predictor: numpy input is
+    treated as BGR, letterboxed to ``imgsz`` with gray padding, and boxes go
+    through class-aware NMS (conf 0.25, IoU 0.7) before being mapped back.
+    """
+
+    def __init__(self, path: str, imgsz: int = 640, threads: int = None,
+                 conf: float = 0.25, iou: float = 0.7, max_det: int = 300):
+        self.path = path
+        self._names = None
+        self.imgsz = imgsz
+        self.conf = conf
+        self.iou = iou
+        self.max_det = max_det
+        self.session = LazySession(path, threads)
+
+    @property
+    def names(self) -> Dict[int, str]:
+        """Class names from the metadata ultralytics writes into the export"""
+        if self._names is None:
+            metadata = self.session.session.get_modelmeta().custom_metadata_map
+            self._names = ast.literal_eval(metadata['names']) if 'names' in metadata else {0: 'person'}
+        return self._names
+
+    def predict(self, source, **kwargs) -> List[OnnxResult]:
+        images = source if isinstance(source, list) else [source]
+        batch, transforms = zip(*(self.preprocess(image) for image in images))
+        outputs = self.session.run(np.stack(batch))
+        return [
+            self.postprocess(output, transform, image.shape[:2])
+            for output, transform, image in zip(outputs, transforms, images)
+        ]
+
+    def preprocess(self, image: np.ndarray):
+        """Letterbox one image to a CHW float tensor; returns (tensor, (gain, left, top))"""
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        height, width = image.shape[:2]
+        gain = min(self.imgsz / height, self.imgsz / width)
+        new_width, new_height = int(round(width * gain)), int(round(height * gain))
+        pad_x, pad_y = (self.imgsz - new_width) / 2, (self.imgsz - new_height) / 2
+
+        if (new_width, new_height) != (width, height):
+            image = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+        top, bottom = int(round(pad_y - 0.1)), int(round(pad_y + 0.1))
+        left, right = int(round(pad_x - 0.1)), int(round(pad_x + 0.1))
+        image = cv2.copyMakeBorder(image, top, bottom, left, right, cv2.BORDER_CONSTANT, value=(114, 114, 114))
+
+        tensor = np.ascontiguousarray(image[:, :, ::-1].transpose(2, 0, 1), dtype=np.float32) / 255.0
+        # Offsets used to map boxes back, computed like ultralytics' scale_boxes
+        offset_x = round((self.imgsz - width * gain) / 2 - 0.1)
+        offset_y = round((self.imgsz - height * gain) / 2 - 0.1)
+        return tensor, (gain, offset_x, offset_y)
+
+    def postprocess(self, output: np.ndarray, transform, shape) -> OnnxResult:
+        """NMS on one (4 + classes, anchors) output and map boxes to the input image"""
+        predictions = output.T
+        scores = predictions[:, 4:]
+        cls = scores.argmax(axis=1)
+        conf = scores[np.arange(len(scores)), cls]
+        keep = conf > self.conf
+        centers, cls, conf = predictions[keep, :4], cls[keep], conf[keep]
+
+        xyxy = np.empty_like(centers)
+        xyxy[:, :2] = centers[:, :2] - centers[:, 2:] / 2
+        xyxy[:, 2:] = centers[:, :2] + centers[:, 2:] / 2
+
+        if len(xyxy):
+            xywh = np.concatenate([xyxy[:, :2], centers[:, 2:]], axis=1)
+            indices = cv2.dnn.NMSBoxesBatched(xywh.tolist(), conf.tolist(), cls.tolist(), self.conf, self.iou)
+            indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+            # Highest confidence first, like ultralytics
+            indices = indices[np.argsort(-conf[indices], kind='stable')][:self.max_det]
+            xyxy, cls, conf = xyxy[indices], cls[indices], conf[indices]
+
+        gain, offset_x, offset_y = transform
+        xyxy[:, [0, 2]] = ((xyxy[:, [0, 2]] - offset_x) / gain).clip(0, shape[1])
+        xyxy[:, [1, 3]] = ((xyxy[:, [1, 3]] - offset_y) / gain).clip(0, shape[0])
+
+        return OnnxResult(
+            OnnxBoxes(torch.from_numpy(xyxy), torch.from_numpy(cls.astype(np.float32)), torch.from_numpy(conf)),
+            self.names
+        )
+
+
+class _EncoderPlaceholder(torch.nn.Module):
+    """Stands in for SAM's ViT encoder once it runs in ONNX Runtime; preprocessing only needs img_size"""
+
+    def __init__(self, img_size: int):
+        super().__init__()
+        self.img_size = img_size
+
+
+class OnnxSamPredictor(SamPredictor):
+    """SamPredictor whose image embedding comes from an exported encoder.
+
+    The prompt encoder and mask decoder are small and stay in PyTorch; the
+    ViT encoder's weights are released from the torch model.
+    """
+
+    def __init__(self, sam_model, encoder_path: str, threads: int = None):
+        sam_model.image_encoder = _EncoderPlaceholder(sam_model.image_encoder.img_size)
+        super().__init__(sam_model)
+        self.encoder = LazySession(encoder_path, threads, arena=False)
+
+    @torch.no_grad()
+    def set_torch_image(self, transformed_image: torch.Tensor, original_image_size) -> None:
+        self.reset_image()
+
+        self.original_size = original_image_size
+        self.input_size = tuple(transformed_image.shape[-2:])
+        input_image = self.model.preprocess(transformed_image)
+        features = self.encoder.run(input_image.cpu().numpy().astype(np.float32))
+        self.features = torch.from_numpy(features).to(self.device)
+        self.is_image_set = True
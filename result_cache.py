@@ -0,0 +1,197 @@
+"""
+Content-addressed cache for detection results
+"""
+
+import copy
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+
+class ResultCache:
+    """Bounded in-memory LRU of detection results with an optional disk tier.
+
+    Keys are derived from the decoded image bytes plus a detector
+    configuration string (see ``make_key``), so identical uploads hit the
+    cache no matter how they were encoded on the wire. Results must be
+    JSON-serializable; callers always get their own deep copy.
+
+    The disk tier is bounded by ``disk_max_bytes`` and ``disk_max_entries``
+    (0 = unbounded). Disk hits refresh a file's mtime; once a bound is
+    exceeded, the least recently used files are deleted until usage is
+    back under 90% of it. Several processes may share the directory: each
+    tracks its own writes and re-scans the directory every
+    ``disk_rescan_every`` writes, so the bounds hold approximately.
+    """
+
+    def __init__(self, max_entries: int = 256, disk_dir: Optional[str] = None,
+                 disk_max_bytes: int = 1024 * 2 ** 20, disk_max_entries: int = 100_000,
+                 disk_rescan_every: int = 1000):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.disk_max_entries = disk_max_entries
+        self.disk_rescan_every = disk_rescan_every
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_bytes = 0
+        self.disk_entries = 0
+        self.disk_evictions = 0
+        self._writes_since_scan = 0
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            with self._disk_lock:
+                self._sync_disk()
+
+    @staticmethod
+    def make_key(image: np.ndarray, config: str) -> str:
+        """Hash the image pixels, shape and dtype together with the detector config"""
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(config.encode('utf-8'))
+        digest.update(str((image.shape, image.dtype.str)).encode('utf-8'))
+        digest.update(memoryview(np.ascontiguousarray(image)).cast('B'))
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Return a copy of the cached result, or None on a miss"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return copy.deepcopy(self._entries[key])
+
+        result = self._read_disk(key)
+
+        with self._lock:
+            if result is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, result)
+            return copy.deepcopy(result)
+
+    def put(self, key: str, result: Dict[str, Any]):
+        """Store a result in memory and, if configured, on disk"""
+        result = copy.deepcopy(result)
+        with self._lock:
+            self._remember(key, result)
+        self._write_disk(key, result)
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters for the health endpoint"""
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'disk_dir': self.disk_dir,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                'disk_bytes': self.disk_bytes,
+                'disk_entries': self.disk_entries,
+                'disk_evictions': self.disk_evictions
+            }
+
+    def _remember(self, key: str, result: Dict[str, Any]):
+        """Insert into the LRU; caller holds the lock"""
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], f"{key}.json")
+
+    def _read_disk(self, key: str) -> Optional[Dict[str, Any]]:
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                result = json.load(f)
+        except (OSError, ValueError):
+            return None
+        try:
+            # Recently used entries are evicted last
+            os.utime(path)
+        except OSError:
+            pass
+        return result
+
+    def _write_disk(self, key: str, result: Dict[str, Any]):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        tmp_path = None
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temp file and rename so readers never see partial JSON
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(result, f)
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+        except (OSError, TypeError, ValueError) as e:
+            print(f"⚠️ Could not write result cache entry: {e}")
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        with self._disk_lock:
+            self.disk_bytes += size
+            self.disk_entries += 1
+            self._writes_since_scan += 1
+            if self._over_disk_limit(1.0) or self._writes_since_scan >= self.disk_rescan_every:
+                self._sync_disk()
+
+    def _over_disk_limit(self, fraction: float) -> bool:
+        return bool((self.disk_max_bytes and self.disk_bytes > self.disk_max_bytes * fraction) or
+                    (self.disk_max_entries and self.disk_entries > self.disk_max_entries * fraction))
+
+    def _sync_disk(self):
+        """Recount the disk tier (other processes write to it too) and evict oldest-first if over a bound.
+
+        Caller holds the disk lock.
+        """
+        files = []
+        for shard in os.scandir(self.disk_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith('.json'):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+        self.disk_bytes = sum(size for _, size, _ in files)
+        self.disk_entries = len(files)
+        self._writes_since_scan = 0
+        if not self._over_disk_limit(1.0):
+            return
+
+        files.sort()
+        for _, size, path in files:
+            if not self._over_disk_limit(0.9):
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # Already evicted by another process
+                pass
+            self.disk_bytes -= size
+            self.disk_entries -= 1
+            self.disk_evictions += 1
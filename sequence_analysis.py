@@ -0,0 +1,313 @@
+"""
+Video and burst analysis with temporal result reuse
+
+Frames of a clip or photo burst are analyzed in order and every detection
+is linked to a track by box overlap with the previous frame. Work done
+for a track is reused while it changes little:
+
+- a frame that barely differs from the last analyzed one skips every model
+- a detection whose box and pixels barely moved keeps its colors
+- one that moved a little keeps its (resized) mask and warm-starts color
+  clustering from the track's previous centers
+- only new or heavily changed detections are segmented from scratch
+
+Each track reports colors aggregated over all of its frames.
+"""
+
+import itertools
+import os
+import tempfile
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from metrics import StageTimer, NULL_TIMER
+from pipeline import clip_box, describe_colors, format_colors
+
+# Side of the grayscale thumbnails frames and crops are compared on
+THUMBNAIL_SIDE = 32
+
+
+def box_iou(a, b) -> float:
+    """Intersection over union of two xyxy boxes"""
+    x1, y1 = max(a[0], b[0]), max(a[1], b[1])
+    x2, y2 = min(a[2], b[2]), min(a[3], b[3])
+    intersection = max(0.0, x2 - x1) * max(0.0, y2 - y1)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return float(intersection / union) if union > 0 else 0.0
+
+
+def thumbnail(image: np.ndarray) -> np.ndarray:
+    """Small grayscale copy for cheap change detection"""
+    gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY) if image.ndim == 3 else image
+    return cv2.resize(gray, (THUMBNAIL_SIDE, THUMBNAIL_SIDE), interpolation=cv2.INTER_AREA).astype(np.int16)
+
+
+def change(a: Optional[np.ndarray], b: np.ndarray) -> float:
+    """Mean absolute gray-level difference of two thumbnails (inf without a previous one)"""
+    return float(np.abs(a - b).mean()) if a is not None else float('inf')
+
+
+def iter_video_frames(video_bytes: bytes, frame_step: int = 1, max_frames: int = None) -> Iterator[np.ndarray]:
+    """Yield every ``frame_step``-th BGR frame of an encoded video, one at a time.
+
+    OpenCV only opens videos from files, so the upload is spooled to a
+    temporary file for the duration of the iteration.
+    """
+    handle, path = tempfile.mkstemp(suffix='.video')
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            f.write(video_bytes)
+        capture = cv2.VideoCapture(path)
+        if not capture.isOpened():
+            raise ValueError('Invalid video data')
+        try:
+            index = 0
+            yielded = 0
+            while max_frames is None or yielded < max_frames:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                if index % frame_step == 0:
+                    yield frame
+                    yielded += 1
+                index += 1
+        finally:
+            capture.release()
+    finally:
+        os.unlink(path)
+
+
+class _Track:
+    """State of one tracked detection"""
+
+    def __init__(self, track_id: int, frame: int, clothing_type: str, label: str):
+        self.track_id = track_id
+        self.clothing_type = clothing_type
+        self.label = label
+        self.first_frame = frame
+        self.last_frame = frame
+        self.box = None
+        self.mask = None
+        self.thumbnail = None
+        self.colors = None
+        self.frame_count = 0
+        # Running color aggregate: weighted RGB sums and total share per cluster
+        self._rgb_sums = []
+        self._weights = []
+
+    def observe(self, frame: int, box: Tuple[int, int, int, int], mask: np.ndarray,
+                crop_thumbnail: np.ndarray, colors: List[Tuple[np.ndarray, float]], merge_distance: float):
+        self.last_frame = frame
+        self.box = box
+        self.mask = mask
+        self.thumbnail = crop_thumbnail
+        self.colors = colors
+        self.frame_count += 1
+        for rgb, fraction in colors:
+            rgb = np.asarray(rgb, dtype=np.float64)
+            if self._weights:
+                centers = np.array(self._rgb_sums) / np.array(self._weights)[:, None]
+                nearest = int(np.argmin(((centers - rgb) ** 2).sum(axis=1)))
+                if np.sqrt(((centers[nearest] - rgb) ** 2).sum()) <= merge_distance:
+                    self._rgb_sums[nearest] = self._rgb_sums[nearest] + rgb * fraction
+                    self._weights[nearest] += fraction
+                    continue
+            self._rgb_sums.append(rgb * fraction)
+            self._weights.append(fraction)
+
+    def aggregated_colors(self, k: int) -> List[Tuple[np.ndarray, float]]:
+        """Top-k colors over every frame, as fractions of the track's pixels"""
+        if not self._weights:
+            return []
+        weights = np.array(self._weights)
+        centers = (np.array(self._rgb_sums) / weights[:, None]).astype(int)
+        order = np.argsort(weights, kind='stable')[::-1][:k]
+        total = weights[order].sum()
+        return [(centers[i], float(weights[i] / total)) for i in order]
+
+
+class SequenceAnalyzer:
+    """Analyze the frames of one clip or burst with a ClothingDetector, reusing work across frames.
+
+    ``reuse_iou`` / ``max_change`` decide when a track keeps its colors
+    (box overlap with the previous frame and mean gray-level change of the
+    crop); ``mask_iou`` when it keeps its mask. ``max_age`` is how many
+    frames a track survives without a matching detection.
+    """
+
+    def __init__(self, detector, track_iou: float = 0.3, mask_iou: float = 0.7, reuse_iou: float = 0.9,
+                 max_change: float = 4.0, max_age: int = 5, k: int = 3, merge_distance: float = 40.0):
+        self.detector = detector
+        self.track_iou = track_iou
+        self.mask_iou = mask_iou
+        self.reuse_iou = reuse_iou
+        self.max_change = max_change
+        self.max_age = max_age
+        self.k = k
+        self.merge_distance = merge_distance
+
+    def analyze(self, frames: Iterable[Tuple[np.ndarray, Optional[Tuple[int, int]]]],
+                timer: StageTimer = None) -> Dict[str, Any]:
+        """Analyze (BGR frame, original (width, height) or None) pairs in order"""
+        timer = timer or NULL_TIMER
+        tracks: List[_Track] = []
+        finished: List[_Track] = []
+        track_ids = itertools.count()
+        per_frame = []
+        counts = {'static_frames': 0, 'detections': 0, 'reused_colors': 0, 'reused_masks': 0,
+                  'warm_started': 0, 'segmented': 0}
+        # Thumbnail of the last frame that went through detection
+        keyframe = None
+
+        for index, (frame, original_size) in enumerate(frames):
+            start = time.perf_counter()
+            image, (width, height) = self.detector.prepare_image(frame, original_size, timer)
+            scale = (width / image.shape[1], height / image.shape[0])
+            frame_thumbnail = thumbnail(image)
+
+            if change(keyframe, frame_thumbnail) <= self.max_change:
+                # Nothing moved since the last analyzed frame: live tracks carry over unchanged
+                live = [track for track in tracks if track.last_frame == index - 1]
+                for track in live:
+                    track.observe(index, track.box, track.mask, track.thumbnail, track.colors, self.merge_distance)
+                counts['static_frames'] += 1
+                counts['reused_colors'] += len(live)
+                counts['detections'] += len(live)
+                detections = [self._detection(track, 'frame', scale) for track in live]
+            else:
+                detections = self._analyze_frame(image, index, tracks, track_ids, counts, scale, timer)
+                keyframe = frame_thumbnail
+
+            finished.extend(track for track in tracks if index - track.last_frame >= self.max_age)
+            tracks = [track for track in tracks if index - track.last_frame < self.max_age]
+            per_frame.append({
+                'frame': index,
+                'detections': detections,
+                'time_ms': (time.perf_counter() - start) * 1000.0
+            })
+
+        if not per_frame:
+            return {
+                'success': False,
+                'error': 'No frames to analyze',
+                'tracks': [],
+                'frames': []
+            }
+        return {
+            'success': True,
+            'frame_count': len(per_frame),
+            'tracks': [self._summary(track) for track in sorted(finished + tracks, key=lambda t: t.track_id)],
+            'frames': per_frame,
+            'reuse': counts
+        }
+
+    def _analyze_frame(self, image: np.ndarray, index: int, tracks: List[_Track], track_ids: Iterator[int],
+                       counts: Dict[str, int], scale: Tuple[float, float], timer: StageTimer) -> List[Dict[str, Any]]:
+        """Detect, match to tracks (appending new ones) and color one frame"""
+        with timer.stage('yolo'):
+            rows = self.detector.detect_boxes(image)
+
+        detections = []
+        for row in np.asarray(rows, dtype=np.float32).reshape(len(rows), -1):
+            region = clip_box(image.shape, row)
+            if region is not None:
+                clothing_type, label = self.detector.classify(row[5]) if len(row) >= 6 else ('person', 'person')
+                detections.append((region, clothing_type, label))
+
+        # Greedy IoU matching against last frame's tracks, best overlaps first, within a clothing type
+        pairs = sorted(
+            ((box_iou(region, track.box), i, t)
+             for i, (region, clothing_type, _) in enumerate(detections)
+             for t, track in enumerate(tracks) if track.clothing_type == clothing_type),
+            reverse=True
+        )
+        matched = {}
+        used = set()
+        for iou, i, t in pairs:
+            if iou < self.track_iou:
+                break
+            if i not in matched and t not in used:
+                matched[i] = (tracks[t], iou)
+                used.add(t)
+
+        plans = []
+        for i, (region, clothing_type, label) in enumerate(detections):
+            x1, y1, x2, y2 = region
+            crop = image[y1:y2, x1:x2]
+            crop_thumbnail = thumbnail(crop)
+            track, iou = matched.get(i, (None, 0.0))
+            if track is None:
+                track = _Track(next(track_ids), index, clothing_type, label)
+                tracks.append(track)
+
+            if iou >= self.reuse_iou and change(track.thumbnail, crop_thumbnail) <= self.max_change:
+                plans.append([track, region, crop, track.thumbnail, 'colors', track.mask])
+            elif iou >= self.mask_iou:
+                mask = cv2.resize(track.mask.astype(np.uint8), (x2 - x1, y2 - y1), interpolation=cv2.INTER_NEAREST)
+                plans.append([track, region, crop, crop_thumbnail, 'mask', mask])
+            else:
+                plans.append([track, region, crop, crop_thumbnail, None, None])
+
+        # New and heavily changed detections are segmented together (one SAM encoding)
+        to_segment = [plan for plan in plans if plan[4] is None]
+        if to_segment:
+            with timer.stage('sam'):
+                masks = self.detector.get_box_masks(image, np.array([plan[1] for plan in to_segment]))
+            for plan, mask in zip(to_segment, masks):
+                plan[5] = mask
+            counts['segmented'] += len(to_segment)
+
+        results = []
+        for track, region, crop, crop_thumbnail, reused, mask in plans:
+            if reused == 'colors':
+                colors = track.colors
+                counts['reused_colors'] += 1
+            else:
+                # Warm start from the track's previous clusters
+                init = np.array([rgb for rgb, _ in track.colors], dtype=np.float64) if track.colors else None
+                try:
+                    with timer.stage('color'):
+                        colors = self.detector.color_extractor.extract(crop, mask, k=self.k, init=init)
+                except Exception as e:
+                    # Like DetectionPipeline.run: report this detection, keep the others
+                    if track.frame_count == 0:
+                        tracks.remove(track)
+                    results.append({'track_id': track.track_id, 'success': False, 'error': str(e)})
+                    continue
+                counts['warm_started'] += init is not None
+                counts['reused_masks'] += reused == 'mask'
+            track.observe(index, region, mask, crop_thumbnail, colors, self.merge_distance)
+            counts['detections'] += 1
+            results.append(self._detection(track, reused, scale))
+        return results
+
+    def _detection(self, track: _Track, reused: Optional[str], scale: Tuple[float, float]) -> Dict[str, Any]:
+        """One frame's view of a track; ``reused`` is 'frame', 'colors', 'mask' or None"""
+        x1, y1, x2, y2 = track.box
+        scale_x, scale_y = scale
+        names = self.detector.closest_color_names([rgb for rgb, _ in track.colors])
+        return {
+            'track_id': track.track_id,
+            'success': True,
+            'box': [round(x1 * scale_x), round(y1 * scale_y), round(x2 * scale_x), round(y2 * scale_y)],
+            'clothing_type': track.clothing_type,
+            'colors': format_colors(track.colors, names),
+            'reused': reused
+        }
+
+    def _summary(self, track: _Track) -> Dict[str, Any]:
+        colors = track.aggregated_colors(self.k)
+        names = self.detector.closest_color_names([rgb for rgb, _ in colors])
+        return {
+            'track_id': track.track_id,
+            'clothing_type': track.clothing_type,
+            'label': track.label,
+            'first_frame': track.first_frame,
+            'last_frame': track.last_frame,
+            'frame_count': track.frame_count,
+            'colors': format_colors(colors, names),
+            'description': describe_colors(colors, names)
+        }
@@ -0,0 +1,231 @@
+"""
+Serving helpers: CPU limits and admission control for inference requests
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from typing import ContextManager, Optional, Tuple
+
+
+def available_cpus() -> int:
+    """Number of CPUs this process may use, honouring container CPU limits"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    # cgroup v2: "max 100000" or "<quota> <period>"
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()[:2]
+        if quota != 'max':
+            cpus = min(cpus, max(1, int(int(quota) / int(period))))
+        return cpus
+    except (OSError, ValueError):
+        pass
+
+    # cgroup v1
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            cpus = min(cpus, max(1, quota // period))
+    except (OSError, ValueError):
+        pass
+
+    return cpus
+
+
+def default_threads() -> int:
+    """Threads for one process's compute: torch's setting (per-worker share under gunicorn), capped by the CPU limit"""
+    import torch
+
+    return max(1, min(torch.get_num_threads(), available_cpus()))
+
+
+def inference_limits() -> Tuple[int, int]:
+    """(max_concurrent, max_queued) inference requests per worker, from the environment.
+
+    Only requests a gunicorn thread is serving can wait at the gate, so the
+    queue is sized from GUNICORN_THREADS: every thread but one may hold a
+    slot or wait for one, and the spare thread rejects the next request
+    with 503 instead of leaving it in gunicorn's backlog. gunicorn.conf.py
+    sizes the threads the other way round when GUNICORN_THREADS is unset.
+    """
+    batching = float(os.environ.get('MICROBATCH_WINDOW_MS', 0)) > 0
+    # With micro-batching, a full batch must be able to wait in the scheduler at once
+    max_concurrent = int(os.environ.get('INFERENCE_CONCURRENCY',
+                                        os.environ.get('MICROBATCH_MAX_SIZE', 8) if batching else 2))
+    threads = os.environ.get('GUNICORN_THREADS')
+    default_queued = max(0, int(threads) - max_concurrent - 1) if threads else 8
+    return max_concurrent, int(os.environ.get('INFERENCE_QUEUE_SIZE', default_queued))
+
+
+class ServerBusy(Exception):
+    """Raised when the inference queue is full; maps to HTTP 503"""
+
+    def __init__(self, message: str = 'Server is busy, please retry', retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class PayloadTooLarge(ValueError):
+    """Raised for an upload over a size, pixel or memory limit on its own; maps to HTTP 413"""
+
+
+class InferenceGate:
+    """Bound concurrent inference work and the number of requests waiting for it.
+
+    At most ``max_concurrent`` requests run inference at once; up to
+    ``max_queued`` more may wait up to ``timeout`` seconds for a slot.
+    Anything beyond that is rejected immediately with ServerBusy so the
+    load balancer can retry elsewhere instead of piling up requests.
+    """
+
+    def __init__(self, max_concurrent: int = 2, max_queued: int = 8, timeout: float = 30.0):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+
+    def acquire(self):
+        """Take an inference slot or raise ServerBusy"""
+        if self._slots.acquire(blocking=False):
+            with self._lock:
+                self.active += 1
+            return
+
+        with self._lock:
+            if self.waiting >= self.max_queued:
+                self.rejected += 1
+                raise ServerBusy()
+            self.waiting += 1
+
+        acquired = self._slots.acquire(timeout=self.timeout)
+        with self._lock:
+            self.waiting -= 1
+            if not acquired:
+                self.rejected += 1
+                raise ServerBusy()
+            self.active += 1
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+        self._slots.release()
+
+    def limit(self, func):
+        """Decorator running a view function inside an inference slot"""
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            self.acquire()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.release()
+        return wrapper
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'max_concurrent': self.max_concurrent,
+                'max_queued': self.max_queued,
+                'active': self.active,
+                'waiting': self.waiting,
+                'rejected': self.rejected
+            }
+
+
+class MemoryBudget:
+    """Bound the memory held by decoded images of in-flight requests in this process.
+
+    Each decode reserves its estimated size for as long as the image is in
+    use. A reservation that doesn't fit waits up to ``timeout`` seconds for
+    others to be released and then raises ServerBusy; one larger than the
+    whole budget raises PayloadTooLarge, since it could never fit.
+    ``max_bytes=0`` disables the budget.
+    """
+
+    def __init__(self, max_bytes: int, timeout: float = 5.0):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self._condition = threading.Condition()
+        self.reserved = 0
+        self.peak = 0
+        self.rejected = 0
+
+    def try_reserve(self, nbytes: int) -> Optional[ContextManager]:
+        """Reserve ``nbytes`` only if it fits right now, checked and taken under one lock.
+
+        Returns a context manager that releases the reservation, or None
+        (nothing reserved) when it would have to wait.
+        """
+        if not self.max_bytes:
+            return nullcontext()
+        self._check_size(nbytes)
+        with self._condition:
+            if self.reserved + nbytes > self.max_bytes:
+                return None
+            self._take(nbytes)
+        return self._held(nbytes)
+
+    @contextmanager
+    def reserve(self, nbytes: int):
+        """Hold ``nbytes`` of the budget for the duration of the block"""
+        if not self.max_bytes:
+            yield
+            return
+        self._check_size(nbytes)
+
+        deadline = time.monotonic() + self.timeout
+        with self._condition:
+            while self.reserved + nbytes > self.max_bytes:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.rejected += 1
+                    raise ServerBusy('Server is low on memory, please retry')
+                self._condition.wait(remaining)
+            self._take(nbytes)
+        with self._held(nbytes):
+            yield
+
+    def _check_size(self, nbytes: int):
+        if nbytes > self.max_bytes:
+            with self._condition:
+                self.rejected += 1
+            raise PayloadTooLarge(
+                f'Image needs ~{nbytes // 2 ** 20} MB to decode, over the {self.max_bytes // 2 ** 20} MB limit'
+            )
+
+    def _take(self, nbytes: int):
+        # Caller holds the condition
+        self.reserved += nbytes
+        self.peak = max(self.peak, self.reserved)
+
+    @contextmanager
+    def _held(self, nbytes: int):
+        """Release an already taken reservation when the block exits"""
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.reserved -= nbytes
+                self._condition.notify_all()
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                'max_bytes': self.max_bytes,
+                'reserved': self.reserved,
+                'peak': self.peak,
+                'rejected': self.rejected
+            }
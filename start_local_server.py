@@ -4,14 +4,13 @@ Local AI Backend Server for DressApp
 Runs on localhost:5000 for emulator testing
 """
 
-import os
 import sys
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import base64
-import cv2
-import numpy as np
 from clothing_detector import ClothingDetector
+from wire_format import is_raw_image, negotiated_response
+from serving import PayloadTooLarge
 import logging
 
 # Configure logging
@@ -45,131 +44,111 @@ def health_check():
         'sam_loaded': detector is not None
     })
 
+def request_image_bytes():
+    """Raw image body (application/octet-stream or image/*) or base64 JSON {"image": ...}"""
+    if is_raw_image(request.mimetype):
+        return request.get_data(cache=False) or None
+    data = request.get_json(silent=True)
+    if not data or 'image' not in data:
+        return None
+    return base64.b64decode(data['image'])
+
 @app.route('/detect-clothing', methods=['POST'])
 def detect_clothing():
     """Detect clothing items in an image"""
     try:
         if detector is None:
-            return jsonify({
+            return negotiated_response({
                 'success': False,
                 'error': 'AI detector not initialized'
-            }), 500
+            }, 500)
 
-        # Get image data from request
-        data = request.get_json()
-        if not data or 'image' not in data:
-            return jsonify({
+        # Decode the image straight from the request buffer
+        try:
+            image_bytes = request_image_bytes()
+            if image_bytes is None:
+                return negotiated_response({
+                    'success': False,
+                    'error': 'No image data provided'
+                }, 400)
+            image, original_size = detector.decode_for_analysis(image_bytes)
+        except PayloadTooLarge as e:
+            return negotiated_response({
                 'success': False,
-                'error': 'No image data provided'
-            }), 400
-
-        # Decode base64 image
-        image_data = base64.b64decode(data['image'])
-        nparr = np.frombuffer(image_data, np.uint8)
-        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        
-        if image is None:
-            return jsonify({
+                'error': str(e)
+            }, 413)
+        except ValueError:
+            return negotiated_response({
                 'success': False,
                 'error': 'Invalid image data'
-            }), 400
+            }, 400)
 
-        # Save temporary image for analysis
-        temp_path = 'temp_image.jpg'
-        cv2.imwrite(temp_path, image)
-        
-        try:
-            # Analyze clothing
-            result = detector.analyze_clothing(temp_path)
-            
-            # Clean up temp file
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-            
-            return jsonify(result)
-            
-        except Exception as e:
-            # Clean up temp file on error
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-            raise e
+        # Analyze clothing in memory (no temp file, safe with threaded=True)
+        result = detector.detect_clothing_from_array(image, original_size=original_size)
+        return negotiated_response(result)
 
     except Exception as e:
         logger.error(f"Error in detect-clothing: {e}")
-        return jsonify({
+        return negotiated_response({
             'success': False,
             'error': str(e)
-        }), 500
+        }, 500)
 
 @app.route('/analyze-colors', methods=['POST'])
 def analyze_colors():
     """Analyze colors in an image"""
     try:
         if detector is None:
-            return jsonify({
+            return negotiated_response({
                 'success': False,
                 'error': 'AI detector not initialized'
-            }), 500
+            }, 500)
 
-        # Get image data from request
-        data = request.get_json()
-        if not data or 'image' not in data:
-            return jsonify({
+        # Decode the image straight from the request buffer
+        try:
+            image_bytes = request_image_bytes()
+            if image_bytes is None:
+                return negotiated_response({
+                    'success': False,
+                    'error': 'No image data provided'
+                }, 400)
+            image, original_size = detector.decode_for_analysis(image_bytes)
+        except PayloadTooLarge as e:
+            return negotiated_response({
                 'success': False,
-                'error': 'No image data provided'
-            }), 400
-
-        # Decode base64 image
-        image_data = base64.b64decode(data['image'])
-        nparr = np.frombuffer(image_data, np.uint8)
-        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        
-        if image is None:
-            return jsonify({
+                'error': str(e)
+            }, 413)
+        except ValueError:
+            return negotiated_response({
                 'success': False,
                 'error': 'Invalid image data'
-            }), 400
-
-        # Save temporary image for analysis
-        temp_path = 'temp_image.jpg'
-        cv2.imwrite(temp_path, image)
-        
-        try:
-            # Analyze clothing
-            result = detector.analyze_clothing(temp_path)
-            
-            # Clean up temp file
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-            
-            # Extract color analysis from result
-            if result.get('success') and result.get('detections'):
-                # Get the first detection's color analysis
-                first_detection = result['detections'][0]
-                color_analysis = {
-                    'success': True,
-                    'dominant_colors': first_detection.get('colors', []),
-                    'description': first_detection.get('description', 'No color analysis available')
-                }
-                return jsonify(color_analysis)
-            else:
-                return jsonify({
-                    'success': False,
-                    'error': 'No clothing detected for color analysis'
-                })
-            
-        except Exception as e:
-            # Clean up temp file on error
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-            raise e
+            }, 400)
+
+        # Only the most confident detection is reported, so skip the others' colors
+        result = detector.detect_clothing_from_array(image, original_size=original_size, max_detections=1)
+
+        # Extract color analysis from result
+        if result.get('success') and result.get('detections'):
+            # Get the first detection's color analysis
+            first_detection = result['detections'][0]
+            color_analysis = {
+                'success': True,
+                'dominant_colors': first_detection.get('colors', []),
+                'description': first_detection.get('description', 'No color analysis available')
+            }
+            return negotiated_response(color_analysis)
+        else:
+            return negotiated_response({
+                'success': False,
+                'error': 'No clothing detected for color analysis'
+            })
 
     except Exception as e:
         logger.error(f"Error in analyze-colors: {e}")
-        return jsonify({
+        return negotiated_response({
             'success': False,
             'error': str(e)
-        }), 500
+        }, 500)
 
 @app.route('/test', methods=['GET'])
 def test_endpoint():
@@ -1,6 +1,11 @@
 #!/usr/bin/env python3
 """
-Startup script for the AI Clothing Detection API
+Startup script for the AI Clothing Detection API (development server)
+
+For production use gunicorn, which loads the models once and serves
+requests from several workers:
+
+    gunicorn -c gunicorn.conf.py app:app
 """
 
 import os
@@ -8,9 +13,8 @@ import sys
 from app import app
 
 if __name__ == '__main__':
-    # Set environment variables
-    os.environ['FLASK_ENV'] = 'development'
-    os.environ['FLASK_DEBUG'] = '1'
+    # Debug mode only when explicitly requested
+    debug = os.environ.get('FLASK_DEBUG', '0') == '1'
     
     # Get port from environment or use default
     port = int(os.environ.get('PORT', 5000))
@@ -24,7 +28,8 @@ if __name__ == '__main__':
     print("\nPress Ctrl+C to stop the server")
     
     try:
-        app.run(host='0.0.0.0', port=port, debug=True)
+        # The reloader would import app.py (and load the models) a second time
+        app.run(host='0.0.0.0', port=port, debug=debug, use_reloader=False, threaded=True)
     except KeyboardInterrupt:
         print("\n🛑 Server stopped by user")
     except Exception as e:
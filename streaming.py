@@ -0,0 +1,106 @@
+"""
+Incremental upload parsing and response framing for streaming endpoints
+"""
+
+import base64
+import binascii
+import json
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+# Bytes read from the request body per step; only the image being received is buffered
+READ_CHUNK_SIZE = 64 * 1024
+
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+
+
+def decode_base64_image(data) -> bytes:
+    """Raw image bytes from a base64 string, with or without a data URL prefix"""
+    if isinstance(data, (bytes, bytearray)):
+        data = bytes(data).decode('ascii')
+    if not isinstance(data, str):
+        raise ValueError('Expected a base64 encoded image')
+    if data.startswith('data:'):
+        data = data.split(',', 1)[1]
+    try:
+        return base64.b64decode(data)
+    except (binascii.Error, ValueError):
+        raise ValueError('Invalid base64 image data')
+
+
+def iter_base64_images(items) -> Iterator[Tuple[Optional[bytes], Optional[str]]]:
+    """Yield (image_bytes, error) for a list of base64 images from a JSON body"""
+    for item in items:
+        try:
+            yield decode_base64_image(item), None
+        except ValueError as e:
+            yield None, str(e)
+
+
+def iter_ndjson_images(stream) -> Iterator[Tuple[Optional[bytes], Optional[str]]]:
+    """Yield (image_bytes, error) per NDJSON line as the body arrives.
+
+    Each line is either a JSON object with an ``image`` (or ``image_base64``)
+    field or a bare JSON string, holding a base64 image. A bad line yields
+    an error for that image instead of ending the stream.
+    """
+    while True:
+        line = stream.readline()
+        if not line:
+            return
+        line = line.strip()
+        if not line:
+            continue
+
+        try:
+            item = json.loads(line)
+            if isinstance(item, dict):
+                item = item.get('image', item.get('image_base64'))
+            yield decode_base64_image(item), None
+        except ValueError as e:
+            yield None, str(e)
+
+
+def iter_multipart_images(stream, boundary: bytes) -> Iterator[Tuple[Optional[bytes], Optional[str]]]:
+    """Yield (image_bytes, error) per multipart part as soon as the part is complete.
+
+    File parts hold raw encoded images; plain form fields are read as
+    base64 images.
+    """
+    decoder = MultipartDecoder(boundary)
+    part = None
+    buffer = bytearray()
+
+    while True:
+        chunk = stream.read(READ_CHUNK_SIZE)
+        decoder.receive_data(chunk or None)
+
+        event = decoder.next_event()
+        while not isinstance(event, (NeedData, Epilogue)):
+            if isinstance(event, (Field, File)):
+                part = event
+                buffer = bytearray()
+            elif isinstance(event, Data):
+                buffer += event.data
+                if not event.more_data:
+                    if isinstance(part, File):
+                        yield bytes(buffer), None
+                    else:
+                        try:
+                            yield decode_base64_image(buffer), None
+                        except ValueError as e:
+                            yield None, str(e)
+                    buffer = bytearray()
+            event = decoder.next_event()
+
+        if isinstance(event, Epilogue) or not chunk:
+            return
+
+
+def ndjson_line(payload: Dict[str, Any]) -> str:
+    return json.dumps(payload) + '\n'
+
+
+def sse_event(payload: Dict[str, Any], event: str = 'result') -> str:
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
@@ -5,7 +5,21 @@ Test script for the AI Clothing Detection system
 
 import numpy as np
 import cv2
+import os
+import torch
 from clothing_detector import ClothingDetector
+from color_extraction import ColorExtractor
+from benchmark import StubYOLO, make_workload
+import onnx_backend
+import garments
+import segmentation
+import tempfile
+from wardrobe_index import WardrobeIndex
+from sequence_analysis import SequenceAnalyzer
+from batch_cli import Checkpoint, ChunkWriter
+from serving import MemoryBudget, PayloadTooLarge, ServerBusy
+from result_cache import ResultCache
+from jobs import JobStore
 import time
 
 def create_test_image():
@@ -21,6 +35,339 @@ def create_test_image():
     
     return image
 
+def create_noisy_test_image(seed=0):
+    """Create a 3-color test image with sensor-like noise"""
+    rng = np.random.default_rng(seed)
+    image = np.zeros((480, 360, 3), dtype=np.int16)
+    image[0:240] = [200, 30, 40]    # Red-ish (50%)
+    image[240:384] = [20, 40, 120]  # Navy-ish (30%)
+    image[384:480] = [235, 235, 225]  # Off-white (20%)
+    image += rng.integers(-12, 13, size=image.shape, dtype=np.int16)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+def colors_match(reference, candidate, max_rgb_dist=20.0, max_pct_diff=0.05):
+    """Check every significant reference color has a close candidate color"""
+    for ref_rgb, ref_pct in reference:
+        if ref_pct < 0.05:
+            continue
+        dists = [np.linalg.norm(np.asarray(ref_rgb, float) - np.asarray(rgb, float)) for rgb, _ in candidate]
+        best = int(np.argmin(dists))
+        if dists[best] > max_rgb_dist or abs(candidate[best][1] - ref_pct) > max_pct_diff:
+            return False
+    return True
+
+def test_color_backends():
+    """Compare the fast color backends against the original full KMeans"""
+    print("🧪 Testing color extraction backends against full KMeans...")
+    
+    reference_extractor = ColorExtractor(backend='kmeans', max_pixels=None)
+    all_match = True
+    
+    for image_name, image in [('two-color', create_test_image()), ('noisy three-color', create_noisy_test_image())]:
+        reference = reference_extractor.extract(image)
+        for backend in ColorExtractor.BACKENDS:
+            start_time = time.time()
+            colors = ColorExtractor(backend=backend).extract(image)
+            elapsed = time.time() - start_time
+            
+            match = colors_match(reference, colors)
+            all_match = all_match and match
+            status = "✅" if match else "❌"
+            print(f"  {status} {backend} on {image_name}: {elapsed*1000:.1f} ms")
+    
+    assert all_match, "Color backends disagree with full KMeans"
+    return True
+
+def test_resolution_policy():
+    """Downscaled inference should match full resolution, with boxes in original coordinates"""
+    print("🧪 Testing downscaled inference against full resolution...")
+    
+    image = make_workload(4032, 3024, people=2, colors=3, seed=1)
+    ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    
+    full = ClothingDetector(yolo_model=StubYOLO(), yolo_weights='stub', sam_checkpoint=None,
+                            max_image_side=0, max_detect_side=0)
+    bounded = ClothingDetector(yolo_model=StubYOLO(), yolo_weights='stub', sam_checkpoint=None)
+    
+    results = []
+    for detector in (full, bounded):
+        decoded, original_size = detector.decode_for_analysis(encoded.tobytes())
+        results.append(detector.detect_clothing_from_array(decoded, original_size=original_size)['detections'])
+    reference, detections = results
+    assert len(detections) == len(reference) == 2, "Detection count changed with downscaling"
+    
+    # 4032 px decodes at 1/2 scale (1/4 would fall under max_image_side=1024)
+    factor = bounded.decode_factor(bounded.probe_image(encoded.tobytes()))
+    assert factor == 2, f"Decoded at 1/{factor} scale"
+    for ref, det in zip(reference, detections):
+        # One pixel at the 1/2 decode scale is 2 original pixels; allow two of them
+        assert np.abs(np.subtract(ref['box'], det['box'])).max() <= 2 * factor, \
+            f"Box moved: {ref['box']} -> {det['box']}"
+        assert colors_match(
+            [(c['rgb'], c['percentage'] / 100) for c in ref['colors']],
+            [(c['rgb'], c['percentage'] / 100) for c in det['colors']]
+        ), "Colors changed with downscaling"
+        print(f"  ✅ {ref['box']} -> {det['box']}")
+    
+    return True
+
+def test_garment_detection():
+    """Garment models report their own classes and scores; COCO models fall back to people"""
+    print("🧪 Testing garment-level detection...")
+    
+    coco = garments.detection_classes({0: 'person', 26: 'handbag', 27: 'tie'})
+    assert coco == {0: ('person', 'person')}, "COCO model should detect whole people"
+    
+    class GarmentStub(StubYOLO):
+        names = {0: 'Long sleeve top', 1: 'person'}
+    
+    detector = ClothingDetector(yolo_model=GarmentStub(), sam_checkpoint=None)
+    result = detector.detect_clothing_from_array(make_workload(640, 480, people=2, colors=3), use_cache=False)
+    detections = result['detections']
+    assert len(detections) == 2, "Expected one garment per figure"
+    for detection in detections:
+        assert detection['clothing_type'] == 'top' and detection['label'] == 'Long sleeve top'
+        assert abs(detection['confidence'] - 0.9) < 1e-6, "Confidence should come from the model"
+    print(f"  ✅ {len(detections)} tops with model confidences")
+    return True
+
+def test_grabcut_segmentation():
+    """GrabCut masks drop the background a loose box includes"""
+    print("🧪 Testing GrabCut segmentation...")
+    
+    image = make_workload(640, 480, people=1, colors=3)
+    truth = np.abs(image.astype(np.int16) - 128).max(axis=2) > 40
+    ys, xs = np.nonzero(truth)
+    # Box the figure with background on every side, like a real detection
+    region = (xs.min() - 40, ys.min() - 30, xs.max() + 40, min(480, ys.max() + 30))
+    x1, y1, x2, y2 = region
+    
+    box_iou = segmentation.mask_iou(segmentation.box_masks([region])[0], truth[y1:y2, x1:x2])
+    grabcut_iou = segmentation.mask_iou(segmentation.grabcut_mask(image, region), truth[y1:y2, x1:x2])
+    assert grabcut_iou > 0.9 and grabcut_iou > box_iou, f"GrabCut IoU {grabcut_iou:.3f} vs box {box_iou:.3f}"
+    print(f"  ✅ IoU {grabcut_iou:.3f} (whole box {box_iou:.3f})")
+    return True
+
+def test_wardrobe_index():
+    """Similar and complementary matches from the wardrobe index"""
+    print("🧪 Testing wardrobe matching...")
+    
+    with tempfile.TemporaryDirectory() as directory:
+        index = WardrobeIndex(directory)
+        index.add('user', 'red-top', [{'rgb': [220, 30, 30], 'percentage': 100.0}], 'top')
+        index.add('user', 'teal-pants', [{'rgb': [30, 220, 220], 'percentage': 100.0}], 'bottom')
+        index.add('user', 'red-skirt', [{'rgb': [200, 40, 40], 'percentage': 100.0}], 'bottom')
+        index.add('other', 'teal-shorts', [{'rgb': [30, 220, 220], 'percentage': 100.0}], 'bottom')
+        
+        query = [{'rgb': [220, 30, 30], 'percentage': 100.0}]
+        similar = index.query('user', query, k=1, exclude_item='red-top')
+        assert [m['item_id'] for m in similar] == ['red-skirt'], similar
+        complementary = index.query('user', query, k=1, mode='complementary', clothing_type='bottom')
+        assert [m['item_id'] for m in complementary] == ['teal-pants'], complementary
+    print("  ✅ red top: similar red-skirt, complementary teal-pants")
+    return True
+
+def test_sequence_analysis():
+    """Tracks stay stable across a burst and unchanged frames reuse earlier work"""
+    print("🧪 Testing burst analysis...")
+    
+    detector = ClothingDetector(yolo_model=StubYOLO(), sam_checkpoint=None, segmentation='box')
+    base = make_workload(640, 480, people=2, colors=3)
+    # Still frames, then the people walk right a little more every frame
+    frames = [base] * 3
+    for shift in (30, 60, 90):
+        frame = np.full_like(base, 128)
+        frame[:, shift:] = base[:, :-shift]
+        frames.append(frame)
+    result = SequenceAnalyzer(detector).analyze((frame, None) for frame in frames)
+    
+    assert result['success'] and result['frame_count'] == 6, result
+    assert [track['frame_count'] for track in result['tracks']] == [6, 6], result['tracks']
+    reuse = result['reuse']
+    assert reuse['static_frames'] == 2 and reuse['segmented'] < reuse['detections'], reuse
+    print(f"  ✅ 2 tracks over 6 frames, {reuse['segmented']} of {reuse['detections']} detections segmented")
+    return True
+
+def test_batch_checkpoint():
+    """Batch CLI chunks are checkpointed and a resumed run drops unrecorded ones"""
+    print("🧪 Testing batch checkpoints...")
+    
+    with tempfile.TemporaryDirectory() as directory:
+        writer = ChunkWriter(directory, Checkpoint(directory), chunk_size=2)
+        for i in range(5):
+            writer.add({'id': f'img{i}.jpg', 'path': f'img{i}.jpg', 'success': True, 'detections': []})
+        # A chunk written by a run that crashed before checkpointing it
+        open(os.path.join(directory, 'part-00009.jsonl'), 'w').close()
+        
+        resumed = Checkpoint(directory)
+        assert resumed.done == {'img0.jpg', 'img1.jpg', 'img2.jpg', 'img3.jpg'}, resumed.done
+        assert resumed.remove_orphans() == ['part-00009.jsonl']
+        assert ChunkWriter(directory, resumed)._next == 2
+    print("  ✅ 2 chunks resumed, 1 orphan removed")
+    return True
+
+def test_memory_budget():
+    """Decode memory reservations, and the 413/503 responses they drive"""
+    print("🧪 Testing the decode memory budget...")
+    
+    budget = MemoryBudget(1000, timeout=0.05)
+    with budget.try_reserve(600):
+        assert budget.try_reserve(600) is None, "try_reserve took memory that was held"
+        try:
+            with budget.reserve(600):
+                assert False, "reserve didn't wait for held memory"
+        except ServerBusy:
+            pass
+    with budget.reserve(600):
+        assert budget.stats()['reserved'] == 600
+    try:
+        budget.try_reserve(2000)
+        assert False, "A reservation over the whole budget was accepted"
+    except PayloadTooLarge:
+        pass
+    stats = budget.stats()
+    assert (stats['reserved'], stats['peak'], stats['rejected']) == (0, 600, 2), stats
+    print("  ✅ reserve waits and times out, try_reserve never waits, oversize is refused")
+    
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ.update(JOB_DB_PATH=os.path.join(directory, 'jobs.db'),
+                          CLOSET_DB_PATH=os.path.join(directory, 'closets.db'),
+                          WARDROBE_DIR=os.path.join(directory, 'wardrobe'),
+                          MODEL_BACKGROUND_LOAD='0', MODEL_WARMUP='0', SEGMENTATION='box')
+        import app
+        app.detector = ClothingDetector(yolo_model=StubYOLO(), yolo_weights='stub', sam_checkpoint=None,
+                                        segmentation='box')
+        client = app.app.test_client()
+        ok, encoded = cv2.imencode('.png', make_workload(320, 240, people=1, colors=2))
+        cost = app.detector.decoded_bytes(app.detector.probe_image(encoded.tobytes()), len(encoded))
+        
+        def post():
+            return client.post('/detect-clothing', data=encoded.tobytes(), content_type='image/png')
+        
+        app.memory_budget = MemoryBudget(cost - 1, timeout=0.05)
+        assert post().status_code == 413, "An image over the budget wasn't refused with 413"
+        app.memory_budget = MemoryBudget(cost, timeout=0.05)
+        with app.memory_budget.reserve(1):
+            response = post()
+            assert response.status_code == 503 and response.headers.get('Retry-After'), response.status_code
+        assert post().status_code == 200, "The budget wasn't released after the 503"
+    print("  ✅ /detect-clothing answers 413 over the budget and 503 while it is held")
+    return True
+
+def test_result_cache():
+    """Memory LRU eviction and the bounded disk tier of the result cache"""
+    print("🧪 Testing the result cache...")
+    
+    cache = ResultCache(max_entries=2)
+    cache.put('a', {'n': 1})
+    cache.put('b', {'n': 2})
+    assert cache.get('a') == {'n': 1}
+    cache.put('c', {'n': 3})
+    assert cache.get('b') is None and cache.get('a') == {'n': 1}, "The least recently used entry wasn't evicted"
+    # Callers get copies, never the cached object
+    cache.get('a')['n'] = 0
+    assert cache.get('a') == {'n': 1}
+    
+    with tempfile.TemporaryDirectory() as directory:
+        cache = ResultCache(max_entries=1, disk_dir=directory, disk_max_entries=4)
+        for i in range(4):
+            cache.put(f'key{i}', {'n': i})
+            # Distinct ages; the disk tier evicts by modification time
+            os.utime(cache._disk_path(f'key{i}'), (i, i))
+        # A disk hit makes key0 the most recently used entry
+        assert cache.get('key0') == {'n': 0} and cache.disk_hits == 1
+        cache.put('key4', {'n': 4})
+        
+        stats = cache.stats()
+        assert (stats['disk_entries'], stats['disk_evictions']) == (3, 2), stats
+        reopened = ResultCache(max_entries=1, disk_dir=directory, disk_max_entries=4)
+        kept = [i for i in range(5) if reopened.get(f'key{i}') is not None]
+        assert kept == [0, 3, 4], f"Disk tier kept {kept}"
+    print("  ✅ LRU in memory, oldest disk entries evicted past the bound")
+    return True
+
+def test_job_lifecycle():
+    """Jobs are claimed, completed, failed and requeued without double counting"""
+    print("🧪 Testing the job queue...")
+    
+    with tempfile.TemporaryDirectory() as directory:
+        store = JobStore(os.path.join(directory, 'jobs.db'))
+        
+        claimed_during_upload = []
+        def upload():
+            yield b'first', None
+            # Items of a job still uploading are never handed out
+            claimed_during_upload.extend(store.claim_items('worker', limit=5))
+            yield None, 'Invalid image data'
+            yield b'third', None
+        job = store.create_job(upload(), group_size=1)
+        job_id = job['job_id']
+        assert claimed_during_upload == [], claimed_during_upload
+        assert (job['status'], job['total'], job['failed']) == ('queued', 3, 1), job
+        
+        items = store.claim_items('worker', limit=5)
+        assert [item['index'] for item in items] == [0, 2] and items[0]['image'] == b'first', items
+        assert store.claim_items('other', limit=5) == [], "A running item was claimed twice"
+        assert store.get_job(job_id, include_results=False)['status'] == 'running'
+        
+        store.complete_item(job_id, 0, {'success': True, 'detections': []})
+        store.complete_item(job_id, 0, {'success': True, 'detections': []})
+        # A crashed worker's items go back to the queue
+        assert store.requeue(worker='worker') == 1
+        assert [item['index'] for item in store.claim_items('other', limit=5)] == [2]
+        store.fail_item(job_id, 2, 'boom')
+        
+        job = store.get_job(job_id)
+        assert (job['status'], job['completed'], job['failed'], job['progress']) == ('done', 1, 2, 1.0), job
+        assert [(r['index'], r['success']) for r in job['results']] == [(0, True), (1, False), (2, False)], job
+        assert job['results'][2]['error'] == 'boom'
+    print("  ✅ upload, claim, requeue, complete and fail keep the counts exact")
+    return True
+
+def test_onnx_parity():
+    """Compare the exported ONNX models with PyTorch (skipped until export_models.py has run)"""
+    print("🧪 Testing ONNX Runtime backend against PyTorch...")
+    
+    yolo_path = onnx_backend.yolo_onnx_path('yolov8n.pt')
+    if not onnx_backend.onnx_available() or not os.path.exists(yolo_path):
+        print("  ⏭️ No ONNX artifacts found, run export_models.py first")
+        return True
+    
+    # Raw network outputs for the same letterboxed input
+    from ultralytics import YOLO
+    image = make_workload(640, 480, people=2, colors=3)
+    onnx_yolo = onnx_backend.OnnxYOLO(yolo_path)
+    tensor, _ = onnx_yolo.preprocess(image)
+    with torch.no_grad():
+        expected = YOLO('yolov8n.pt').model.float().eval()(torch.from_numpy(tensor[None]))[0].numpy()
+    actual = onnx_yolo.session.run(tensor[None])
+    error = np.abs(expected - actual).max() / np.abs(expected).max()
+    print(f"  {'✅' if error < 1e-3 else '❌'} YOLO relative error {error:.2e}")
+    assert error < 1e-3, "YOLO ONNX outputs differ from PyTorch"
+    
+    # Final detections through both detector backends
+    torch_boxes = ClothingDetector(sam_checkpoint=None, inference_backend='torch').detect_clothing(image)
+    onnx_boxes = ClothingDetector(sam_checkpoint=None, yolo_model=onnx_yolo).detect_clothing(image)
+    assert len(torch_boxes) == len(onnx_boxes), "ONNX backend found a different number of people"
+    if len(torch_boxes):
+        assert np.abs(torch_boxes - onnx_boxes).max() < 1.0, "ONNX backend boxes moved"
+    print(f"  ✅ {len(onnx_boxes)} matching detections")
+    
+    encoder_path = onnx_backend.sam_encoder_onnx_path('sam_vit_b.pth')
+    if os.path.exists(encoder_path):
+        from segment_anything import sam_model_registry
+        sam = sam_model_registry['vit_b'](checkpoint='sam_vit_b.pth').eval()
+        sample = torch.randn(1, 3, 1024, 1024, generator=torch.Generator().manual_seed(0))
+        with torch.no_grad():
+            expected = sam.image_encoder(sample).numpy().ravel()
+        del sam
+        actual = onnx_backend.LazySession(encoder_path, arena=False).run(sample.numpy()).ravel()
+        similarity = expected @ actual / (np.linalg.norm(expected) * np.linalg.norm(actual))
+        print(f"  {'✅' if similarity > 0.999 else '❌'} SAM encoder cosine similarity {similarity:.5f}")
+        assert similarity > 0.999, "SAM encoder ONNX embeddings differ from PyTorch"
+    
+    return True
+
 def test_clothing_detector():
     """Test the clothing detector with a simple image"""
     print("🧪 Testing Clothing Detector...")
@@ -86,7 +433,10 @@ if __name__ == "__main__":
     print("=" * 40)
     
     # Test with synthetic image
-    success = test_clothing_detector()
+    success = (test_color_backends() and test_resolution_policy() and test_garment_detection()
+               and test_grabcut_segmentation() and test_wardrobe_index() and test_sequence_analysis()
+               and test_batch_checkpoint() and test_memory_budget() and test_result_cache()
+               and test_job_lifecycle() and test_onnx_parity() and test_clothing_detector())
     
     if success:
         print("\n🎉 All tests completed successfully!")
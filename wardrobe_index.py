@@ -0,0 +1,334 @@
+"""
+Persistent wardrobe color index for "what goes with this?" queries
+
+Every indexed item is a fixed-length soft color histogram of its palette
+(the `colors` of a detection), stored as one float32 row of a
+memory-mapped matrix. Item metadata lives in SQLite next to it. Adding an
+item appends (or overwrites) a single row; a query scores all of a user's
+rows with one matrix-vector product, so it stays in the low milliseconds
+at tens of thousands of items.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+# Histogram bins: a 4x4x4 grid over RGB, colors spread over nearby bins
+BIN_LEVELS = np.array([32, 96, 160, 224], dtype=np.float32)
+BIN_CENTERS = np.stack(np.meshgrid(BIN_LEVELS, BIN_LEVELS, BIN_LEVELS, indexing='ij'), axis=-1).reshape(-1, 3)
+BIN_SIGMA = 40.0
+VECTOR_SIZE = len(BIN_CENTERS)
+
+# Below this HSV saturation (0-255) a color is a neutral and matches anything
+NEUTRAL_SATURATION = 40
+
+QUERY_MODES = ('similar', 'complementary')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    row INTEGER PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    item_id TEXT NOT NULL,
+    detection INTEGER NOT NULL DEFAULT 0,
+    clothing_type TEXT,
+    colors TEXT NOT NULL,
+    updated REAL NOT NULL,
+    UNIQUE (user_id, item_id, detection)
+);
+CREATE INDEX IF NOT EXISTS items_user ON items (user_id, clothing_type);
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    version INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+# Users whose row lists are kept in memory per process
+ROW_CACHE_USERS = 1024
+
+
+def palette_vector(colors: Sequence[Dict[str, Any]]) -> np.ndarray:
+    """Unit-length soft histogram of [{'rgb': [r, g, b], 'percentage': p}, ...]"""
+    vector = np.zeros(VECTOR_SIZE, dtype=np.float32)
+    if not colors:
+        return vector
+    rgb = np.array([color['rgb'] for color in colors], dtype=np.float32).reshape(-1, 3)
+    weights = np.array([color.get('percentage', 100.0) for color in colors], dtype=np.float32)
+
+    distances = ((rgb[:, None, :] - BIN_CENTERS[None, :, :]) ** 2).sum(axis=2)
+    vector = (weights[:, None] * np.exp(-distances / (2 * BIN_SIGMA ** 2))).sum(axis=0)
+    norm = np.linalg.norm(vector)
+    return (vector / norm).astype(np.float32) if norm > 0 else vector.astype(np.float32)
+
+
+def complementary_colors(colors: Sequence[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Palette with every hue rotated 180 degrees; neutrals are kept as they are"""
+    if not colors:
+        return []
+    rgb = np.array([color['rgb'] for color in colors], dtype=np.uint8).reshape(-1, 1, 3)
+    hsv = cv2.cvtColor(rgb, cv2.COLOR_RGB2HSV)
+    chromatic = hsv[:, 0, 1] >= NEUTRAL_SATURATION
+    # OpenCV hue runs 0-179
+    hsv[chromatic, 0, 0] = (hsv[chromatic, 0, 0].astype(np.int32) + 90) % 180
+    rotated = cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB).reshape(-1, 3)
+    return [
+        {**color, 'rgb': rotated[i].tolist()}
+        for i, color in enumerate(colors)
+    ]
+
+
+def colored_detections(detections: Sequence[Dict[str, Any]]) -> List[Tuple[int, Dict[str, Any], np.ndarray]]:
+    """(number, detection, palette vector) of the successful detections that have colors.
+
+    Raises TypeError, KeyError or ValueError on a malformed detection.
+    """
+    entries = []
+    for i, detection in enumerate(detections):
+        if not isinstance(detection, dict):
+            raise TypeError(f'detection {i} is not an object')
+        if detection.get('success', True) and detection.get('colors'):
+            colors = detection['colors']
+            if not isinstance(colors, list) or not all(isinstance(color, dict) for color in colors):
+                raise TypeError(f'colors of detection {i} are not a list of objects')
+            rgb = np.array([color['rgb'] for color in colors], dtype=np.float32).reshape(-1, 3)
+            if not ((rgb >= 0) & (rgb <= 255)).all():
+                raise ValueError(f'rgb of detection {i} is outside 0-255')
+            entries.append((int(detection.get('index', i)), detection, palette_vector(colors)))
+    return entries
+
+
+class WardrobeIndex:
+    """Color vectors of closet items, shared by threads and processes.
+
+    Rows are allocated inside an SQLite write transaction and their
+    vectors written before it commits, so a row is never visible to a
+    query before its vector is on disk. The matrix file grows in chunks
+    and is remapped when another process has grown it. Each user's row
+    ids are cached in memory until any process changes that user's items.
+    """
+
+    def __init__(self, directory: str = 'wardrobe', grow_rows: int = 4096):
+        self.directory = directory
+        self.grow_rows = grow_rows
+        self.vectors_path = os.path.join(directory, 'vectors.f32')
+        self.db_path = os.path.join(directory, 'index.db')
+        self._local = threading.local()
+        self._map_lock = threading.Lock()
+        self._matrix = None
+        self._mapped_pid = None
+        self._user_rows = OrderedDict()
+        self._rows_lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+        open(self.vectors_path, 'ab').close()
+
+    def _connect(self) -> sqlite3.Connection:
+        if getattr(self._local, 'pid', None) != os.getpid():
+            db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute('PRAGMA journal_mode=WAL')
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return self._local.db
+
+    def _rows_capacity(self) -> int:
+        return os.path.getsize(self.vectors_path) // (VECTOR_SIZE * 4)
+
+    def _write_vector(self, row: int, vector: np.ndarray):
+        """Write one row, growing the file a chunk at a time (caller holds the write transaction)"""
+        with open(self.vectors_path, 'r+b') as f:
+            if row >= self._rows_capacity():
+                f.truncate((row + self.grow_rows) * VECTOR_SIZE * 4)
+            f.seek(row * VECTOR_SIZE * 4)
+            f.write(vector.astype(np.float32).tobytes())
+
+    def _matrix_rows(self, rows: int) -> np.ndarray:
+        """Memory map covering at least ``rows`` rows"""
+        with self._map_lock:
+            if self._matrix is None or self._mapped_pid != os.getpid() or len(self._matrix) < rows:
+                capacity = self._rows_capacity()
+                if capacity == 0:
+                    return np.zeros((0, VECTOR_SIZE), dtype=np.float32)
+                self._matrix = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(capacity, VECTOR_SIZE))
+                self._mapped_pid = os.getpid()
+            return self._matrix
+
+    def add(self, user_id: str, item_id: str, colors: Sequence[Dict[str, Any]],
+            clothing_type: str = None, detection: int = 0) -> int:
+        """Index one item (replacing an earlier version of it); returns its row"""
+        vector = palette_vector(colors)
+        db = self._connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = self._upsert(db, user_id, item_id, detection, colors, clothing_type, vector)
+            self._touch(db, user_id)
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        return row
+
+    def add_detections(self, user_id: str, item_id: str, detections: Sequence[Dict[str, Any]]) -> int:
+        """Index the successful detections of one detect_clothing_from_array result; returns how many.
+
+        Detections the item no longer has (e.g. after re-analysis) are removed.
+        Everything is validated first and written in one transaction, so a
+        bad detection raises (TypeError, KeyError or ValueError) without
+        changing the item.
+        """
+        entries = colored_detections(detections)
+        kept = [number for number, _, _ in entries]
+        db = self._connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            for number, detection, vector in entries:
+                self._upsert(db, user_id, item_id, number, detection['colors'], detection.get('clothing_type'), vector)
+            self._delete_rows(db, user_id, item_id, kept)
+            self._touch(db, user_id)
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        return len(entries)
+
+    def _upsert(self, db: sqlite3.Connection, user_id: str, item_id: str, detection: int,
+                colors: Sequence[Dict[str, Any]], clothing_type: Optional[str], vector: np.ndarray) -> int:
+        """Insert or replace one detection's row (caller holds the write transaction)"""
+        existing = db.execute(
+            'SELECT row FROM items WHERE user_id = ? AND item_id = ? AND detection = ?',
+            (user_id, item_id, detection)
+        ).fetchone()
+        values = (clothing_type, json.dumps(list(colors)), time.time())
+        if existing is not None:
+            row = existing['row']
+            db.execute('UPDATE items SET clothing_type = ?, colors = ?, updated = ? WHERE row = ?',
+                       values + (row,))
+        else:
+            row = db.execute('SELECT COALESCE(MAX(row) + 1, 0) FROM items').fetchone()[0]
+            db.execute(
+                'INSERT INTO items (row, user_id, item_id, detection, clothing_type, colors, updated) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (row, user_id, item_id, detection) + values
+            )
+        self._write_vector(row, vector)
+        return row
+
+    def remove(self, user_id: str, item_id: str) -> int:
+        """Drop every detection of an item; returns how many"""
+        return self._delete(user_id, item_id)
+
+    def _delete(self, user_id: str, item_id: str, keep: Sequence[int] = ()) -> int:
+        """Delete an item's detections except ``keep``; their rows are reused only at the end of the file"""
+        db = self._connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            deleted = self._delete_rows(db, user_id, item_id, keep)
+            if deleted:
+                self._touch(db, user_id)
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        return deleted
+
+    @staticmethod
+    def _delete_rows(db: sqlite3.Connection, user_id: str, item_id: str, keep: Sequence[int]) -> int:
+        placeholders = ', '.join('?' * len(keep))
+        return db.execute(
+            f'DELETE FROM items WHERE user_id = ? AND item_id = ? AND detection NOT IN ({placeholders})',
+            [user_id, item_id] + list(keep)
+        ).rowcount
+
+    @staticmethod
+    def _touch(db: sqlite3.Connection, user_id: str):
+        """Invalidate cached row lists of a user in every process (inside a write transaction)"""
+        db.execute(
+            'INSERT INTO users (user_id, version) VALUES (?, 1) '
+            'ON CONFLICT (user_id) DO UPDATE SET version = version + 1',
+            (user_id,)
+        )
+
+    def _rows_of(self, user_id: str) -> Tuple[np.ndarray, np.ndarray]:
+        """(rows, clothing types) of a user's items, cached until the user's version changes"""
+        db = self._connect()
+        version = db.execute('SELECT version FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        version = version[0] if version is not None else 0
+        with self._rows_lock:
+            cached = self._user_rows.get(user_id)
+            if cached is not None and cached[0] == version:
+                self._user_rows.move_to_end(user_id)
+                return cached[1], cached[2]
+
+        items = db.execute('SELECT row, clothing_type FROM items WHERE user_id = ?', (user_id,)).fetchall()
+        rows = np.array([item[0] for item in items], dtype=np.int64)
+        types = np.array([item[1] or '' for item in items], dtype=object)
+        with self._rows_lock:
+            self._user_rows[user_id] = (version, rows, types)
+            self._user_rows.move_to_end(user_id)
+            while len(self._user_rows) > ROW_CACHE_USERS:
+                self._user_rows.popitem(last=False)
+        return rows, types
+
+    def get(self, user_id: str, item_id: str) -> List[Dict[str, Any]]:
+        """Indexed detections of one item"""
+        rows = self._connect().execute(
+            'SELECT * FROM items WHERE user_id = ? AND item_id = ? ORDER BY detection', (user_id, item_id)
+        ).fetchall()
+        return [self._item(row) for row in rows]
+
+    def query(self, user_id: str, colors: Sequence[Dict[str, Any]], k: int = 5, mode: str = 'similar',
+              clothing_type: str = None, exclude_item: str = None) -> List[Dict[str, Any]]:
+        """Top-k items of a user by cosine similarity to a palette (or to its complement)"""
+        if mode not in QUERY_MODES:
+            raise ValueError(f"Unknown query mode '{mode}', expected one of {QUERY_MODES}")
+        target = palette_vector(complementary_colors(colors) if mode == 'complementary' else colors)
+
+        db = self._connect()
+        rows, types = self._rows_of(user_id)
+        keep = np.ones(len(rows), dtype=bool)
+        if clothing_type is not None:
+            keep &= types == clothing_type
+        if exclude_item is not None:
+            excluded = [r[0] for r in db.execute(
+                'SELECT row FROM items WHERE user_id = ? AND item_id = ?', (user_id, exclude_item)
+            )]
+            keep &= ~np.isin(rows, excluded)
+        rows = rows[keep]
+        if len(rows) == 0 or k <= 0:
+            return []
+
+        scores = self._matrix_rows(int(rows.max()) + 1)[rows] @ target
+        top = np.argpartition(-scores, k - 1)[:k] if len(scores) > k else np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind='stable')]
+
+        matches = []
+        for i in top:
+            item = self._item(db.execute('SELECT * FROM items WHERE row = ?', (int(rows[i]),)).fetchone())
+            item['score'] = round(float(scores[i]), 4)
+            matches.append(item)
+        return matches
+
+    def stats(self) -> Dict[str, Any]:
+        row = self._connect().execute('SELECT COUNT(*), COUNT(DISTINCT user_id) FROM items').fetchone()
+        return {
+            'items': row[0],
+            'users': row[1],
+            'capacity': self._rows_capacity()
+        }
+
+    @staticmethod
+    def _item(row: sqlite3.Row) -> Dict[str, Any]:
+        return {
+            'item_id': row['item_id'],
+            'detection': row['detection'],
+            'clothing_type': row['clothing_type'],
+            'colors': json.loads(row['colors'])
+        }
@@ -0,0 +1,55 @@
+"""
+Binary wire format: raw image uploads and MessagePack responses
+
+Images can be sent as the raw request body (``application/octet-stream``
+or any ``image/*`` type) instead of base64 inside JSON, and responses are
+encoded as MessagePack when the Accept header prefers it. Both encodings
+carry the same payload schema.
+"""
+
+from typing import Any, Dict
+
+from flask import Response, jsonify, request
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_MIMETYPE = 'application/msgpack'
+# Names used by clients written before application/msgpack was registered
+MSGPACK_MIMETYPES = (MSGPACK_MIMETYPE, 'application/x-msgpack', 'application/vnd.msgpack')
+
+
+def msgpack_available() -> bool:
+    """Whether MessagePack responses can be produced (the optional msgpack package is installed)"""
+    return msgpack is not None
+
+
+def is_raw_image(mimetype: str) -> bool:
+    """Whether a request body is a bare encoded image"""
+    return mimetype == 'application/octet-stream' or mimetype.startswith('image/')
+
+
+def prefers_msgpack(accept_mimetypes) -> bool:
+    """True when the client ranks MessagePack above JSON; JSON wins ties and */*"""
+    if msgpack is None:
+        return False
+    best = accept_mimetypes.best_match(('application/json',) + MSGPACK_MIMETYPES, default='application/json')
+    return best in MSGPACK_MIMETYPES
+
+
+def pack(payload: Dict[str, Any]) -> bytes:
+    """MessagePack encoding of a JSON-compatible payload"""
+    return msgpack.packb(payload, use_bin_type=True)
+
+
+def negotiated_response(payload: Dict[str, Any], status: int = 200) -> Response:
+    """JSON response for the current request, or MessagePack when the Accept header prefers it"""
+    if prefers_msgpack(request.accept_mimetypes):
+        response = Response(pack(payload), mimetype=MSGPACK_MIMETYPE)
+    else:
+        response = jsonify(payload)
+    response.status_code = status
+    response.vary.add('Accept')
+    return response